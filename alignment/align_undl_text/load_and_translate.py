@@ -1,5 +1,6 @@
 import os.path
 from pathlib import Path
+import sys
 import time
 import re
 from datasets import load_from_disk
@@ -7,7 +8,13 @@ import argostranslate.package
 import argostranslate.translate
 import os
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from response_cache import ResponseCache, DEFAULT_CACHE_FILE
+
 PATH = r'F:\undl_text_local'
+MT_MODEL = 'argostranslate'
+MT_PROMPT_TEMPLATE = 'en->zh' # 机翻没有提示词，用翻译方向区分
+response_cache = ResponseCache(Path(__file__).resolve().parent / DEFAULT_CACHE_FILE) # 联合国文件里大量段落是重复的套话，同样的段落只翻一次
 
 def load_random_clean_docs(ds, l, r):
     # sample_doc = dataset
@@ -69,7 +76,11 @@ def translate(row):
             translation.append(para)
         else:
             try:
-                translation.append(argostranslate.translate.translate(para, 'en', 'zh'))
+                translated = response_cache.get(MT_MODEL, MT_PROMPT_TEMPLATE, para)
+                if translated is None:
+                    translated = argostranslate.translate.translate(para, 'en', 'zh')
+                    response_cache.put(MT_MODEL, MT_PROMPT_TEMPLATE, para, translated)
+                translation.append(translated)
             except Exception as e:
                 print(e)
                 translation.append(para)
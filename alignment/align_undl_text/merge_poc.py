@@ -1,11 +1,14 @@
 import os
 from pathlib import Path
-import hashlib
 import json
 import re
+import sys
 
 import datasets
 
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+import corpus_record
+
 ALL_SOURCE_LANGS = ('es', 'zh', 'fr', 'ru', 'ar', 'de')
 TARGET_LANG = 'en'
 INPUT_DIR_ALIGNMENT = Path(r'F:\undl_text_alignment_prod') # align2_poc.py输出
@@ -118,6 +121,7 @@ def gen_func():
 
 
         blk_infos = []
+        blk_texts = []
         for idx, keylist in enumerate(blocks.values()):
             para_text_buffer = {}
             keylist.sort()
@@ -130,7 +134,7 @@ def gen_func():
                 '行号': overall_blocks_count,
                 '是否重复': False,
                 '是否跨文件重复': False,
-                'zh_text_md5': hashlib.md5(para_text_buffer.get('zh','').encode('utf-8')).hexdigest(),
+                'zh_text_md5': '', # 整个文件的块都生成后再批量计算
                 'zh_text': para_text_buffer.get('zh',''),
                 'en_text': para_text_buffer.get('en',''),
                 'ar_text': para_text_buffer.get('ar',''),
@@ -152,6 +156,9 @@ def gen_func():
             }
             overall_blocks_count += 1
             blk_infos.append(output_block_info)
+            blk_texts.append(output_block_info['zh_text'])
+        for output_block_info, zh_text_md5 in zip(blk_infos, corpus_record.zh_text_md5_batch(blk_texts)):
+            output_block_info['zh_text_md5'] = zh_text_md5
         if blk_infos:
             output_file_info['段落'] = blk_infos
             with OUTPUT_FILE_INFO.open('a', encoding='utf-8') as f:
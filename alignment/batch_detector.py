@@ -1,20 +1,34 @@
 from typing import Tuple
+import asyncio
 import itertools
 from pathlib import Path
 import json
 
 from alignment.text_segmenter import HardLineBreakDetector
+from alignment.response_cache import ResponseCache, DEFAULT_CACHE_FILE, cache_path_beside
 import alignment.utils as utils
 
 
 class GPTBatchDetector(HardLineBreakDetector):
-    def __init__(self, name, cache_dir, token_limit=1400, use_proxy=False):
+    def __init__(self, name, cache_dir, token_limit=1400, use_proxy=False, concurrency=8, rpm=3500, tpm=90000, api_url=None,
+                 response_cache_path=DEFAULT_CACHE_FILE):
         super().__init__(name)
         self.cache_dir = Path(cache_dir)
         self.cache_dir.mkdir(parents=True, exist_ok=True)
         self.cache = {}
         self.token_limit = token_limit
         self.use_proxy = use_proxy
+        # 并发请求的配置，见utils.AsyncGPTClient
+        self.concurrency = concurrency
+        self.rpm = rpm
+        self.tpm = tpm
+        self.api_url = api_url
+        # GPT的回答统一缓存在response_cache_path（相对路径按cache_dir所在的目录解析），为None时不缓存；cache_dir下旧的按batch存的缓存文件仍然会读
+        self.response_cache = ResponseCache(cache_path_beside(self.cache_dir, response_cache_path)) if response_cache_path else None
+
+    def create_client(self) -> utils.AsyncGPTClient:
+        return utils.AsyncGPTClient(use_proxy=self.use_proxy, api_url=self.api_url,
+            concurrency=self.concurrency, rpm=self.rpm, tpm=self.tpm, response_cache=self.response_cache)
 
     def create_batches(self, lines: list[str]) -> list[list[str]]:
         """
@@ -58,7 +72,8 @@ class GPTBatchDetector(HardLineBreakDetector):
     def gpt_linebreak_detection_request(self, raw_text: str, record_id: str, batch_index: int) -> str:
         """
         Sends a request to the GPT-3.5 API to detect hard line breaks in the given text.
-        Use record_id and batch_index to cache the output.
+        The output is cached in the response cache by its input text. Outputs cached under cache_dir
+        by record_id and batch_index in earlier versions are still used.
 
         Args:
             raw_text (str): The raw text to be processed.
@@ -70,12 +85,27 @@ class GPTBatchDetector(HardLineBreakDetector):
         """
         filename = self.cache_dir / f'record_{record_id}_processed_batch_{batch_index}.json'
         if not filename.exists():
-            output_text = utils.gpt_detect_hard_line_breaks(raw_text, use_proxy=self.use_proxy)
-            with filename.open('w') as f:
-                json.dump(output_text, f)
+            output_text = utils.gpt_detect_hard_line_breaks(raw_text, use_proxy=self.use_proxy, api_url=self.api_url,
+                response_cache=self.response_cache)
         else:
             with filename.open('r') as f:
                 output_text = json.load(f)
+        return self.clearup_output(output_text, record_id, batch_index)
+
+    async def agpt_linebreak_detection_request(self, client: utils.AsyncGPTClient, raw_text: str, record_id: str, batch_index: int) -> str:
+        """
+        Asynchronous version of gpt_linebreak_detection_request, sending the request through the shared `client`.
+        """
+        filename = self.cache_dir / f'record_{record_id}_processed_batch_{batch_index}.json'
+        if not filename.exists():
+            output_text = await client.detect_hard_line_breaks(raw_text)
+        else:
+            with filename.open('r') as f:
+                output_text = json.load(f)
+        return self.clearup_output(output_text, record_id, batch_index)
+
+    @staticmethod
+    def clearup_output(output_text: str, record_id: str, batch_index: int) -> str:
         output_text = output_text.replace('\n\n', '\n')
         if '\n\n' in output_text:
             print(record_id, batch_index)
@@ -93,13 +123,23 @@ class GPTBatchDetector(HardLineBreakDetector):
         Returns:
             Tuple[list[str], list[bool]]: The processed lines and their corresponding boolean detections.
         """
+        async def process_with_client():
+            async with self.create_client() as client:
+                return await self.aprocess_batches(client, batches, record_id)
+        return utils.run_async(process_with_client())
+
+    async def aprocess_batches(self, client: utils.AsyncGPTClient, batches: list[list[str]], record_id: str) -> Tuple[list[str], list[bool]]:
+        """
+        Asynchronous version of process_batches. All batches are sent concurrently through the shared `client`.
+        """
         processed_batches = []
         detections = []
 
-        for i, batch in enumerate(batches):
-            raw_text = "\n".join(batch)
-
-            output_text = self.gpt_linebreak_detection_request(raw_text, record_id, i)
+        raw_texts = ["\n".join(batch) for batch in batches]
+        output_texts = await asyncio.gather(*(
+            self.agpt_linebreak_detection_request(client, raw_text, record_id, i) for i, raw_text in enumerate(raw_texts)
+        ))
+        for raw_text, output_text in zip(raw_texts, output_texts):
             # Compare the hard line breaks in the raw text with the output text
             is_hard_line_break = utils.compute_near_linebreak_match(raw_text, output_text, margin=10)
 
@@ -141,6 +181,30 @@ class GPTBatchDetector(HardLineBreakDetector):
         # post_processed_detections = self.post_process(processed_batches, detections)
         return detections
 
+    async def adetect(self, client: utils.AsyncGPTClient, lines: list[str], record_id: str) -> list[bool]:
+        """
+        Asynchronous version of detect, sending requests through the shared `client`.
+        """
+        batches = self.create_batches(lines)
+        processed_batches, detections = await self.aprocess_batches(client, batches, record_id)
+        return detections
+
+    def detect_records(self, records: list[Tuple[list[str], str]]) -> list[list[bool]]:
+        """
+        Detects many records concurrently. All requests share one client, so the concurrency and
+        rate limits apply to the whole run.
+
+        Args:
+            records (list[Tuple[list[str], str]]): (lines, record_id) of each record.
+
+        Returns:
+            list[list[bool]]: The detection results of each record.
+        """
+        async def detect_with_client():
+            async with self.create_client() as client:
+                return await asyncio.gather(*(self.adetect(client, lines, record_id) for lines, record_id in records))
+        return utils.run_async(detect_with_client())
+
 
 if __name__ == '__main__':
     # Test the GPTBatchDetector
@@ -1,5 +1,6 @@
 from collections import namedtuple
 from datetime import datetime
+import asyncio
 import traceback
 from typing import Tuple
 import itertools
@@ -12,14 +13,17 @@ import tiktoken
 import pylcs
 
 from text_segmenter import HardLineBreakDetector
+from response_cache import ResponseCache, DEFAULT_CACHE_FILE, cache_path_beside
 import utils
 
 LCSTokenInfo = namedtuple('LCSTokenInfo', ('token', 'length', 'source_line_id'))
 
 class GPTBatchSequentialDetector(HardLineBreakDetector):
     LEADING_NOISE_SCAN_LINE_LIMIT = 12 # 
+    SENTENCE_END_PATTERN = re.compile(r'[.?!:;]["”’)\]]*$') # 以句末标点（及其后的引号、括号）结尾的行，推测下一个batch的起点用
 
-    def __init__(self, name, cache_dir, token_limit=500, use_proxy=False, re_ask_times=3, ignore_leading_noise_lines=True):
+    def __init__(self, name, cache_dir, token_limit=500, use_proxy=False, re_ask_times=3, ignore_leading_noise_lines=True,
+                 concurrency=8, rpm=3500, tpm=90000, api_url=None, speculative_depth=0, response_cache_path=DEFAULT_CACHE_FILE):
         super().__init__(name)
         self.cache_dir = Path(cache_dir)
         self.cache_dir.mkdir(parents=True, exist_ok=True)
@@ -27,8 +31,26 @@ class GPTBatchSequentialDetector(HardLineBreakDetector):
         self.token_limit = token_limit
         self.use_proxy = use_proxy
         self.encoder = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        # generate_batch用的逐行token数缓存：行文本 -> token数，(上一行, 本行) -> 用'\n'接上本行后多出的token数
+        self.line_token_count_cache = {}
+        self.joint_token_count_cache = {}
+        self.last_batch_token_count = (None, 0) # 最近一个batch及其token数，detect中不必再编码一遍
         self.re_ask_times = re_ask_times
         self.ignore_leading = ignore_leading_noise_lines
+        # 并发请求的配置，见utils.AsyncGPTClient。同一文件的batch只能逐个请求，并发来自同时处理多个文件
+        self.concurrency = concurrency
+        self.rpm = rpm
+        self.tpm = tpm
+        self.api_url = api_url
+        # 推测执行：在当前batch的结果返回前，按推测的起点提前请求之后的speculative_depth个batch，0为不推测
+        self.speculative_depth = speculative_depth
+        # GPT的回答统一缓存在response_cache_path（相对路径按cache_dir所在的目录解析），为None时不缓存；cache_dir下旧的按batch存的缓存文件仍然会读
+        self.response_cache = ResponseCache(cache_path_beside(self.cache_dir, response_cache_path)) if response_cache_path else None
+
+    def create_client(self) -> utils.AsyncGPTClient:
+        # 缓存由align_gpt_linebreak_detection_request自己读写，只缓存有用的output，所以不交给client
+        return utils.AsyncGPTClient(use_proxy=self.use_proxy, api_url=self.api_url,
+            concurrency=self.concurrency, rpm=self.rpm, tpm=self.tpm)
 
     @staticmethod
     def clearup_output(raw_output_from_chatgpt: str) -> list[str]:
@@ -224,50 +246,115 @@ class GPTBatchSequentialDetector(HardLineBreakDetector):
         return list(align_map.values())
 
 
-    def align_gpt_linebreak_detection_request(self, raw_text: str, record_id: str, batch_index: int, drop_last_paragraph=True) -> list[Tuple[int, int]]:
+    async def align_gpt_linebreak_detection_request(self, client: utils.AsyncGPTClient, raw_text: str, record_id: str, batch_index: int,
+                                                    drop_last_paragraph=True, input_tokens: int = None, speculative_output: asyncio.Task = None) -> list[Tuple[int, int]]:
         """
-        Sends a request to the GPT-3.5 API to detect hard line breaks in the given text, 
+        Sends a request to the GPT-3.5 API through the shared `client` to detect hard line breaks in the given text, 
         and align the given text to its output text on the fly.
-        Use `record_id` and `batch_index` to cache the output.
+        The output is cached in the response cache by its input text, so the same batch is not asked again
+        in another record or with another token_limit. Outputs cached under cache_dir by `record_id` and `batch_index`
+        in earlier versions are still used.
+        A cached output is checked like a fresh one and counts as the first answer.
         Unexpected output will not be cached and cause re-asking procedure.
         Use `re_ask_times` to set the retry times for re-asking gpt when unexpected answer generated.
 
         Args:
+            client (utils.AsyncGPTClient): The client shared by all concurrent requests.
             raw_text (str): The raw text to be processed.
             record_id (int): The unique id of the record.
             batch_index (int): The index of the batch.
             drop_last_paragraph (bool): set to False if the current batch is the last batch, so that the last paragraph will not be dropped.
+            input_tokens (int): The token number of raw_text if known, used for rate limiting.
+            speculative_output (asyncio.Task): A request for the same raw_text sent in advance, used as the first answer.
 
         Returns:
             list[Tuple[int, int]]: The aligned paragragh group intervals indicating a output line refers to which input lines.
         """
 
         filename = self.cache_dir / f'record_{record_id}_processed_batch_{batch_index}.json'
-        if not filename.exists():
-            for re_ask_time in range(self.re_ask_times):
-                output_text = utils.gpt_detect_hard_line_breaks(raw_text, use_proxy=self.use_proxy)
-                segment_list = GPTBatchSequentialDetector.construct_segment_list_from_output_text(raw_text, output_text,
-                    re_ask_time == self.re_ask_times - 1, drop_last_paragraph)
-                if len(segment_list) == 0: # 记录一下GPT说的胡话以便日后分析
-                    with Path('unexpected_outputs.jsonl').open('a', encoding='utf-8') as f:
-                        json.dump({'time': str(datetime.now()), 'record': record_id, 'batch': batch_index, 'input': raw_text, 'output': output_text})
-                        f.write('\n')
-                else:
-                    break
-            with filename.open('w') as f: # 只有有用的output才会被cache
-                json.dump(output_text, f)
-        else:
+        if filename.exists():
+            if speculative_output is not None:
+                speculative_output.cancel()
             with filename.open('r') as f:
                 output_text = json.load(f)
-                segment_list = GPTBatchSequentialDetector.construct_segment_list_from_output_text(raw_text, output_text,
-                    True, drop_last_paragraph)
-            
+            return GPTBatchSequentialDetector.construct_segment_list_from_output_text(raw_text, output_text,
+                True, drop_last_paragraph)
+
+        # 别的detector或脚本也会往同一个key下写没检查过的回答，所以缓存的回答也要检查，只算作第一次回答
+        cached_output = None
+        if self.response_cache is not None:
+            cached_output = self.response_cache.get(utils.CHAT_MODEL, utils.CHAT_PROMPT_TEMPLATE, raw_text)
+        if cached_output is not None and speculative_output is not None:
+            speculative_output.cancel()
+        segment_list = []
+        for re_ask_time in range(self.re_ask_times):
+            if re_ask_time == 0 and cached_output is not None:
+                output_text = cached_output
+            elif re_ask_time == 0 and speculative_output is not None:
+                output_text = await speculative_output
+            else:
+                output_text = await client.detect_hard_line_breaks(raw_text, input_tokens, use_cache=False)
+            segment_list = GPTBatchSequentialDetector.construct_segment_list_from_output_text(raw_text, output_text,
+                False, drop_last_paragraph)
+            if len(segment_list) == 0: # 记录一下GPT说的胡话以便日后分析
+                with Path('unexpected_outputs.jsonl').open('a', encoding='utf-8') as f:
+                    json.dump({'time': str(datetime.now()), 'record': record_id, 'batch': batch_index, 'input': raw_text, 'output': output_text}, f)
+                    f.write('\n')
+            else:
+                if self.response_cache is not None and output_text != cached_output: # 只有通过检查的output才会被cache
+                    self.response_cache.put(utils.CHAT_MODEL, utils.CHAT_PROMPT_TEMPLATE, raw_text, output_text)
+                break
+        if len(segment_list) == 0: # 反复重问都不行，令换行原样返回
+            segment_list = GPTBatchSequentialDetector.construct_segment_list_from_output_text(raw_text, output_text,
+                True, drop_last_paragraph)
         return segment_list
 
+    TOKEN_COUNT_CACHE_SIZE = 1 << 18
+
+    def count_tokens(self, text: str) -> int:
+        batch, token_count = self.last_batch_token_count
+        if text == batch:
+            return token_count
+        return len(self.encoder.encode(text))
+
+    def line_token_count(self, line: str) -> int:
+        token_count = self.line_token_count_cache.get(line)
+        if token_count is None:
+            if len(self.line_token_count_cache) >= self.TOKEN_COUNT_CACHE_SIZE:
+                self.line_token_count_cache.clear()
+            token_count = self.line_token_count_cache[line] = len(self.encoder.encode(line))
+        return token_count
+
+    def joint_token_count(self, prev_line: str, line: str) -> int:
+        """在prev_line后面用'\n'接上line多出的token数。'\n'可能与上一行末尾的标点合成一个token，所以不是简单的line的token数加1"""
+        token_count = self.joint_token_count_cache.get((prev_line, line))
+        if token_count is None:
+            if len(self.joint_token_count_cache) >= self.TOKEN_COUNT_CACHE_SIZE:
+                self.joint_token_count_cache.clear()
+            token_count = len(self.encoder.encode(prev_line + '\n' + line)) - self.line_token_count(prev_line)
+            self.joint_token_count_cache[(prev_line, line)] = token_count
+        return token_count
+
+    def generate_batch_by_full_encoding(self, lines: list[str], begin_lineid: int) -> str:
+        # 原先的做法：每加一行都把整个batch重新编码一遍，batch越长越慢，只在逐行估计与实际不符时使用
+        buffer = ''
+        for lineid in range(begin_lineid, len(lines)):
+            line = lines[lineid]
+            pending_text = (buffer + '\n' if len(buffer)>0 else '') + line
+            tokens = self.encoder.encode(pending_text)
+            if len(tokens) >= self.token_limit:
+                return buffer
+            buffer = pending_text
+        if buffer:
+            return buffer
+
     def generate_batch(self, lines: list[str], begin_lineid: int) -> str:
         """
         从begin_lineid开始构造一个连续若干行的batch，使这个batch尽可能大，同时不超出self.token_limit指定的限制。
 
+        每行的token数和相邻两行接上后多出的token数都有缓存，逐行累加即可估计batch的token数，不必反复编码整个batch；
+        找到边界后再把边界两侧的batch各实际编码一次确认，估计与实际不符时退回逐行整体编码的做法，结果与之完全一致。
+
         Args:
             lines (list[str]): 源输入文件按行隔开的文本
             begin_lineid (int): 欲开始构造的行下标，包含此行
@@ -277,16 +364,26 @@ class GPTBatchSequentialDetector(HardLineBreakDetector):
 
         """
         # assert begin_lineid < len(lines)
-        buffer = ''
+        if begin_lineid >= len(lines) or not lines[begin_lineid]:
+            # 原先的做法在batch为空时会跳过空行，开头是空行时拼出的batch不是简单的'\n'.join，直接沿用原先的做法
+            return self.generate_batch_by_full_encoding(lines, begin_lineid)
+        end_lineid = len(lines) # 估计的第一个放不下的行
+        token_count = self.line_token_count(lines[begin_lineid])
         for lineid in range(begin_lineid, len(lines)):
-            line = lines[lineid]
-            pending_text = (buffer + '\n' if len(buffer)>0 else '') + line
-            tokens = self.encoder.encode(pending_text)
-            if len(tokens) >= self.token_limit:
-                return buffer
-            buffer = pending_text
-        if buffer:
-            return buffer
+            if lineid > begin_lineid:
+                token_count += self.joint_token_count(lines[lineid - 1], lines[lineid])
+            if token_count >= self.token_limit:
+                end_lineid = lineid
+                break
+        batch = '\n'.join(lines[begin_lineid:end_lineid])
+        batch_token_count = len(self.encoder.encode(batch))
+        if batch_token_count >= self.token_limit: # 估计少了
+            return self.generate_batch_by_full_encoding(lines, begin_lineid)
+        if end_lineid < len(lines) and end_lineid > begin_lineid:
+            if len(self.encoder.encode(batch + '\n' + lines[end_lineid])) < self.token_limit: # 估计多了
+                return self.generate_batch_by_full_encoding(lines, begin_lineid)
+        self.last_batch_token_count = (batch, batch_token_count)
+        return batch
 
     def ignore_first_page_leading_noises(self, lines: list[str]) -> int:
         """
@@ -368,6 +465,75 @@ class GPTBatchSequentialDetector(HardLineBreakDetector):
         Returns:
             list[bool]: The detection results.
         """
+        return self.detect_records([(lines, record_id)])[0]
+
+    def detect_records(self, records: list[Tuple[list[str], str]]) -> list[list[bool]]:
+        """
+        Detects many records concurrently. Batches of one record are still requested one by one,
+        while different records are processed in parallel through one shared client.
+
+        Args:
+            records (list[Tuple[list[str], str]]): (lines, record_id) of each record.
+
+        Returns:
+            list[list[bool]]: The detection results of each record.
+        """
+        async def detect_with_client():
+            async with self.create_client() as client:
+                return await asyncio.gather(*(self.adetect(client, lines, record_id) for lines, record_id in records))
+        return utils.run_async(detect_with_client())
+
+    @staticmethod
+    def predict_next_begin_lineid(lines: list[str], begin_lineid: int, batch_line_count: int) -> int:
+        """
+        推测以begin_lineid开始、共batch_line_count行的batch处理完后，下一个batch从哪一行开始。
+        GPT成段后最后一个大段会被丢掉，下一个batch从这个大段的第一行开始；我们假设段落都以句末标点结尾，
+        即下一个batch从batch最后一行之前最后一个以句末标点结尾的行的下一行开始。没有这样的行时认为整个batch成了一段，从batch之后开始。
+        """
+        for lineid in range(begin_lineid + batch_line_count - 2, begin_lineid - 1, -1):
+            if GPTBatchSequentialDetector.SENTENCE_END_PATTERN.search(lines[lineid]):
+                return lineid + 1
+        return begin_lineid + batch_line_count
+
+    def last_legacy_batch_id(self, record_id: str) -> int:
+        """cache_dir下该记录旧的按batch存的缓存文件中最大的batch下标，没有时返回-1"""
+        batch_ids = [int(m.group(1)) for f in self.cache_dir.glob(f'record_{record_id}_processed_batch_*.json')
+                     if (m := re.fullmatch(rf'record_{re.escape(str(record_id))}_processed_batch_(\d+)\.json', f.name))]
+        return max(batch_ids, default=-1)
+
+    def speculate(self, client: utils.AsyncGPTClient, lines: list[str], record_id: str, batch_id: int,
+                  begin_lineid: int, batch_line_count: int, speculative_requests: dict[int, Tuple[str, asyncio.Task]],
+                  last_legacy_batch_id: int = -1):
+        """
+        从当前batch出发逐个推测之后speculative_depth个batch的起点，提前发出还没有缓存、也没有发出过的请求。
+        请求放在speculative_requests里：起点行号 -> (batch, 请求)，只有真实起点与推测一致时才会用到其结果。
+        旧的缓存文件按batch下标存，而推测的batch最终在哪个下标被用到事先并不知道，
+        所以之后还有旧缓存文件（batch_id < last_legacy_batch_id）时不推测，这些batch会直接读旧文件。
+        """
+        if batch_id < last_legacy_batch_id:
+            return
+        for _ in range(self.speculative_depth):
+            if begin_lineid + batch_line_count >= len(lines): # 推测到了最后一批
+                return
+            begin_lineid = self.predict_next_begin_lineid(lines, begin_lineid, batch_line_count)
+            batch = self.generate_batch(lines, begin_lineid)
+            batch_line_count = batch.count('\n') + 1
+            batch_token_count = self.count_tokens(batch)
+            if batch_token_count < 20:
+                return
+            if begin_lineid in speculative_requests:
+                continue
+            if self.response_cache is not None and self.response_cache.contains(utils.CHAT_MODEL, utils.CHAT_PROMPT_TEMPLATE, batch):
+                continue
+            speculative_requests[begin_lineid] = (batch, asyncio.create_task(client.detect_hard_line_breaks(batch, batch_token_count, use_cache=False)))
+
+    async def adetect(self, client: utils.AsyncGPTClient, lines: list[str], record_id: str) -> list[bool]:
+        """
+        Asynchronous version of detect, sending requests through the shared `client`.
+        With `speculative_depth` > 0, the following batches are requested in advance from predicted begin lines
+        (see predict_next_begin_lineid). A batch is re-requested only when its real begin line differs from the prediction,
+        so the detections are the same as without speculation.
+        """
         # processed_batches = []
         detections = [True] * (len(lines) - 1)
 
@@ -378,28 +544,49 @@ class GPTBatchSequentialDetector(HardLineBreakDetector):
             new_batch_begin_lineid = self.ignore_first_page_leading_noises(lines)
             print(f'[{record_id}]first batch begin at:{new_batch_begin_lineid}')
 
-        while new_batch_begin_lineid < len(lines):
-            batch = self.generate_batch(lines, new_batch_begin_lineid) # 利用已有的结果生成input_batch
-            batch_line_count = batch.count('\n') + 1
-            next_lineid = new_batch_begin_lineid + batch_line_count
-            if len(self.encoder.encode(batch)) < 20: # 结尾不能成段的噪声可能会让gpt疯狂道歉，这种情况下我们放过
-                break
+        speculative_requests = {} # 推测的起点行号 -> (batch, 提前发出的请求)
+        last_legacy_batch_id = self.last_legacy_batch_id(record_id) if self.speculative_depth else -1
+        try:
+            while new_batch_begin_lineid < len(lines):
+                batch = self.generate_batch(lines, new_batch_begin_lineid) # 利用已有的结果生成input_batch
+                batch_line_count = batch.count('\n') + 1
+                next_lineid = new_batch_begin_lineid + batch_line_count
+                batch_token_count = self.count_tokens(batch)
+                if batch_token_count < 20: # 结尾不能成段的噪声可能会让gpt疯狂道歉，这种情况下我们放过
+                    break
 
-            # 获取成段区间表
-            segment_list = self.align_gpt_linebreak_detection_request(batch, record_id, batch_id,
-                drop_last_paragraph=next_lineid < len(lines)) # 如果是最后一批，就不要丢掉最后一个大段
+                speculative_output = None
+                speculative_batch, speculative_request = speculative_requests.pop(new_batch_begin_lineid, (None, None))
+                if speculative_batch == batch: # 推测命中
+                    speculative_output = speculative_request
+                elif speculative_request is not None:
+                    speculative_request.cancel()
+                if self.speculative_depth:
+                    self.speculate(client, lines, record_id, batch_id, new_batch_begin_lineid, batch_line_count, speculative_requests,
+                                   last_legacy_batch_id)
+
+                # 获取成段区间表
+                segment_list = await self.align_gpt_linebreak_detection_request(client, batch, record_id, batch_id,
+                    drop_last_paragraph=next_lineid < len(lines), input_tokens=batch_token_count, # 如果是最后一批，就不要丢掉最后一个大段
+                    speculative_output=speculative_output)
+
+                for l_border, r_border in segment_list:
+                    detections[new_batch_begin_lineid + l_border:new_batch_begin_lineid + r_border] = [False] * (r_border - l_border) # 每个段落的区间赋值为False
+                    
+                if next_lineid < len(lines):
+                    # max(itertools.chain(*segment_list)) 取最大已成段行号
+                    new_batch_begin_lineid += max(itertools.chain(*segment_list)) + 1 
+                else:
+                    # 已经做完了本文件，接下来不再请求了
+                    new_batch_begin_lineid = len(lines)
 
-            for l_border, r_border in segment_list:
-                detections[new_batch_begin_lineid + l_border:new_batch_begin_lineid + r_border] = [False] * (r_border - l_border) # 每个段落的区间赋值为False
-                
-            if next_lineid < len(lines):
-                # max(itertools.chain(*segment_list)) 取最大已成段行号
-                new_batch_begin_lineid += max(itertools.chain(*segment_list)) + 1 
-            else:
-                # 已经做完了本文件，接下来不再请求了
-                new_batch_begin_lineid = len(lines)
+                batch_id += 1
 
-            batch_id += 1
+                for begin_lineid in [x for x in speculative_requests if x < new_batch_begin_lineid]: # 起点已经跳过，推测落空
+                    speculative_requests.pop(begin_lineid)[1].cancel()
+        finally:
+            for _, speculative_request in speculative_requests.values():
+                speculative_request.cancel()
 
         return detections
 
@@ -0,0 +1,408 @@
+"""
+换行检测器的可复现校验脚本。
+
+GPT检测器对本地模拟服务器的差分测试：
+    python detector_bench.py mockdiff
+    python detector_bench.py mockdiff --input 453500.txt validation_small.jsonl --records 8 --fault_rate 0.3 --concurrency 16 --speculative_depth 2
+在本进程里起一个模拟 chat completions 接口的 aiohttp 服务器：按句末标点把行接成段落作为回答，
+并按 --fault_rate 随机返回带 Retry-After 的429、"overloaded" 错误、未知错误，或漏掉回答开头的'{'。
+先在没有故障的服务器上用 concurrency=1 逐个记录 detect 得到串行结果，再在有故障的服务器上用 detect_records 并发跑一遍，
+检查 GPTBatchDetector、GPTBatchSequentialDetector 两者的检测结果与串行结果完全一致，
+同时检查同时在途的请求数不超过 concurrency、重试没有早于 Retry-After、请求速率不超过 --rpm 的令牌桶，任何一项不满足时退出码非0。
+需要 aiohttp 和 tiktoken 的 gpt-3.5-turbo 词表；不会读写 GPT 回答缓存，也不会请求真实的接口。
+
+单独运行模拟服务器（配合 evaluate_segmentation.py 的 api_url 使用）：
+    python detector_bench.py mockserver --port 8765 --fault_rate 0.2
+
+RuleBasedDetector 与原实现的差分测试：
+    python detector_bench.py rulediff
+    python detector_bench.py rulediff --hf_validation --records 20
+RuleBasedDetector.detect 用带缓存的 punkt 分句器副本（依赖nltk的内部实现）和提前结束的打分，这里逐条比较：
+每个行对窗口的分句结果与 nltk.sent_tokenize、is_soft_by_simple_and_nltk 与 score_simple + score_by_nltk > 0、
+以及 detect（首次和缓存命中后的再次调用）与按原先逐行打分写出的 reference_rule_detect 是否完全一致，并报告两者耗时，任何不一致时退出码非0。
+输入为 --input 的文件、用其中的词造的合成记录，以及打乱、截断、拼接、加列表标号得到的变体；--hf_validation 时加上评测用的验证集。
+升级nltk后应重新跑一遍。
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+from pathlib import Path
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+sys.path.append(str(Path(__file__).resolve().parent.parent)) # batch_detector以alignment包的形式引用其它模块
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+DEFAULT_INPUTS = [SCRIPT_DIR / 'validation_small.jsonl', SCRIPT_DIR / '453500.txt']
+SENTENCE_END = re.compile(r'[.?!:;]["”’)\]]*$')
+RATE_SLACK = 2 # 请求从令牌桶出来到服务器收到之间有调度抖动，允许多出的请求数
+
+
+def mock_join(text: str) -> str:
+    """模拟GPT的回答：把行接起来，直到某行以句末标点结尾；结果只取决于输入，串行与并发的回答一致"""
+    paragraphs, buffer = [], []
+    for line in text.split('\n'):
+        buffer.append(line)
+        if SENTENCE_END.search(line.rstrip()):
+            paragraphs.append(' '.join(buffer))
+            buffer = []
+    if buffer:
+        paragraphs.append(' '.join(buffer))
+    return '\n'.join(paragraphs)
+
+
+class MockChatServer:
+    """
+    模拟的 chat completions 接口，在后台线程的事件循环里运行。
+    回答取最后一条user消息作为输入；fault_rate为注入故障的比例，一半是带Retry-After的429，其余是overloaded和未知错误。
+    """
+
+    def __init__(self, fault_rate: float = 0.2, latency: float = 0.05, retry_after: float = 0.2, seed: int = 0):
+        if web is None:
+            raise ImportError("MockChatServer needs aiohttp, please pip install aiohttp")
+        self.fault_rate = fault_rate
+        self.latency = latency
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.loop = None
+        self.runner = None
+        self.url = None
+        self.reset()
+
+    def reset(self, fault_rate: float = None):
+        if fault_rate is not None:
+            self.fault_rate = fault_rate
+        self.stats = {'requests': 0, 'rate_limited': 0, 'overloaded': 0, 'unknown_errors': 0, 'dropped_braces': 0,
+                      'max_inflight': 0, 'retry_after_violations': 0}
+        self.inflight = 0
+        self.arrivals = []
+        self.not_before = {} # 输入的哈希 -> 429要求的最早重试时间
+
+    async def chat(self, request):
+        body = await request.json()
+        input_text = [message['content'] for message in body['messages'] if message['role'] == 'user'][-1]
+        key = hashlib.md5(input_text.encode('utf-8')).hexdigest()
+        now = time.monotonic()
+        self.stats['requests'] += 1
+        self.arrivals.append(now)
+        if key in self.not_before and now < self.not_before.pop(key):
+            self.stats['retry_after_violations'] += 1
+        self.inflight += 1
+        self.stats['max_inflight'] = max(self.stats['max_inflight'], self.inflight)
+        try:
+            await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+            r = self.rng.random()
+            if r < self.fault_rate / 2:
+                self.stats['rate_limited'] += 1
+                self.not_before[key] = time.monotonic() + self.retry_after
+                return web.Response(status=429, headers={'Retry-After': str(self.retry_after)},
+                    text=json.dumps({'error': {'type': 'requests', 'message': 'Rate limit reached for requests'}}))
+            if r < self.fault_rate * 3 / 4:
+                self.stats['overloaded'] += 1
+                return web.json_response({'error': {'type': 'server_error', 'message': 'That model is currently overloaded with other requests.'}})
+            if r < self.fault_rate:
+                self.stats['unknown_errors'] += 1
+                return web.json_response({'error': {'type': 'server_error', 'message': 'The server had an error while processing your request.'}}, status=500)
+            text = json.dumps({'choices': [{'message': {'role': 'assistant', 'content': mock_join(input_text)}}]})
+            if self.rng.random() < self.fault_rate / 2: # 接口偶尔会漏掉开头的'{'
+                self.stats['dropped_braces'] += 1
+                text = text[1:]
+            return web.Response(text=text, content_type='application/json')
+        finally:
+            self.inflight -= 1
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.chat)
+        return app
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """在后台线程里启动服务器，返回接口地址"""
+        started = threading.Event()
+
+        async def serve():
+            self.runner = web.AppRunner(self.make_app())
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, host, port)
+            await site.start()
+            self.url = f'http://{host}:{self.runner.addresses[0][1]}/v1/chat/completions'
+            started.set()
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(serve(), self.loop).result()
+        started.wait()
+        return self.url
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def max_rate_excess(self, per_minute: float) -> float:
+        """
+        到达的请求数超出容量为per_minute、每秒补充per_minute/60的令牌桶的最大值，<=0说明没有超限。
+        任意一段时间[t_i, t_j]内的请求数 j-i+1 不应超过 per_minute + rate*(t_j-t_i)
+        """
+        rate = per_minute / 60
+        excess = float('-inf')
+        lowest = float('inf') # min(i - rate*t_i)
+        for j, t in enumerate(sorted(self.arrivals)):
+            lowest = min(lowest, j - rate * t)
+            excess = max(excess, (j - rate * t) - lowest + 1 - per_minute)
+        return excess
+
+
+def load_records(paths: list, synthetic_records: int, synthetic_lines: int, seed: int) -> list:
+    """读取.txt（一个文件一条记录）和.jsonl（每行的raw_text一条记录），再用其中的词造synthetic_records条互不相同的合成记录"""
+    records = []
+    for path in map(Path, paths):
+        if not path.exists():
+            print(f'skip missing input {path}')
+            continue
+        if path.suffix == '.jsonl':
+            with path.open('r', encoding='utf-8') as f:
+                for i, line in enumerate(f):
+                    records.append(([x.strip() for x in json.loads(line)['raw_text'].splitlines()], f'{path.stem}_{i}'))
+        else:
+            with path.open('r', encoding='utf-8') as f:
+                records.append(([line.strip() for line in f], path.stem))
+    words = sorted({word for lines, _ in records for line in lines for word in line.split()}) or ['lorem', 'ipsum', 'dolor', 'sit', 'amet']
+    rng = random.Random(seed)
+    for i in range(synthetic_records):
+        lines = []
+        while len(lines) < synthetic_lines:
+            kind = rng.random()
+            if kind < 0.1: # 标题、页码等不成段的行
+                lines.append(' '.join(rng.choice(words) for _ in range(rng.randint(1, 5))))
+            elif kind < 0.15:
+                lines.append(str(rng.randint(1, 300)))
+            else:
+                paragraph = ' '.join(rng.choice(words) for _ in range(rng.randint(10, 120))).rstrip('.?!:;') + rng.choice('..?:;')
+                lines.extend(textwrap.wrap(paragraph, rng.randint(50, 90)))
+        records.append((lines[:synthetic_lines], f'synthetic_{i}'))
+    return records
+
+
+def rule_variants(records: list, synthetic_lines: int, seed: int) -> list:
+    """由已有记录造出更多边界情况：打乱并随机截断行、三行拼成长行、加上各种列表标号和空行"""
+    rng = random.Random(seed)
+    all_lines = [line for lines, _ in records for line in lines if line]
+    if not all_lines:
+        return []
+    shuffled = all_lines[:]
+    rng.shuffle(shuffled)
+    variants = [
+        ([line[:rng.randint(1, 200)] if rng.random() < 0.3 else line for line in shuffled], 'shuffled'),
+        ([' '.join(rng.sample(all_lines, min(3, len(all_lines)))) for _ in range(synthetic_lines)], 'joined'),
+    ]
+    numbered = []
+    prefixes = [lambda i: f'{i}. ', lambda i: '• ', lambda i: f'1.{i} ', lambda i: 'IVX'[i % 3] + '. ', lambda i: f'({chr(97 + i % 26)}) ',
+                lambda i: f'{chr(97 + i % 26)}) ', lambda i: f'{i}) ', lambda i: f'({i}) ', lambda i: f'{chr(65 + i % 26)}. ', lambda i: '一二三'[i % 3] + '、']
+    for i in range(synthetic_lines):
+        kind = rng.random()
+        if kind < 0.05:
+            numbered.append('')
+        elif kind < 0.4:
+            numbered.append(rng.choice(prefixes)(i % 30 + 1) + rng.choice(all_lines))
+        else:
+            numbered.append(rng.choice(all_lines))
+    variants.append((numbered, 'numbered'))
+    return variants
+
+
+def reference_rule_detect(lines: list[str]) -> list[bool]:
+    """按原先的做法逐个行对用score_special、score_simple、score_by_nltk打分，作为RuleBasedDetector.detect的参照"""
+    from rule_based_detector import RuleBasedDetector
+
+    is_hard_breaklines = [True] * (len(lines) - 1)
+    match_infos = []
+    soft_linebreak_indice = []
+    for lineid, line in enumerate(lines):
+        m = RuleBasedDetector.match_lineno_seg(line)
+        if m:
+            match_infos.append((m.rule_id, m.int_index, lineid))
+    for idx, (rule_id, linecounter, lineid) in enumerate(match_infos[1:]):
+        prev_rule_id, prevcounter, prev_lineid = match_infos[idx]
+        if prev_rule_id == rule_id:
+            if linecounter is None or linecounter == prevcounter + 1:
+                soft_linebreak_indice.extend(range(prev_lineid, lineid - 1))
+    for lineid, nextline in enumerate(lines[1:]):
+        prevline = lines[lineid]
+        score = RuleBasedDetector.score_special(prevline, nextline)
+        if score == 0:
+            score += RuleBasedDetector.score_simple(prevline, nextline)
+            score += RuleBasedDetector.score_by_nltk(prevline, nextline)
+        if score > 0:
+            soft_linebreak_indice.append(lineid)
+    for i in soft_linebreak_indice:
+        is_hard_breaklines[i] = False
+    return is_hard_breaklines
+
+
+def bench_rulediff(args):
+    import nltk
+    from rule_based_detector import RuleBasedDetector
+
+    records = load_records(args.input, args.records, args.lines, args.seed)
+    records += rule_variants(records, args.lines, args.seed)
+    if args.hf_validation:
+        import datasets
+        validation_data = datasets.load_dataset("bot-yaya/human_joined_en_paragraph_19", split="train")
+        records += [(record['raw_text'].split('\n'), record['record']) for record in validation_data]
+    detector = RuleBasedDetector('rule')
+    pair_detector = RuleBasedDetector('rule-pairs')
+    window = RuleBasedDetector.NLTK_WINDOW
+    print(f'nltk {nltk.__version__}, cached punkt tokenizer in use: {detector.get_sentence_tokenizer() is not None}')
+    failed = False
+    total_reference, total_detect = 0.0, 0.0
+    for lines, record_id in records:
+        sentence_mismatches, pair_mismatches = 0, 0
+        for prevline, nextline in zip(lines, lines[1:]):
+            if RuleBasedDetector.score_special(prevline, nextline) != 0:
+                continue
+            joined = prevline[-window:] + ' ' + nextline[:window]
+            if pair_detector.sent_tokenize(joined) != nltk.sent_tokenize(joined):
+                sentence_mismatches += 1
+            expected = RuleBasedDetector.score_simple(prevline, nextline) + RuleBasedDetector.score_by_nltk(prevline, nextline) > 0
+            if pair_detector.is_soft_by_simple_and_nltk(prevline, nextline) != expected:
+                pair_mismatches += 1
+        t = time.perf_counter()
+        reference = reference_rule_detect(lines)
+        reference_time = time.perf_counter() - t
+        t = time.perf_counter()
+        detected = detector.detect(lines)
+        detect_time = time.perf_counter() - t
+        detected_again = detector.detect(lines)
+        total_reference += reference_time
+        total_detect += detect_time
+        ok = sentence_mismatches == 0 and pair_mismatches == 0 and detected == reference and detected_again == reference
+        failed |= not ok
+        differing = [i for i, (x, y) in enumerate(zip(reference, detected)) if x != y][:20]
+        print(f'{"ok  " if ok else "FAIL"} {record_id}: {len(lines)} lines, reference {reference_time:.3f}s, detect {detect_time:.3f}s'
+              + ('' if ok else f', sentence mismatches {sentence_mismatches}, pair mismatches {pair_mismatches}, differing breaks {differing}'))
+    print(f'total: reference {total_reference:.3f}s, detect {total_detect:.3f}s')
+    if failed:
+        sys.exit(1)
+
+
+def bench_mockdiff(args):
+    import batch_detector
+    import batch_sequential_detector
+
+    os.environ.setdefault('OPENAI_API_KEY', 'mock')
+    records = load_records(args.input, args.records, args.lines, args.seed)
+    print(f'{len(records)} records, {sum(len(lines) for lines, _ in records)} lines')
+    server = MockChatServer(latency=args.latency, retry_after=args.retry_after, seed=args.seed)
+    url = server.start()
+    workdir = tempfile.mkdtemp(prefix='detector_bench_')
+    os.chdir(workdir) # unexpected_outputs.jsonl之类的副产物留在临时目录
+    detector_classes = {
+        'batch': lambda cache_dir, **kwargs: batch_detector.GPTBatchDetector('mock', cache_dir, **kwargs),
+        'sequential': lambda cache_dir, speculative_depth=0, **kwargs: batch_sequential_detector.GPTBatchSequentialDetector(
+            'mock', cache_dir, speculative_depth=speculative_depth, **kwargs),
+    }
+    failed = False
+    try:
+        for name in args.detectors:
+            make_detector = detector_classes[name]
+            common = dict(token_limit=args.token_limit, api_url=url, response_cache_path=None)
+            server.reset(fault_rate=0)
+            t = time.perf_counter()
+            serial_detector = make_detector(os.path.join(workdir, f'{name}_serial'), concurrency=1, rpm=None, tpm=None, **common)
+            serial = [serial_detector.detect(lines, record_id) for lines, record_id in records]
+            serial_time = time.perf_counter() - t
+
+            server.reset(fault_rate=args.fault_rate)
+            extra = {'speculative_depth': args.speculative_depth} if name == 'sequential' else {}
+            t = time.perf_counter()
+            concurrent_detector = make_detector(os.path.join(workdir, f'{name}_concurrent'), concurrency=args.concurrency,
+                rpm=args.rpm, tpm=args.tpm, **common, **extra)
+            concurrent = concurrent_detector.detect_records(records)
+            concurrent_time = time.perf_counter() - t
+
+            stats = server.stats
+            rate_excess = server.max_rate_excess(args.rpm) if args.rpm else float('-inf')
+            checks = {
+                'same detections as serial run': concurrent == serial,
+                f'max in-flight {stats["max_inflight"]} <= concurrency {args.concurrency}': stats['max_inflight'] <= args.concurrency,
+                'no retry before Retry-After': stats['retry_after_violations'] == 0,
+                f'request rate within rpm {args.rpm}': rate_excess <= RATE_SLACK,
+            }
+            if args.fault_rate > 0:
+                checks['faults were injected'] = stats['rate_limited'] + stats['overloaded'] + stats['unknown_errors'] > 0
+            print(f'[{name}] serial {serial_time:.2f}s, concurrent {concurrent_time:.2f}s, server stats {json.dumps(stats)}')
+            for check, ok in checks.items():
+                print(f'[{name}]   {"ok  " if ok else "FAIL"} {check}')
+                failed |= not ok
+            if concurrent != serial:
+                for (lines, record_id), a, b in zip(records, serial, concurrent):
+                    if a != b:
+                        print(f'[{name}]   record {record_id} differs at lines {[i for i, (x, y) in enumerate(zip(a, b)) if x != y][:20]}')
+    finally:
+        server.stop()
+        os.chdir(SCRIPT_DIR)
+    if failed:
+        print(f'cache dirs and unexpected outputs kept in {workdir}')
+        sys.exit(1)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_mockserver(args):
+    server = MockChatServer(fault_rate=args.fault_rate, latency=args.latency, retry_after=args.retry_after, seed=args.seed)
+    web.run_app(server.make_app(), host=args.host, port=args.port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reproducible checks of the hard line break detectors')
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+    mockdiff_parser = subparsers.add_parser('mockdiff', help='Check that the concurrent GPT detectors match a serial run against a faulty local mock server')
+    mockdiff_parser.add_argument('--input', type=str, nargs='*', default=[str(path) for path in DEFAULT_INPUTS], help='.txt files (one record each) or .jsonl files with a raw_text field')
+    mockdiff_parser.add_argument('--records', type=int, default=6, help='Number of synthetic records generated from the words of the inputs')
+    mockdiff_parser.add_argument('--lines', type=int, default=150, help='Lines of each synthetic record')
+    mockdiff_parser.add_argument('--detectors', type=str, nargs='+', default=['batch', 'sequential'], choices=['batch', 'sequential'], help='Detectors to check')
+    mockdiff_parser.add_argument('--token_limit', type=int, default=400, help='token_limit of both detectors')
+    mockdiff_parser.add_argument('--concurrency', type=int, default=8, help='Concurrency of the concurrent run')
+    mockdiff_parser.add_argument('--rpm', type=float, default=300, help='Requests per minute of the concurrent run, checked at the server')
+    mockdiff_parser.add_argument('--tpm', type=float, default=None, help='Tokens per minute of the concurrent run')
+    mockdiff_parser.add_argument('--speculative_depth', type=int, default=2, help='speculative_depth of GPTBatchSequentialDetector in the concurrent run')
+    mockdiff_parser.add_argument('--fault_rate', type=float, default=0.2, help='Share of mock responses that are 429/overloaded/unknown errors')
+    mockdiff_parser.add_argument('--latency', type=float, default=0.05, help='Mean latency of the mock server in seconds')
+    mockdiff_parser.add_argument('--retry_after', type=float, default=0.2, help='Retry-After seconds sent with 429 responses')
+    mockdiff_parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic records and the injected faults')
+    mockserver_parser = subparsers.add_parser('mockserver', help='Run the mock chat completions server alone')
+    mockserver_parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to listen on')
+    mockserver_parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    mockserver_parser.add_argument('--fault_rate', type=float, default=0.2, help='Share of responses that are 429/overloaded/unknown errors')
+    mockserver_parser.add_argument('--latency', type=float, default=0.05, help='Mean latency in seconds')
+    mockserver_parser.add_argument('--retry_after', type=float, default=0.2, help='Retry-After seconds sent with 429 responses')
+    mockserver_parser.add_argument('--seed', type=int, default=0, help='Seed of the injected faults')
+    rulediff_parser = subparsers.add_parser('rulediff', help='Check that RuleBasedDetector matches the original per-pair scoring and nltk.sent_tokenize')
+    rulediff_parser.add_argument('--input', type=str, nargs='*', default=[str(path) for path in DEFAULT_INPUTS], help='.txt files (one record each) or .jsonl files with a raw_text field')
+    rulediff_parser.add_argument('--records', type=int, default=6, help='Number of synthetic records generated from the words of the inputs')
+    rulediff_parser.add_argument('--lines', type=int, default=1000, help='Lines of each synthetic record and variant')
+    rulediff_parser.add_argument('--hf_validation', action='store_true', help='Also check the bot-yaya/human_joined_en_paragraph_19 validation set (needs datasets and network)')
+    rulediff_parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic records and variants')
+    args = parser.parse_args()
+    if args.bench == 'mockdiff':
+        bench_mockdiff(args)
+    elif args.bench == 'mockserver':
+        bench_mockserver(args)
+    elif args.bench == 'rulediff':
+        bench_rulediff(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,10 +15,15 @@ from rule_based_detector import RuleBasedDetector
 import utils
 
 
+CLIENT_CONFIG_KEYS = ('concurrency', 'rpm', 'tpm', 'api_url')
+RUNTIME_CONFIG_KEYS = CLIENT_CONFIG_KEYS + ('speculative_depth',)
+
+
 def _get_folder_from_config(config):
     if 'cache_dir' in config:
         cache_dir = config['cache_dir']
     else:
+        config = {k: v for k, v in config.items() if k not in RUNTIME_CONFIG_KEYS} # 并发、限速与推测执行的配置不影响结果，不参与cache目录的命名
         if config:
             # join all params in config to create the cache dir
             # sort the key to make sure the cache dir is the same
@@ -28,6 +33,10 @@ def _get_folder_from_config(config):
     return cache_dir
 
 
+def _get_client_config(config):
+    return {k: config[k] for k in CLIENT_CONFIG_KEYS if k in config}
+
+
 def main(detector_name, remove_long_file, detector_config):
     # Instantiate the chosen detector
     if detector_name == 'DetectorA':
@@ -42,12 +51,13 @@ def main(detector_name, remove_long_file, detector_config):
         print("using confing", detector_config)
         token_limit = detector_config.get('token_limit', 1400)
         cache_dir = _get_folder_from_config(detector_config)
-        detector = GPTBatchDetector('gpt-remote', cache_dir, token_limit=token_limit)
+        detector = GPTBatchDetector('gpt-remote', cache_dir, token_limit=token_limit, **_get_client_config(detector_config))
     elif detector_name == "GptBatchSequentialDetector":
         print("using confing", detector_config)
         token_limit = detector_config.get('token_limit', 1400)
         cache_dir = 'batch_sequential_' + _get_folder_from_config(detector_config)
-        detector = GPTBatchSequentialDetector('gpt-remote', cache_dir, token_limit=token_limit, use_proxy=True)
+        detector = GPTBatchSequentialDetector('gpt-remote', cache_dir, token_limit=token_limit, use_proxy=True,
+            speculative_depth=detector_config.get('speculative_depth', 0), **_get_client_config(detector_config))
     else:
         raise ValueError(f"Unknown detector name: {detector_name}")
 
@@ -80,18 +90,22 @@ def main(detector_name, remove_long_file, detector_config):
     # Initialize the lists to collect all predictions and ground truth labels
     all_predictions, all_ground_truth = [], []
 
+    # Initialize and process the text with a TextSegmenter
+    segmenters = []
+    for record in validation_data:
+        segmenter = TextSegmenter(record['raw_text'])
+        segmenter.split_by_linebreak()
+        segmenters.append(segmenter)
+
+    # Get predictions for all records at once, so that gpt detectors can send requests concurrently
+    all_records_predicted = detector.detect_records([(segmenter.lines, record['record']) for segmenter, record in zip(segmenters, validation_data)]) # record_id for gpt cache 
+
     # Iterate over the validation data
-    for record in tqdm(validation_data):
+    for record, segmenter, predicted in tqdm(zip(validation_data, segmenters, all_records_predicted), total=len(segmenters)):
 
         raw_text = record['raw_text']
         ground_truth = record['is_hard_linebreak']
         record_id = record['record']
-        # Initialize and process the text with a TextSegmenter
-        segmenter = TextSegmenter(raw_text)
-        segmenter.split_by_linebreak()
-
-        # Get predictions for current record
-        predicted = detector.detect(segmenter.lines, record_id=record_id) # record_id for gpt cache 
 
         while len(ground_truth) >= len(segmenter.lines): # temporary fix for the bug in the validation dataset
             ground_truth.pop()
@@ -11,6 +11,8 @@ import pylcs
 from pathlib import Path
 from datasets.dataset_dict import DatasetDict
 
+from response_cache import ResponseCache, DEFAULT_CACHE_FILE
+
 
 MAX_TOKEN_COUNT = 1400
 WORKDIR_ABSOLUTE = r'C:\Users\Administrator\Documents\parallel_corpus_mnbvc\alignment\bertalign' # 工作区绝对路径，实际使用换成.即可
@@ -110,8 +112,16 @@ Additionally, please ensure that pagination and indexing information remains on
 # Here is the input text:
 # '''
 
-def chat(prompt: str):
-    """主体，入参prompt是向chatgpt问的内容，debug_prompt是让它打印内容，production只打下标"""
+GPT_MODEL = "gpt-3.5-turbo"
+PROMPT_TEMPLATE = json.dumps(echo_prompt2('{input_text}'), ensure_ascii=False) # 回答按(模型, 提示词模板, 输入)缓存
+response_cache = ResponseCache(my_path(DEFAULT_CACHE_FILE))
+
+def chat(prompt: str, use_cache=True):
+    """主体，入参prompt是向chatgpt问的内容，debug_prompt是让它打印内容，production只打下标。use_cache为False时不读缓存，重新问一遍"""
+    if use_cache:
+        cached_output = response_cache.get(GPT_MODEL, PROMPT_TEMPLATE, prompt)
+        if cached_output is not None:
+            return cached_output
 
     import requests
     k = read_secret('openai_token')
@@ -127,7 +137,7 @@ def chat(prompt: str):
             },
             json={
                 # "model": "text-davinci-003",
-                "model": "gpt-3.5-turbo",
+                "model": GPT_MODEL,
                 # "model": "gpt-4",
                 "messages": echo_prompt2(prompt),
                 # "temperature": 0, 
@@ -152,7 +162,9 @@ def chat(prompt: str):
             raise UnknownException(err['message'])
             # with open(my_path('chatgptexception.jsonl'), 'a', encoding='utf-8') as f: # 日志
             #     f.write(r.text)
-    return j['choices'][0]['message']['content']
+    output = j['choices'][0]['message']['content']
+    response_cache.put(GPT_MODEL, PROMPT_TEMPLATE, prompt, output)
+    return output
 
 async def aiochat(prompt: str):
     """异步版本的chat，还没开始写，但是对于这个任务来说并发请求很容易server error，我建议还是挂着串行搞"""
@@ -237,7 +249,7 @@ def process_one_file_use_chatgpt2(row: DatasetDict):
         else:
             for retrytime in range(RETRY_TIME):
                 try:
-                    outputs = chat(batch)
+                    outputs = chat(batch, use_cache=retrytime == 0) # 缓存的回答处理出错时重新问
                     outputlines = clearup_output(outputs)
 
                     align_map, irate, orate = lcs_sequence_alignment(batch, outputlines)
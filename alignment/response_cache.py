@@ -0,0 +1,164 @@
+"""
+LLM/机翻调用结果的统一缓存，所有条目存在同一个sqlite文件里。
+
+键是 (模型, 提示词模板, 输入文本) 的sha256：同一段输入无论来自哪个文件、哪个detector、哪种token_limit配置，
+只要模型和提示词相同就只请求一次。提示词模板里的输入用 INPUT_PLACEHOLDER 占位，模板变了键自然也变。
+文件超过max_size_bytes时，按最近一次使用的时间淘汰最旧的条目；命中/未命中次数累计在文件里，stats()可以查看。
+get只读不写：命中/未命中次数和使用时间先记在内存里，每FLUSH_EVERY次查询、put、stats或close时才一起写入，
+所以只查询的多个进程不会排队等sqlite的写锁；没有close就退出的进程会少记最后不到FLUSH_EVERY次查询。
+
+    cache = ResponseCache(cache_path_beside('cache_dir'))
+    output = cache.get(model, prompt_template, input_text)
+    if output is None:
+        output = request(input_text)
+        cache.put(model, prompt_template, input_text, output)
+
+只依赖标准库；可以在多进程（如datasets.map(num_proc=...)）中使用，每个进程在第一次用到时才打开连接。
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_FILE = 'llm_response_cache.sqlite'
+DEFAULT_MAX_SIZE_BYTES = 1 << 30
+INPUT_PLACEHOLDER = '{input_text}'
+EVICT_TO_RATIO = 0.9 # 淘汰时一次清到上限的九成，避免每次写入都触发淘汰
+FLUSH_EVERY = 256 # 累计这么多次查询后把统计和使用时间写入文件
+
+
+def cache_path_beside(cache_dir, path=DEFAULT_CACHE_FILE) -> str:
+    """
+    detector的response_cache_path为相对路径时，按cache_dir所在的目录解析，而不是按当前工作目录。
+    同一目录下不同detector、不同token_limit的cache_dir因此共用一个缓存文件，也不会因为换了启动目录而各存一份
+    """
+    return str(Path(cache_dir).resolve().parent / path)
+
+
+def response_key(model: str, prompt_template: str, input_text: str) -> str:
+    return hashlib.sha256(json.dumps([model, prompt_template, input_text], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=DEFAULT_CACHE_FILE, max_size_bytes: int = DEFAULT_MAX_SIZE_BYTES):
+        self.path = str(path)
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0 # 本进程内的统计，累计值见stats()
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+        self.size_bytes = 0
+        # 还没写入文件的查询统计和使用时间
+        self.pending_hits = 0
+        self.pending_misses = 0
+        self.pending_last_used = {}
+
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is None or self.pid != os.getpid(): # fork出的子进程不能沿用父进程的连接
+            self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, created REAL, last_used REAL)''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+            self.conn.executemany('INSERT OR IGNORE INTO stats VALUES (?, 0)', [('hits',), ('misses',), ('evictions',)])
+            self.conn.commit()
+            self.pid = os.getpid()
+            self.pending_hits, self.pending_misses, self.pending_last_used = 0, 0, {} # 从父进程继承来的由父进程写入
+            self.size_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        return self.conn
+
+    def get(self, model: str, prompt_template: str, input_text: str) -> str | None:
+        """命中时返回缓存的结果，否则返回None。只读，统计和使用时间攒够FLUSH_EVERY次再写入"""
+        key = response_key(model, prompt_template, input_text)
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                self.pending_misses += 1
+            else:
+                self.hits += 1
+                self.pending_hits += 1
+                self.pending_last_used[key] = time.time()
+            if self.pending_hits + self.pending_misses >= FLUSH_EVERY:
+                self.flush(conn)
+                conn.commit()
+        return None if row is None else row[0]
+
+    def contains(self, model: str, prompt_template: str, input_text: str) -> bool:
+        """只判断有没有缓存，不计入统计，也不更新使用时间"""
+        key = response_key(model, prompt_template, input_text)
+        with self.lock:
+            return self.connect().execute('SELECT 1 FROM responses WHERE key = ?', (key,)).fetchone() is not None
+
+    def put(self, model: str, prompt_template: str, input_text: str, response: str):
+        """写入（或覆盖）一条结果，文件超过上限时淘汰最久没用过的条目"""
+        key = response_key(model, prompt_template, input_text)
+        size = len(input_text.encode('utf-8')) + len(response.encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            conn = self.connect()
+            old = conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)', (key, model, response, size, now, now))
+            self.size_bytes += size - (old[0] if old else 0)
+            self.pending_last_used.pop(key, None) # 刚写入的使用时间最新
+            self.flush(conn) # 淘汰前先写入使用时间
+            if self.size_bytes > self.max_size_bytes:
+                self.evict(conn)
+            conn.commit()
+
+    def flush(self, conn: sqlite3.Connection):
+        """把内存里攒下的命中/未命中次数和使用时间写入文件，由调用者commit"""
+        if self.pending_last_used:
+            conn.executemany('UPDATE responses SET last_used = ? WHERE key = ?',
+                [(last_used, key) for key, last_used in self.pending_last_used.items()])
+        if self.pending_hits:
+            conn.execute("UPDATE stats SET value = value + ? WHERE name = 'hits'", (self.pending_hits,))
+        if self.pending_misses:
+            conn.execute("UPDATE stats SET value = value + ? WHERE name = 'misses'", (self.pending_misses,))
+        self.pending_hits, self.pending_misses, self.pending_last_used = 0, 0, {}
+
+    def evict(self, conn: sqlite3.Connection):
+        self.size_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0] # 其它进程也可能写入过，重新统计
+        target = self.max_size_bytes * EVICT_TO_RATIO
+        evicted = 0
+        for key, size in conn.execute('SELECT key, size FROM responses ORDER BY last_used').fetchall():
+            if self.size_bytes <= target:
+                break
+            conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.size_bytes -= size
+            evicted += 1
+        conn.execute("UPDATE stats SET value = value + ? WHERE name = 'evictions'", (evicted,))
+
+    def stats(self) -> dict:
+        """累计的命中、未命中、淘汰次数，当前条目数与大小，以及本进程内的命中、未命中次数"""
+        with self.lock:
+            conn = self.connect()
+            self.flush(conn)
+            conn.commit()
+            result = dict(conn.execute('SELECT name, value FROM stats').fetchall())
+            result['entries'], result['size_bytes'] = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        result['session_hits'] = self.hits
+        result['session_misses'] = self.misses
+        return result
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None and self.pid == os.getpid():
+                self.flush(self.conn)
+                self.conn.commit()
+                self.conn.close()
+            self.conn = None
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Show the statistics of an LLM/MT response cache')
+    parser.add_argument('path', type=str, nargs='?', default=DEFAULT_CACHE_FILE, help='Path of the sqlite cache file')
+    args = parser.parse_args()
+    print(json.dumps(ResponseCache(args.path).stats(), indent=2))
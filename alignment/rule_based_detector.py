@@ -1,3 +1,4 @@
+import copy
 import re
 from difflib import SequenceMatcher
 from collections import namedtuple
@@ -90,6 +91,14 @@ class RuleBasedDetector(HardLineBreakDetector):
         (re.compile(r'^\([一二三四五六七八九十]{1,3}\) '), read_chinese), # 第二类汉字有序列表 (一)
     ]
     MatchedLinenoInfo = namedtuple('MatchedLinenoInfo', ['rule_id', 'int_index'])
+    NLTK_WINDOW = 100 # score_by_nltk只看前一行末尾、后一行开头这么多字符
+    CACHE_SIZE = 1 << 16 # 以下各个缓存的条目上限，超过就清空
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.sentence_tokenizer = None
+        self.sentbreak_cache = {} # 句末标点的上下文 -> 是否为句子边界
+        self.nltk_decision_cache = {} # (前一行末尾, 后一行开头) -> 非特判的行对是否去掉换行
 
     @staticmethod
     def match_lineno_seg(line: str):
@@ -98,7 +107,7 @@ class RuleBasedDetector(HardLineBreakDetector):
         int_index为None时，表示无序列表
         """
         for rule_id, (rule_pattern, process_func) in enumerate(RuleBasedDetector.LINE_NUMBERING_PATTERNS):
-            m = re.match(rule_pattern, line)
+            m = rule_pattern.match(line)
             if m:
                 return RuleBasedDetector.MatchedLinenoInfo(rule_id, process_func(m.group(0)))
         return None
@@ -124,6 +133,87 @@ class RuleBasedDetector(HardLineBreakDetector):
             score -= (maxratio - 0.6) * 666.7 # * 200 / 0.3
         return score
 
+    def get_sentence_tokenizer(self):
+        """
+        取nltk的punkt分句器的副本，把其中判断一段上下文是否包含句子边界的text_contains_sentbreak换成带缓存的版本。
+        punkt对每个句末标点是否断句，只取决于标点前的一个词和后面的一个词组成的上下文。相邻行对的拼接窗口互相重叠，
+        同一处标点会在两个窗口里各判断一次，缓存后整篇文档（以及之后的文档）里同样的上下文只判断一次，分句结果与nltk.sent_tokenize完全相同。
+        当前nltk版本拿不到分句器时返回None，退回逐次调用nltk.sent_tokenize。
+        """
+        if self.sentence_tokenizer is None:
+            try:
+                if hasattr(nltk.tokenize, '_get_punkt_tokenizer'):
+                    base_tokenizer = nltk.tokenize._get_punkt_tokenizer('english')
+                else:
+                    base_tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
+                text_contains_sentbreak = base_tokenizer.text_contains_sentbreak
+            except (AttributeError, LookupError):
+                self.sentence_tokenizer = False
+                return None
+
+            def cached_text_contains_sentbreak(text: str) -> bool:
+                is_sentbreak = self.sentbreak_cache.get(text)
+                if is_sentbreak is None:
+                    if len(self.sentbreak_cache) >= self.CACHE_SIZE:
+                        self.sentbreak_cache.clear()
+                    is_sentbreak = self.sentbreak_cache[text] = text_contains_sentbreak(text)
+                return is_sentbreak
+
+            self.sentence_tokenizer = copy.copy(base_tokenizer) # 不改动nltk全局共用的分句器
+            self.sentence_tokenizer.text_contains_sentbreak = cached_text_contains_sentbreak
+        return self.sentence_tokenizer or None
+
+    def sent_tokenize(self, text: str) -> list[str]:
+        sentence_tokenizer = self.get_sentence_tokenizer()
+        if sentence_tokenizer is None:
+            return nltk.sent_tokenize(text)
+        return sentence_tokenizer.tokenize(text)
+
+    def is_soft_by_simple_and_nltk(self, prevline: str, nextline: str) -> bool:
+        """
+        等价于 score_simple(prevline, nextline) + score_by_nltk(prevline, nextline) > 0，结果完全一致，但更快：
+            1. 分句用带缓存的sent_tokenize；
+            2. 只需要知道总分的正负：score_by_nltk的结果 -(maxratio - 0.6) * 666.7 随maxratio单调不增，
+               所以逐句看下来只要有一句让总分不为正，结果就不为正；ratio的上界real_quick_ratio、quick_ratio已经能保证总分为正的句子，不必算ratio；
+            3. 与后一行开头完全相同的句子ratio就是1，不必匹配；SequenceMatcher对后一行开头的预处理每个行对只做一次，且用到时才做；
+            4. 两个函数都只看前一行末尾、后一行开头各NLTK_WINDOW个字符，结果按这两段缓存，重复出现的页眉页脚等行对不必重算。
+        """
+        nextline2Bjoined = nextline[:self.NLTK_WINDOW]
+        prevline_tail = prevline[-self.NLTK_WINDOW:]
+        cache_key = (prevline_tail, nextline2Bjoined)
+        is_soft = self.nltk_decision_cache.get(cache_key)
+        if is_soft is not None:
+            return is_soft
+
+        score = self.score_simple(prevline, nextline)
+        tokenized_by_nltk = self.sent_tokenize(prevline_tail + ' ' + nextline2Bjoined)
+        if len(tokenized_by_nltk) == 1:
+            is_soft = score + 200 > 0
+        elif len(tokenized_by_nltk) >= 2:
+            is_soft = True
+            sm = None
+            for token in reversed(tokenized_by_nltk):
+                if token == nextline2Bjoined: # 最常见的情况：窗口恰好在换行处断句，两个完全相同的串ratio为1
+                    ratio = 1.0
+                else:
+                    if sm is None:
+                        sm = SequenceMatcher(lambda x: x==' ', token, nextline2Bjoined, autojunk=True)
+                    else:
+                        sm.set_seq1(token)
+                    if score - (sm.real_quick_ratio() - 0.6) * 666.7 > 0 or score - (sm.quick_ratio() - 0.6) * 666.7 > 0:
+                        continue
+                    ratio = sm.ratio()
+                if score - (ratio - 0.6) * 666.7 <= 0:
+                    is_soft = False
+                    break
+        else:
+            is_soft = score > 0
+
+        if len(self.nltk_decision_cache) >= self.CACHE_SIZE:
+            self.nltk_decision_cache.clear()
+        self.nltk_decision_cache[cache_key] = is_soft
+        return is_soft
+
     @staticmethod
     def score_simple(prevline: str, nextline: str) -> int:
         score = 0 # 正表示删换行，负表示保留换行
@@ -177,8 +267,10 @@ class RuleBasedDetector(HardLineBreakDetector):
         match_infos = [] # 存(int数字列表号, int文件行号) 这样的二元组
         soft_linebreak_indice = [] # 可以去掉换行的行下标
         ## 行标号规则
+        is_lineno_matched = [] # 每行是否匹配行标号规则，score_special要用，不必再匹配一遍
         for lineid, line in enumerate(lines):
             m = self.match_lineno_seg(line)
+            is_lineno_matched.append(m is not None)
             if m:
                 match_infos.append((m.rule_id, m.int_index, lineid))
 
@@ -193,12 +285,15 @@ class RuleBasedDetector(HardLineBreakDetector):
             # prevline = outputs[-1]
             prevline = lines[lineid]
 
-            score = self.score_special(prevline, nextline) # 特判的运行优先级要高于一般规则（否则会Runtime Error）
-            if score == 0:
-                score += self.score_simple(prevline, nextline) # TODO: 单元测试
-                score += self.score_by_nltk(prevline, nextline)
+            # 特判的运行优先级要高于一般规则（否则会Runtime Error），即score_special，这里用已有的行标号匹配结果
+            if (not nextline) or (not prevline): # 当两行中一行是空行，则拼接
+                is_soft = True
+            elif is_lineno_matched[lineid + 1]: # 避免和lineno规则冲突
+                is_soft = False
+            else:
+                is_soft = self.is_soft_by_simple_and_nltk(prevline, nextline) # TODO: 单元测试
 
-            if score > 0:
+            if is_soft:
                 soft_linebreak_indice.append(lineid)
 
         for i in soft_linebreak_indice:
@@ -1,5 +1,6 @@
 import datetime
 import os
+import sys
 import time
 import json
 import traceback
@@ -16,6 +17,9 @@ import datasets
 
 from datasets.dataset_dict import DatasetDict
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from response_cache import ResponseCache, DEFAULT_CACHE_FILE
+
 MAX_TOKEN_COUNT = 1400
 WORKDIR_ABSOLUTE = r'.' # 工作区绝对路径，为方便调试使用，实际使用换成.即可
 RETRY_TIME = 5
@@ -23,6 +27,7 @@ SLEEP_TIME = 0
 
 encoder_gpt35 = tiktoken.encoding_for_model("gpt-3.5-turbo")
 exception_files = set()
+GPT_MODEL = "gpt-3.5-turbo"
 
 ## path
 def cat(*args): 
@@ -69,11 +74,18 @@ Additionally, please ensure that pagination and indexing information remains on
         {"role": "assistant", "content": 'Output:\n'}
     ]
 
+PROMPT_TEMPLATE = json.dumps(generate_prompt('{input_text}'), ensure_ascii=False) # 回答按(模型, 提示词模板, 输入)缓存
+response_cache = ResponseCache(my_path(DEFAULT_CACHE_FILE))
+
 class ContextLengthExceeded(Exception): pass
 class UnknownException(Exception): pass
 
-def request_gpt_segment(prompt: str):
-    """主体，入参prompt是向chatgpt问的内容，debug_prompt是让它打印内容，production只打下标"""
+def request_gpt_segment(prompt: str, use_cache=True):
+    """主体，入参prompt是向chatgpt问的内容，debug_prompt是让它打印内容，production只打下标。use_cache为False时不读缓存，重新问一遍"""
+    if use_cache:
+        cached_output = response_cache.get(GPT_MODEL, PROMPT_TEMPLATE, prompt)
+        if cached_output is not None:
+            return cached_output
 
     k = read_secret('OPENAI_TOKEN')
     r = requests.post(
@@ -85,7 +97,7 @@ def request_gpt_segment(prompt: str):
             },
             json={
                 # "model": "text-davinci-003",
-                "model": "gpt-3.5-turbo",
+                "model": GPT_MODEL,
                 # "model": "gpt-4",
                 "messages": generate_prompt(prompt),
                 # "temperature": 0, 
@@ -110,7 +122,9 @@ def request_gpt_segment(prompt: str):
             raise UnknownException(err['message'])
             # with open(my_path('chatgptexception.jsonl'), 'a', encoding='utf-8') as f: # 日志
             #     f.write(r.text)
-    return j['choices'][0]['message']['content']
+    output = j['choices'][0]['message']['content']
+    response_cache.put(GPT_MODEL, PROMPT_TEMPLATE, prompt, output)
+    return output
 
 ## algorithm
 def clearup_output(raw_output_from_chatgpt: str) -> list[str]:
@@ -263,7 +277,7 @@ def ask_gpt_for_one_file(row: DatasetDict):
                             todo_lineid = len(input_lines)
                             break
 
-                        outputs = request_gpt_segment(batch)
+                        outputs = request_gpt_segment(batch, use_cache=retrytime == 0) # 缓存的回答处理出错时重新问
                         outputlines = clearup_output(outputs)
 
                         align_map, irate, orate = lcs_sequence_alignment(batch, outputlines)
@@ -85,6 +85,13 @@ class HardLineBreakDetector:
         """
         pass
 
+    def detect_records(self, records: list[tuple[list[str], str]]) -> list[list[bool]]:
+        """
+        Apply detect to many records, given as (lines, record_id) pairs.
+        Detectors that send network requests override this to process records concurrently.
+        """
+        return [self.detect(lines, record_id=record_id) for lines, record_id in records]
+
 
 class DetectorA(HardLineBreakDetector):
     def detect(self, lines: list[str], **kwargs) -> list[bool]:
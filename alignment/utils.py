@@ -1,4 +1,7 @@
+import asyncio
+import concurrent.futures
 import os
+import random
 import time
 import requests
 import logging
@@ -8,6 +11,11 @@ from pathlib import Path
 
 import numpy as np
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 logging.basicConfig(filename='chatgptoutputs.log', level=logging.INFO, format='%(asctime)s %(message)s')
 
 
@@ -20,6 +28,9 @@ class UnknownError(Exception):
 class ServerOverloadedError(Exception):
     pass
 
+class InvalidAPIKeyError(Exception):
+    pass
+
 def create_chat_prompt(input_text: str): 
     """
     Creates a prompt for the AI model based on the provided input text.
@@ -48,13 +59,80 @@ Additionally, please ensure that pagination and indexing information remains on
     ]
 
 
-def gpt_detect_hard_line_breaks(line_break_text: str, use_proxy: bool = False, retries: int = 1000):
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+PROXY_CHAT_URL = "https://openai-proxy-syhien.pages.dev/v1/chat/completions"
+CHAT_MODEL = "gpt-3.5-turbo"
+PROMPT_TOKEN_OVERHEAD = 250 # create_chat_prompt里固定部分的token数（取整估计）
+
+
+def chat_completions_url(use_proxy: bool = False, api_url: str = None) -> str:
+    """
+    Returns the chat completions endpoint. `api_url` (or the OPENAI_CHAT_URL environment variable)
+    overrides the default, e.g. to point at a local mock server.
+    """
+    if api_url:
+        return api_url
+    return os.environ.get('OPENAI_CHAT_URL') or (PROXY_CHAT_URL if use_proxy else OPENAI_CHAT_URL)
+
+
+def create_chat_request(line_break_text: str) -> dict:
+    return {
+        "model": CHAT_MODEL,
+        "messages": create_chat_prompt(line_break_text),
+        "temperature": 0,
+    }
+
+
+# 请求中除模型和输入外的全部内容，作为response_cache.ResponseCache的提示词模板，改了提示词或参数，缓存的键也随之改变
+CHAT_PROMPT_TEMPLATE = json.dumps({k: v for k, v in create_chat_request('{input_text}').items() if k != 'model'}, ensure_ascii=False, sort_keys=True)
+
+
+def parse_chat_response(response_text: str) -> str:
+    """
+    Parses the body of a chat completions response and returns the AI model's response.
+
+    Raises:
+        ExceededContextLength: If the context length is exceeded.
+        ServerOverloadedError: If the server is overloaded, can be solved by retrying later.
+        InvalidAPIKeyError: If the API key is invalid, not active or out of quota. Retrying is useless.
+        UnknownError: If an OpenAI side unknown error occurs.
+    """
+    try:
+        response_json = json.loads(response_text)
+    except json.JSONDecodeError:
+        response_json = json.loads('{' + response_text) # 有时候会漏前导'{'，尝试救回来
+    if 'error' in response_json:
+        error = response_json['error']
+        if 'code' in error and error['code'] == 'invalid_request_error':
+            raise ExceededContextLength(error['message'])
+        elif error.get('type') == 'server_error' and 'overloaded' in error.get('message', ''):
+            raise ServerOverloadedError(error['message']) # 这个错误是可以接住并且通过sleep and retry来解决的
+        elif error.get('type') == 'billing_not_active': # Token过期 直接挂掉
+            raise InvalidAPIKeyError(f"OpenAI API Key not active: {error}")
+        elif error.get('type') == 'invalid_request_error': # API Key无效或者已撤回可能引起这个错误
+            raise InvalidAPIKeyError(f"Invalid request (API Key maybe Invalid): {error}")
+        elif error.get('type') == 'insufficient_quota': # API Key配额用完
+            raise InvalidAPIKeyError(f"OpenAI API Key quota exceeded: {error}")
+        else:
+            raise UnknownError(error['message'])
+    return response_json['choices'][0]['message']['content']
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """带抖动的指数退避：第attempt次（从0开始）重试前等待[0, min(cap, base * 2^attempt))内的随机秒数，避免大量请求同时重试"""
+    return random.uniform(0, min(cap, base * (2 ** min(attempt, 32))))
+
+
+def gpt_detect_hard_line_breaks(line_break_text: str, use_proxy: bool = False, retries: int = 1000, api_url: str = None, response_cache=None):
     """
     Sends the provided text to the AI model and returns its response.
+    For many texts use AsyncGPTClient instead, which sends requests concurrently under rate limits.
 
     Args:
         line_break_text (str): The text with line breaks which needs to be processed by the AI model.
         The token number of line_break_text should be < 1400
+        api_url (str): Overrides the chat completions endpoint, see chat_completions_url.
+        response_cache (response_cache.ResponseCache): Reuses and stores the response if given.
 
     Raises:
         ExceededContextLength: If the context length is exceeded.
@@ -64,59 +142,38 @@ def gpt_detect_hard_line_breaks(line_break_text: str, use_proxy: bool = False, r
     Returns:
         str: The AI model's response.
     """
+    if response_cache is not None:
+        output_text = response_cache.get(CHAT_MODEL, CHAT_PROMPT_TEMPLATE, line_break_text)
+        if output_text is not None:
+            return output_text
     api_key = os.environ.get('OPENAI_API_KEY')
-    if not use_proxy:
-        url = "https://api.openai.com/v1/chat/completions"
-    else:
-        url = "https://openai-proxy-syhien.pages.dev/v1/chat/completions"
+    url = chat_completions_url(use_proxy, api_url)
 
     for i in range(retries):
         try:
             response = requests.post(
-                url, 
+                url,
                 headers={
                     "Content-Type": "application/json",
                     "Authorization": "Bearer " + api_key
                 },
-                json={
-                    "model": "gpt-3.5-turbo",
-                    "messages": create_chat_prompt(line_break_text),
-                    "temperature": 0,
-                },
+                json=create_chat_request(line_break_text),
                 timeout = 60 * 5, verify=False
             )
             logging.debug(response.text)
-            try:
-                response_json = response.json()
-            except json.JSONDecodeError:
-                response_json = json.loads('{' + response.text) 
-            if 'error' in response_json:
-                error = response_json['error']
-                if 'code' in error and error['code'] == 'invalid_request_error':
-                    raise ExceededContextLength(error['message'])
-                elif error.get('type') == 'server_error' and 'overloaded' in error.get('message', ''):
-                    raise ServerOverloadedError(error['message']) # 这个错误是可以接住并且通过sleep and retry来解决的
-                elif error.get('type') == 'billing_not_active': # Token过期 直接挂掉
-                    logging.fatal(f"OpenAI API Key not active: {error}")
-                    print(f"OpenAI API Key not active: {error}")
-                    exit(1)
-                elif error.get('type') == 'invalid_request_error': # API Key无效或者已撤回可能引起这个错误
-                    logging.fatal(f"Invalid request (API Key maybe Invalid): {error}")
-                    print(f"Invalid request (API Key maybe Invalid): {error}")
-                    exit(1)
-                elif error.get('type') == 'insufficient_quota': # API Key配额用完
-                    logging.fatal(f"OpenAI API Key quota exceeded: {error}")
-                    print(f"OpenAI API Key quota exceeded: {error}")
-                    exit(1)
-                else:
-                    raise UnknownError(error['message'])
-
-            break
+            output_text = parse_chat_response(response.text)
+            if response_cache is not None:
+                response_cache.put(CHAT_MODEL, CHAT_PROMPT_TEMPLATE, line_break_text, output_text)
+            return output_text
+        except InvalidAPIKeyError as e:
+            logging.fatal(str(e))
+            print(str(e))
+            exit(1)
         # add requests.exceptions.SSLError
         except (requests.exceptions.RequestException, ServerOverloadedError) as e:
             if i < retries - 1:  # i is zero indexed
                 logging.error(f"Request failed with {str(e)}, retrying.")
-                time.sleep(2)
+                time.sleep(backoff_delay(i))
                 continue
             else:
                 logging.error(f"Request failed after {retries} retries.")
@@ -124,7 +181,7 @@ def gpt_detect_hard_line_breaks(line_break_text: str, use_proxy: bool = False, r
         except UnknownError as e: # sample: The server had an error while processing your request. Sorry about that!
             if i < retries - 1:  # i is zero indexed
                 logging.error(f"OpenAI side unknown error occurred: {str(e)}, retrying.")
-                time.sleep(2)
+                time.sleep(backoff_delay(i))
                 continue
             else:
                 logging.error(f"OpenAI side unknown error occurred after {retries} retries: {str(e)}.")
@@ -132,19 +189,173 @@ def gpt_detect_hard_line_breaks(line_break_text: str, use_proxy: bool = False, r
         except Exception as e:
             if i < retries - 1:  # in case of other unknown exception that prevent running
                 logging.error(f"Unexpected error occurred: {str(e)}, retrying.")
-                time.sleep(2)
+                time.sleep(backoff_delay(i))
                 continue
             else:
                 logging.error(f"Unexpected error occurred after {retries} retries: {str(e)}.")
                 raise e
 
-        # wait 10 sec between each retry
-        time.sleep(10)
 
+def estimate_request_tokens(line_break_text: str, input_tokens: int = None) -> int:
+    """
+    Estimates the tokens a detection request consumes (prompt + input + output) for TPM limiting.
+    The output is about as long as the input. Without `input_tokens`, 4 characters are counted as one token.
+    """
+    if input_tokens is None:
+        input_tokens = len(line_break_text) // 4 + 1
+    return PROMPT_TOKEN_OVERHEAD + 2 * input_tokens
 
 
+class TokenBucket:
+    """
+    令牌桶：容量为每分钟的额度，每秒匀速补充额度的1/60；acquire(n)在令牌不足时等待。
+    等待时持有锁，先来的请求先拿到令牌。per_minute为None或0时不限制。
+    """
 
-    return response_json['choices'][0]['message']['content']
+    def __init__(self, per_minute: float = None):
+        self.capacity = per_minute
+        self.rate = per_minute / 60 if per_minute else None
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1):
+        if not self.capacity:
+            return
+        amount = min(amount, self.capacity) # 单个请求超过整桶时等满一桶即可，否则永远等不到
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class AsyncGPTClient:
+    """
+    Asynchronous chat completions client shared by many concurrent requests. Needs `pip install aiohttp`.
+
+    All requests go through one aiohttp session (one connection pool). `concurrency` caps the number of
+    in-flight requests, and two token buckets keep the request rate under `rpm` requests per minute and
+    the estimated token usage under `tpm` tokens per minute. Failed requests are retried with jittered
+    exponential backoff, waiting at least as long as the Retry-After header asks for.
+    With a `response_cache` (response_cache.ResponseCache), answers are reused across runs, records and detectors.
+
+    Usage:
+        async with AsyncGPTClient(concurrency=8, rpm=3500, tpm=90000) as client:
+            outputs = await asyncio.gather(*(client.detect_hard_line_breaks(text) for text in texts))
+    """
+
+    def __init__(self, use_proxy: bool = False, api_url: str = None, api_key: str = None,
+                 concurrency: int = 8, rpm: float = 3500, tpm: float = 90000,
+                 retries: int = 1000, backoff_base: float = 1.0, backoff_max: float = 60.0, timeout: float = 60 * 5,
+                 response_cache=None):
+        if aiohttp is None:
+            raise ImportError("AsyncGPTClient needs aiohttp, please pip install aiohttp")
+        self.url = chat_completions_url(use_proxy, api_url)
+        self.api_key = api_key if api_key is not None else os.environ.get('OPENAI_API_KEY', '')
+        self.concurrency = concurrency
+        self.rpm = rpm
+        self.tpm = tpm
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.response_cache = response_cache
+        self.session = None
+
+    async def __aenter__(self):
+        # 信号量、令牌桶和session都要在事件循环里创建
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.request_bucket = TokenBucket(self.rpm)
+        self.token_bucket = TokenBucket(self.tpm)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency, ssl=False),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": "Bearer " + self.api_key
+            },
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        self.session = None
+
+    @staticmethod
+    def retry_after(response) -> float:
+        try:
+            return float(response.headers.get('Retry-After', 0))
+        except ValueError:
+            return 0
+
+    async def chat(self, request: dict, estimated_tokens: int) -> str:
+        """
+        Sends one chat completions request and returns the AI model's response.
+
+        Raises:
+            ExceededContextLength: If the context length is exceeded, not retried.
+            InvalidAPIKeyError: If the API key is invalid, not active or out of quota, not retried.
+            Exception: The last error after `retries` failed attempts.
+        """
+        for i in range(self.retries):
+            retry_after = 0
+            await self.request_bucket.acquire(1)
+            await self.token_bucket.acquire(estimated_tokens)
+            try:
+                async with self.semaphore:
+                    async with self.session.post(self.url, json=request) as response:
+                        response_text = await response.text()
+                        retry_after = self.retry_after(response)
+                logging.debug(response_text)
+                return parse_chat_response(response_text)
+            except (ExceededContextLength, InvalidAPIKeyError):
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError, ServerOverloadedError, UnknownError, ValueError, LookupError) as e:
+                if i == self.retries - 1:
+                    logging.error(f"Request failed after {self.retries} retries: {str(e)}.")
+                    raise e
+                logging.error(f"Request failed with {type(e).__name__}: {str(e)}, retrying.")
+                await asyncio.sleep(max(retry_after, backoff_delay(i, self.backoff_base, self.backoff_max)))
+
+    async def detect_hard_line_breaks(self, line_break_text: str, input_tokens: int = None, use_cache: bool = True) -> str:
+        """
+        Asynchronous version of gpt_detect_hard_line_breaks.
+
+        Args:
+            line_break_text (str): The text with line breaks which needs to be processed by the AI model.
+            input_tokens (int): The token number of line_break_text if known, used for TPM limiting.
+            use_cache (bool): Set to False to neither read nor write the response cache, e.g. when the caller
+                decides itself which answer is worth caching.
+
+        Returns:
+            str: The AI model's response.
+        """
+        if self.response_cache is not None and use_cache:
+            output_text = self.response_cache.get(CHAT_MODEL, CHAT_PROMPT_TEMPLATE, line_break_text)
+            if output_text is not None:
+                return output_text
+        output_text = await self.chat(create_chat_request(line_break_text), estimate_request_tokens(line_break_text, input_tokens))
+        if self.response_cache is not None and use_cache:
+            self.response_cache.put(CHAT_MODEL, CHAT_PROMPT_TEMPLATE, line_break_text, output_text)
+        return output_text
+
+
+def run_async(coroutine):
+    """
+    在同步代码里跑完一个协程并返回结果，供各detector的同步接口使用。
+    调用者本身已经在事件循环里（如Jupyter、异步的任务服务器）时不能再asyncio.run，改在另一个线程的新事件循环里跑完
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
 
 
 def find_char(string, char):
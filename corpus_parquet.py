@@ -0,0 +1,159 @@
+"""
+平行语料的Parquet格式，需要 pip install pyarrow。
+
+逻辑结构与jsonl语料完全相同：每行一个段落，31个字段各占一列，文件名、时间等重复值很多的列做字典编码，整体用zstd压缩。
+下游只需要某几种语言时可以只读对应的列，例如 pyarrow.parquet.read_table(path, columns=['zh_text', 'en_text'])。
+不在固定结构里的字段（如旧版语料顶层的其它字段），以及类型与固定结构不符的值，按json存进_extra列，转换回jsonl时原样还原。
+
+转换回标准的jsonl（与 jsonl_chk.py 的输出逐字节一致：按键排序、ensure_ascii=False、每行以LF结尾）：
+    python corpus_parquet.py 某个语料.parquet
+    python corpus_parquet.py 某个目录 -o 输出目录
+"""
+import argparse
+import json
+import os
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+STRING_FIELDS = [
+    "文件名",
+    "时间",
+    "zh_text_md5",
+    "扩展字段",
+    "zh_text",
+    "en_text",
+    "ar_text",
+    "nl_text",
+    "de_text",
+    "eo_text",
+    "fr_text",
+    "he_text",
+    "it_text",
+    "ja_text",
+    "pt_text",
+    "ru_text",
+    "es_text",
+    "sv_text",
+    "ko_text",
+    "th_text",
+    "id_text",
+    "vi_text",
+    "cht_text",
+]
+BOOL_FIELDS = ["是否待查文件", "是否重复文件", "是否重复", "是否跨文件重复"]
+INT_FIELDS = ["段落数", "去重段落数", "低质量段落数", "行号"]
+EXTRA_FIELD = "_extra"
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+ROW_GROUP_ROWS = 65536
+
+
+def require_pyarrow():
+    if pyarrow is None:
+        raise ImportError("未安装pyarrow，请先 pip install pyarrow")
+
+
+def corpus_schema():
+    require_pyarrow()
+    return pyarrow.schema(
+        [(name, pyarrow.string()) for name in STRING_FIELDS]
+        + [(name, pyarrow.bool_()) for name in BOOL_FIELDS]
+        + [(name, pyarrow.int64()) for name in INT_FIELDS]
+        + [(EXTRA_FIELD, pyarrow.string())]
+    )
+
+
+def field_type_ok(name: str, value) -> bool:
+    t = type(value)
+    if name in BOOL_FIELDS:
+        return t is bool
+    if name in INT_FIELDS:
+        return t is int and INT64_MIN <= value <= INT64_MAX
+    return t is str
+
+
+class ParquetCorpusWriter:
+    """逐条写入段落，攒够一个行组再写出；write_record接收的dict与jsonl中的一行相同"""
+
+    def __init__(self, path, row_group_rows: int = ROW_GROUP_ROWS):
+        self.schema = corpus_schema()
+        self.fields = STRING_FIELDS + BOOL_FIELDS + INT_FIELDS
+        self.field_set = frozenset(self.fields)
+        self.columns = {name: [] for name in self.fields + [EXTRA_FIELD]}
+        self.row_group_rows = row_group_rows
+        self.rows = 0
+        self.writer = pyarrow.parquet.ParquetWriter(str(path), self.schema, compression='zstd', use_dictionary=True)
+
+    def write_record(self, record: dict):
+        extra = {}
+        for name in self.fields:
+            value = record.get(name)
+            if name in record and not field_type_ok(name, value):
+                extra[name] = value
+                value = None
+            self.columns[name].append(value)
+        for name, value in record.items():
+            if name not in self.field_set:
+                extra[name] = value
+        self.columns[EXTRA_FIELD].append(json.dumps(extra, ensure_ascii=False) if extra else None)
+        self.rows += 1
+        if self.rows >= self.row_group_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        self.writer.write_table(pyarrow.table(self.columns, schema=self.schema))
+        for column in self.columns.values():
+            column.clear()
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def iter_records(path, columns: list = None, batch_rows: int = ROW_GROUP_ROWS):
+    """
+    逐条读出段落，结果与jsonl中的一行相同。columns非空时只读这些列（不含_extra里的字段）。
+    """
+    require_pyarrow()
+    parquet_file = pyarrow.parquet.ParquetFile(str(path))
+    read_columns = None if columns is None else list(columns)
+    for batch in parquet_file.iter_batches(batch_size=batch_rows, columns=read_columns):
+        for row in batch.to_pylist():
+            extra = row.pop(EXTRA_FIELD, None)
+            record = {name: value for name, value in row.items() if value is not None}
+            if extra is not None:
+                record.update(json.loads(extra))
+            yield record
+
+
+def parquet_to_jsonl(parquet_path, jsonl_path):
+    """把Parquet语料转换回jsonl，与jsonl_chk.py对同一批段落的输出逐字节一致"""
+    with open(jsonl_path, 'wb') as f:
+        for record in iter_records(parquet_path):
+            f.write(json.dumps(record, ensure_ascii=False, sort_keys=True).encode('utf-8') + b'\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert parallel corpus Parquet files back to canonical jsonl')
+    parser.add_argument('input', type=str, help='A .parquet file, or a directory whose .parquet files are converted')
+    parser.add_argument('-o', '--output', type=str, help='Output directory (defaults to the directory of each input file)')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.input):
+        parquet_paths = [os.path.join(args.input, filename) for filename in sorted(os.listdir(args.input)) if filename.endswith('.parquet')]
+    else:
+        parquet_paths = [args.input]
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    for parquet_path in parquet_paths:
+        out_dir = args.output or os.path.dirname(parquet_path)
+        jsonl_path = os.path.join(out_dir, os.path.splitext(os.path.basename(parquet_path))[0] + '.jsonl')
+        print(parquet_path, '->', jsonl_path)
+        parquet_to_jsonl(parquet_path, jsonl_path)
@@ -0,0 +1,84 @@
+"""
+平行语料记录的公共处理：zh_text_md5 和文件内的去重统计（是否重复、去重段落数、低质量段落数）。
+jsonl_chk.py、game_corpus/base_corpus.py、alignment/align_undl_text/merge_poc.py 共用这里的实现。
+
+每个段落的zh_text只算一次md5：去重用的摘要就是md5的16字节摘要（jsonl_chk.py 另外拼上字节长度的低8位），
+【zh_text_md5】直接由摘要的前16字节转成十六进制得到，不必再对原文算一遍。
+"""
+import hashlib
+
+MD5_DIGEST_SIZE = 16
+
+
+def zh_text_md5_digest(zh_text: str) -> bytes:
+    return hashlib.md5(zh_text.encode('utf-8')).digest()
+
+
+def zh_text_dedup_digest(zh_text: str) -> bytes:
+    """jsonl_chk.py 文件内去重用的zh_text摘要：md5加上字节长度的低8位"""
+    zh_bytes = zh_text.encode('utf-8')
+    return hashlib.md5(zh_bytes).digest() + (len(zh_bytes) % 256).to_bytes(1, byteorder='big', signed=False)
+
+
+def digest_to_md5(zh_digest: bytes) -> str:
+    """由zh_text_md5_digest或zh_text_dedup_digest的结果得到【zh_text_md5】"""
+    return zh_digest[:MD5_DIGEST_SIZE].hex()
+
+
+def zh_text_md5(zh_text: str) -> str:
+    return hashlib.md5(zh_text.encode('utf-8')).hexdigest()
+
+
+def zh_text_md5_batch(zh_texts) -> list:
+    """批量计算【zh_text_md5】，同一批内重复的zh_text只算一次"""
+    cache = {}
+    result = []
+    for zh_text in zh_texts:
+        md5 = cache.get(zh_text)
+        if md5 is None:
+            md5 = cache[zh_text] = zh_text_md5(zh_text)
+        result.append(md5)
+    return result
+
+
+def is_low_quality(zh_text: str, en_text: str) -> bool:
+    # 无简中或英文的认为是低质量语料
+    return not zh_text or not en_text
+
+
+class DedupStats:
+    """
+    同一【文件名】下段落的去重簿记。zh_digests可以是set，也可以是digest_store里任一种摘要集合。
+    seen()只登记zh_text摘要、返回是否重复（即【是否重复】）；count()把一个保留下来的段落计入统计。
+    """
+
+    def __init__(self, zh_digests=None):
+        self.zh_digests = set() if zh_digests is None else zh_digests
+        self.para_count = 0
+        self.dup_count = 0
+        self.low_quality_count = 0
+
+    def seen(self, zh_digest) -> bool:
+        prvlen = len(self.zh_digests)
+        self.zh_digests.add(zh_digest)
+        return len(self.zh_digests) == prvlen
+
+    def count(self, is_dup: bool, low_quality: bool):
+        self.para_count += 1
+        if is_dup:
+            self.dup_count += 1 # 经核实，【去重段落数】统计的是“重复了的段落”的个数
+        if low_quality:
+            self.low_quality_count += 1
+
+    def add(self, zh_digest, low_quality: bool) -> bool:
+        """登记并计入一个保留下来的段落，返回其是否重复"""
+        is_dup = self.seen(zh_digest)
+        self.count(is_dup, low_quality)
+        return is_dup
+
+    def close(self):
+        # 计数保留，只释放摘要集合
+        if hasattr(self.zh_digests, 'close'):
+            self.zh_digests.close()
+        else:
+            self.zh_digests.clear()
@@ -0,0 +1,218 @@
+"""
+jsonl_chk.py 的全局跨文件去重索引，用来填写【是否跨文件重复】。
+
+索引是一个目录，可以跨多次运行、跨多个语料目录持续累积：
+- meta.json: 索引格式版本、去重摘要所用的哈希算法和摘要长度、当前有效的分段文件列表
+- seg-*.idx: 不可变的有序分段文件，每条记录是 段落去重摘要 + 首次出现该段落的文件名的8字节摘要，
+  文件头后跟一张按摘要前两个字节分桶的累计计数表，查找时先查表定位到桶，再在桶内二分，mmap读取不占内存
+新段落先记在内存里，攒够一批后写成新分段；相邻分段大小接近时合并（与digest_store中的array实现相同的分层合并），
+因此分段数始终为O(log n)。分段写完、meta.json原子替换之后旧分段才会被删除，运行中途被打断不会损坏索引。
+同一个索引不支持多个进程同时写入。
+"""
+from array import array
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import struct
+import sys
+
+INDEX_VERSION = 1
+META_FILENAME = 'meta.json'
+SEGMENT_MAGIC = b'MNBVCGDI'
+SEGMENT_HEADER = struct.Struct('<8sIIQ') # magic, 摘要长度, 文件名摘要长度, 记录数
+FANOUT_SIZE = 65536 + 1
+OWNER_SIZE = 8
+WRITE_BUFFER_BYTES = 8 * 1024 * 1024
+
+
+def read_meta(index_dir: str):
+    meta_path = os.path.join(index_dir, META_FILENAME)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta.get('version') != INDEX_VERSION:
+        raise ValueError(f"不支持的全局去重索引版本: {meta.get('version')}")
+    return meta
+
+
+def read_hash_algorithm(index_dir: str):
+    """返回已有索引所用的哈希算法，索引尚不存在时返回None"""
+    meta = read_meta(index_dir)
+    return None if meta is None else meta['hash_algorithm']
+
+
+def filename_owner(filename: str) -> bytes:
+    return hashlib.blake2b(filename.encode('utf-8'), digest_size=OWNER_SIZE).digest()
+
+
+def write_segment(path: str, records, digest_size: int) -> int:
+    """把按摘要升序排列的 (摘要, 文件名摘要) 写成分段文件，返回记录数"""
+    fanout = array('Q', bytes(8 * FANOUT_SIZE))
+    count = 0
+    with open(path, 'wb') as f:
+        f.seek(SEGMENT_HEADER.size + 8 * FANOUT_SIZE)
+        buffer = bytearray()
+        for digest, owner in records:
+            buffer += digest
+            buffer += owner
+            fanout[(digest[0] << 8 | digest[1]) + 1] += 1
+            count += 1
+            if len(buffer) >= WRITE_BUFFER_BYTES:
+                f.write(buffer)
+                buffer.clear()
+        f.write(buffer)
+        for i in range(1, FANOUT_SIZE):
+            fanout[i] += fanout[i - 1]
+        if sys.byteorder == 'big':
+            fanout.byteswap()
+        f.seek(0)
+        f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, digest_size, OWNER_SIZE, count))
+        f.write(fanout.tobytes())
+    return count
+
+
+class IndexSegment:
+    def __init__(self, path: str):
+        self.path = path
+        self.fp = open(path, 'rb')
+        self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.digest_size, owner_size, self.count = SEGMENT_HEADER.unpack(self.mm[:SEGMENT_HEADER.size])
+        if magic != SEGMENT_MAGIC or owner_size != OWNER_SIZE:
+            raise ValueError(f"全局去重索引分段文件格式错误: {path}")
+        self.record_size = self.digest_size + OWNER_SIZE
+        self.records_offset = SEGMENT_HEADER.size + 8 * FANOUT_SIZE
+        self.fanout = array('Q')
+        self.fanout.frombytes(self.mm[SEGMENT_HEADER.size:self.records_offset])
+        if sys.byteorder == 'big':
+            self.fanout.byteswap()
+
+    def get(self, digest: bytes):
+        """返回摘要对应的文件名摘要，不存在时返回None"""
+        prefix = digest[0] << 8 | digest[1]
+        lo, hi = self.fanout[prefix], self.fanout[prefix + 1]
+        mm, size, digest_size, base = self.mm, self.record_size, self.digest_size, self.records_offset
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = base + mid * size
+            record = mm[offset:offset + digest_size]
+            if record < digest:
+                lo = mid + 1
+            elif record > digest:
+                hi = mid
+            else:
+                return mm[offset + digest_size:offset + size]
+        return None
+
+    def __iter__(self):
+        mm, size, digest_size = self.mm, self.record_size, self.digest_size
+        for offset in range(self.records_offset, self.records_offset + self.count * size, size):
+            yield mm[offset:offset + digest_size], mm[offset + digest_size:offset + size]
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.mm.close()
+        self.fp.close()
+
+
+class GlobalDedupIndex:
+    def __init__(self, index_dir: str, hash_algorithm: str, pending_limit: int = 1 << 20):
+        self.index_dir = index_dir
+        self.hash_algorithm = hash_algorithm
+        self.pending_limit = pending_limit
+        self.pending = {} # 本次运行新出现、尚未写入分段的摘要 -> 文件名摘要
+        self.segments = [] # 越靠前的分段越大
+        self.next_segment_id = 0
+        self.digest_size = 0
+        self.last_filename = None
+        self.last_owner = None
+        os.makedirs(index_dir, exist_ok=True)
+        meta = read_meta(index_dir)
+        if meta is not None:
+            if meta['hash_algorithm'] != hash_algorithm:
+                raise ValueError(f"全局去重索引使用的哈希算法为{meta['hash_algorithm']}，与本次的{hash_algorithm}不一致")
+            self.digest_size = meta['digest_size']
+            self.next_segment_id = meta['next_segment_id']
+            self.segments = [IndexSegment(os.path.join(index_dir, name)) for name in meta['segments']]
+
+    def _get(self, digest: bytes):
+        owner = self.pending.get(digest)
+        if owner is not None:
+            return owner
+        for segment in reversed(self.segments): # 新分段小，先查
+            owner = segment.get(digest)
+            if owner is not None:
+                return owner
+        return None
+
+    def add(self, digest: bytes, filename: str) -> bool:
+        """
+        登记文件名为filename的文件中的一个段落摘要。
+        返回该段落是否已经出现在别的文件名下（即【是否跨文件重复】）；同一文件名重复运行时不会把自己判为跨文件重复。
+        """
+        if filename != self.last_filename:
+            self.last_filename = filename
+            self.last_owner = filename_owner(filename)
+        if not self.digest_size:
+            self.digest_size = len(digest)
+        assert len(digest) == self.digest_size, "摘要长度必须一致"
+        owner = self._get(digest)
+        if owner is None:
+            self.pending[digest] = self.last_owner
+            if len(self.pending) >= self.pending_limit:
+                self.flush()
+            return False
+        return owner != self.last_owner
+
+    def _new_segment_path(self) -> str:
+        path = os.path.join(self.index_dir, f'seg-{self.next_segment_id:06d}.idx')
+        self.next_segment_id += 1
+        return path
+
+    def _write_meta(self):
+        meta = {
+            'version': INDEX_VERSION,
+            'hash_algorithm': self.hash_algorithm,
+            'digest_size': self.digest_size,
+            'next_segment_id': self.next_segment_id,
+            'segments': [os.path.basename(segment.path) for segment in self.segments],
+        }
+        meta_path = os.path.join(self.index_dir, META_FILENAME)
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def flush(self):
+        """把内存中的新摘要写成分段，必要时合并分段"""
+        if not self.pending:
+            return
+        path = self._new_segment_path()
+        write_segment(path, sorted(self.pending.items()), self.digest_size)
+        self.pending.clear()
+        self.segments.append(IndexSegment(path))
+        obsolete = []
+        while len(self.segments) > 1 and len(self.segments[-2]) <= 2 * len(self.segments[-1]):
+            newer = self.segments.pop()
+            older = self.segments.pop()
+            path = self._new_segment_path()
+            # 各分段之间没有相同的摘要，按摘要归并即可
+            write_segment(path, heapq.merge(older, newer), self.digest_size)
+            self.segments.append(IndexSegment(path))
+            obsolete += [older, newer]
+        self._write_meta()
+        for segment in obsolete:
+            segment.close()
+            os.remove(segment.path)
+
+    def __len__(self):
+        return len(self.pending) + sum(map(len, self.segments))
+
+    def close(self):
+        self.flush()
+        for segment in self.segments:
+            segment.close()
+        self.segments.clear()
@@ -0,0 +1,146 @@
+"""
+jsonl_chk.py 去重用的摘要集合。所有实现都只提供 add / in / len / close 四种操作：
+- set: 直接用python的set，最快，但每个17字节的摘要要占约100字节内存
+- array: 把摘要按定长记录紧凑地存进若干有序的bytes块里（类似LSM树的分层合并），查找用二分，内存约为set的1/5
+- sqlite: 存进sqlite临时库，内存只占页缓存，语料再大也不会爆内存；临时库的位置可用环境变量SQLITE_TMPDIR指定
+"""
+import heapq
+import sqlite3
+
+
+class SetDigestStore:
+    def __init__(self):
+        self.digests = set()
+
+    def add(self, digest: bytes) -> bool:
+        """插入摘要，返回其是否为新出现的摘要"""
+        prvlen = len(self.digests)
+        self.digests.add(digest)
+        return len(self.digests) != prvlen
+
+    def __contains__(self, digest: bytes):
+        return digest in self.digests
+
+    def __len__(self):
+        return len(self.digests)
+
+    def close(self):
+        self.digests.clear()
+
+
+class SortedArrayDigestStore:
+    def __init__(self, buffer_limit: int = 65536):
+        self.buffer = set() # 尚未落入有序块的新摘要
+        self.buffer_limit = buffer_limit
+        self.runs = [] # 有序块，每块是若干定长摘要首尾相接的bytes，越靠前的块越大
+        self.digest_size = 0
+        self.count = 0
+
+    def _run_contains(self, run: bytes, digest: bytes) -> bool:
+        size = self.digest_size
+        lo, hi = 0, len(run) // size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = run[mid * size:(mid + 1) * size]
+            if record < digest:
+                lo = mid + 1
+            elif record > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def _iter_run(self, run: bytes):
+        size = self.digest_size
+        for offset in range(0, len(run), size):
+            yield run[offset:offset + size]
+
+    def _flush(self):
+        self.runs.append(b''.join(sorted(self.buffer)))
+        self.buffer.clear()
+        # 相邻两块大小接近时合并，保证块数为O(log n)，每条摘要被合并的次数也是O(log n)
+        while len(self.runs) > 1 and len(self.runs[-2]) <= 2 * len(self.runs[-1]):
+            newer = self.runs.pop()
+            older = self.runs.pop()
+            merged = bytearray()
+            for record in heapq.merge(self._iter_run(older), self._iter_run(newer)):
+                merged += record
+            self.runs.append(bytes(merged))
+
+    def add(self, digest: bytes) -> bool:
+        """插入摘要，返回其是否为新出现的摘要"""
+        if not self.digest_size:
+            self.digest_size = len(digest)
+        assert len(digest) == self.digest_size, "摘要长度必须一致"
+        if digest in self:
+            return False
+        self.buffer.add(digest)
+        self.count += 1
+        if len(self.buffer) >= self.buffer_limit:
+            self._flush()
+        return True
+
+    def __contains__(self, digest: bytes):
+        if digest in self.buffer:
+            return True
+        return any(self._run_contains(run, digest) for run in self.runs)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.buffer.clear()
+        self.runs.clear()
+        self.count = 0
+
+
+class SqliteDigestStore:
+    # 同一进程内的所有sqlite摘要集合共用一个临时库，每个集合一张表
+    _conn = None
+    _next_table_id = 0
+
+    def __init__(self, commit_interval: int = 100000):
+        if SqliteDigestStore._conn is None:
+            SqliteDigestStore._conn = sqlite3.connect('') # 空路径为sqlite的磁盘临时库，关闭连接后自动删除
+            SqliteDigestStore._conn.execute('PRAGMA journal_mode=OFF')
+            SqliteDigestStore._conn.execute('PRAGMA synchronous=OFF')
+        self.table = f'digest_{SqliteDigestStore._next_table_id}'
+        SqliteDigestStore._next_table_id += 1
+        self._conn.execute(f'CREATE TABLE {self.table} (digest BLOB PRIMARY KEY) WITHOUT ROWID')
+        self.count = 0
+        self.commit_interval = commit_interval
+        self.uncommitted = 0
+
+    def add(self, digest: bytes) -> bool:
+        """插入摘要，返回其是否为新出现的摘要"""
+        cursor = self._conn.execute(f'INSERT OR IGNORE INTO {self.table} VALUES (?)', (digest,))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_interval:
+            self._conn.commit()
+            self.uncommitted = 0
+        if cursor.rowcount:
+            self.count += 1
+            return True
+        return False
+
+    def __contains__(self, digest: bytes):
+        return self._conn.execute(f'SELECT 1 FROM {self.table} WHERE digest = ?', (digest,)).fetchone() is not None
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._conn.execute(f'DROP TABLE IF EXISTS {self.table}')
+        self._conn.commit()
+        self.count = 0
+
+
+DIGEST_STORES = {
+    'set': SetDigestStore,
+    'array': SortedArrayDigestStore,
+    'sqlite': SqliteDigestStore,
+}
+
+
+def new_digest_store(kind: str):
+    return DIGEST_STORES[kind]()
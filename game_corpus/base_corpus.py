@@ -1,10 +1,20 @@
 from abc import abstractmethod
+from collections.abc import MutableMapping
 import warnings
 import hashlib
 import json
+import multiprocessing
+import operator
+import os
+import pickle
+import sys
 import time
 import re
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import corpus_parquet
+import corpus_record
+
 para_contents = {
     "行号": 0,
     "是否重复": False,
@@ -68,25 +78,170 @@ default_json = {
 
 def get_md5(content):
     if content:
-        md5 = hashlib.md5()
-        md5.update(content.encode('utf8'))
-        return md5.hexdigest().lower()
+        return corpus_record.zh_text_md5(content)
     return ''
 
 
+_MISSING = object() # 列中表示该行没有这种语言
+
+
+class _ColumnarRow(MutableMapping):
+    # ColumnarKeyContent中一行的视图，读写直接作用在各语言的列上
+    __slots__ = ('store', 'row')
+
+    def __init__(self, store, row: int):
+        self.store = store
+        self.row = row
+
+    def __getitem__(self, lang):
+        column = self.store.columns.get(lang)
+        if column is None or column[self.row] is _MISSING:
+            raise KeyError(lang)
+        return column[self.row]
+
+    def __setitem__(self, lang, content):
+        store, row = self.store, self.row
+        column = store.column(lang)
+        if column[row] is _MISSING:
+            store.lang_orders[row] = store.intern_order(store.lang_orders[row] + (lang,))
+        column[row] = content
+
+    def __delitem__(self, lang):
+        self[lang] # 不存在时抛KeyError
+        store, row = self.store, self.row
+        store.columns[lang][row] = _MISSING
+        store.lang_orders[row] = store.intern_order(tuple(l for l in store.lang_orders[row] if l != lang))
+
+    def __iter__(self):
+        return iter(self.store.lang_orders[self.row])
+
+    def __len__(self):
+        return len(self.store.lang_orders[self.row])
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class ColumnarKeyContent(MutableMapping):
+    """
+    key_content的列式存储：key只存一次并映射到行号，每种语言一列，按行号存放内容。
+    用法与{key: {lang: content}}的dict相同，kc[key]返回可读写的行视图，kc[key][lang] = content会直接写进列里；
+    省掉了每行一个内层dict的开销，大型本地化文本的内存占用可降到几分之一。
+    一行内语言的遍历顺序与dict相同，是该行写入的顺序，因此输出（如扩展字段的key顺序）与dict存储逐字节一致。
+    """
+
+    def __init__(self):
+        self.rows = {} # key -> 行号，遍历顺序即key的插入顺序
+        self.columns = {} # lang -> 按行号存放的内容列表
+        self.lang_orders = [] # 行号 -> 该行语言的写入顺序，相同顺序的行共用一个tuple
+        self.order_pool = {(): ()}
+        self.row_count = 0
+
+    def intern_order(self, order: tuple) -> tuple:
+        # 各行的语言顺序通常只有几种，共用同一个tuple，每行只多占一个指针
+        return self.order_pool.setdefault(order, order)
+
+    def column(self, lang) -> list:
+        """返回该语言的整列内容，没有该语言的行为_MISSING，不存在时新建一列"""
+        column = self.columns.get(lang)
+        if column is None:
+            column = self.columns[lang] = [_MISSING] * self.row_count
+        return column
+
+    def check_columns(self, checks: dict) -> list:
+        """
+        按列批量检查内容，checks为{lang: 检查函数}，检查函数接收该语言的一整列内容，返回与之等长的bool序列。
+        没有该语言的行以''代入，其检查结果会被忽略。返回按行号排列的bool列表，一行中所有已有语言的内容都通过检查时为True
+        """
+        valid = [True] * self.row_count
+        for lang, column in self.columns.items():
+            missing_rows = []
+            row = -1
+            while True: # 缺失的行通常很少，用list.index查找，不在python层逐行判断
+                try:
+                    row = column.index(_MISSING, row + 1)
+                except ValueError:
+                    break
+                missing_rows.append(row)
+            if missing_rows:
+                column = column.copy()
+                for row in missing_rows:
+                    column[row] = ''
+            ok = list(checks[lang](column))
+            for row in missing_rows:
+                ok[row] = True
+            valid = list(map(operator.and_, valid, ok))
+        return valid
+
+    def __getitem__(self, key):
+        return _ColumnarRow(self, self.rows[key])
+
+    def __setitem__(self, key, lang_content):
+        row = self.rows.get(key)
+        if row is None:
+            row = self.rows[key] = self.row_count
+            self.row_count += 1
+            for column in self.columns.values():
+                column.append(_MISSING)
+            self.lang_orders.append(())
+        else:
+            lang_content = dict(lang_content) # 可能是本行自己的视图，清空前先复制
+            for column in self.columns.values():
+                column[row] = _MISSING
+        for lang, content in lang_content.items():
+            self.column(lang)[row] = content
+        self.lang_orders[row] = self.intern_order(tuple(lang_content))
+
+    def __delitem__(self, key):
+        # 行号不回收，该行在各列中留空
+        row = self.rows.pop(key)
+        for column in self.columns.values():
+            column[row] = _MISSING
+        self.lang_orders[row] = ()
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __repr__(self):
+        return repr({key: dict(lang_content) for key, lang_content in self.items()})
+
+
+def _parse_task(func_task):
+    # 进程池只能执行模块级的可pickle函数，这里转调子类的parse_file
+    func, task = func_task
+    return func(*task)
+
+
 class BaseCorpus:
     """
     为减少语料转换代码开发的一个基类，继承该类后只需实现源语料到一个dict的映射即可
     """
-    def __init__(self, path: str, lang_dict: dict[str, str] = None, export_duplicate: bool = True) -> None:
+    # 子类修改了parse_file的解析逻辑时应增大此版本号，使旧的解析缓存失效
+    parse_cache_version = 1
+
+    def __init__(self, path: str, lang_dict: dict[str, str] = None, export_duplicate: bool = True,
+                 workers: int = 1, cache_dir: str = None, columnar: bool = False, output_format: str = 'jsonl') -> None:
         # key_content: {key: {lang: content}}结构的dict，key为自定义的该语料键值，如自增id、文件路径+文件名+语料内置id，等等。
         # lang为该语料支持的语言，如英文en_text、简中zh_text，等等。content为该语言的语料，如"Chapter 1"、"第一章"等。
-        self.key_content = {}
+        # columnar为True时改用用法相同的ColumnarKeyContent存储，适合条目数以百万计的语料
+        self.columnar = columnar
+        self.key_content = self.new_key_content()
         self.lang_dict = lang_dict
         self.path = path
         self.output = path + '_parallel_corpus.jsonl'
         self.file_name = re.sub(r'.*?\\', '', re.sub(r'.*?/', '', self.output))
         self.export_duplicate = export_duplicate
+        # output_format为parquet时导出为同名的.parquet文件（需要pyarrow），【文件名】字段仍为jsonl的文件名
+        self.output_format = output_format
+        # workers>1时用进程池并行解析文件；cache_dir非空时按文件缓存解析结果，游戏更新后重新导出只需解析改动过的文件
+        self.workers = workers
+        self.cache_dir = cache_dir
 
     def init_lang_dic(self, dic: dict[str, str]) -> None:
         """
@@ -96,11 +251,95 @@ class BaseCorpus:
         """
         self.lang_dict = dic
 
+    def new_key_content(self):
+        """新建一个与key_content存储方式相同的空容器，供load_contents存放中间结果"""
+        return ColumnarKeyContent() if self.columnar else {}
+
     @abstractmethod
     def load_contents(self) -> None:
         # 根据该语料的文本格式转为本工具所需格式的转换代码，需自行实现
         pass
 
+    @staticmethod
+    def parse_file(*task) -> dict:
+        """
+        解析单个文件，返回{key: {lang: content}}结构的dict，配合iter_shards使用。
+        需要实现为不依赖实例状态的静态方法，才能交给子进程执行；task的第一个元素为文件路径，其余为解析所需的参数
+        """
+        raise NotImplementedError
+
+    def _cache_file(self, task: tuple) -> str:
+        task_id = repr((type(self).__name__, self.parse_cache_version, task))
+        return os.path.join(self.cache_dir, hashlib.md5(task_id.encode('utf8')).hexdigest() + '.pkl')
+
+    def _cached_shard_is_fresh(self, task: tuple) -> bool:
+        """只读缓存文件开头的(task, size, mtime_ns)与源文件比对，不加载shard本身"""
+        cache_file = self._cache_file(task)
+        if not os.path.exists(cache_file):
+            return False
+        st = os.stat(task[0])
+        try:
+            with open(cache_file, 'rb') as f:
+                cached_task, size, mtime_ns = pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, ValueError, TypeError):
+            print("解析缓存损坏或格式不符，重新解析:", cache_file)
+            return False
+        return cached_task == task and size == st.st_size and mtime_ns == st.st_mtime_ns
+
+    def _load_cached_shard(self, task: tuple):
+        """读取缓存的shard，缓存损坏时返回None"""
+        try:
+            with open(self._cache_file(task), 'rb') as f:
+                pickle.load(f) # 跳过开头的(task, size, mtime_ns)
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            print("解析缓存损坏，重新解析:", self._cache_file(task))
+            return None
+
+    def _save_cached_shard(self, task: tuple, shard: dict, st: os.stat_result) -> None:
+        # 分两次pickle，先写用于判断是否过期的信息，判断时不必把整个shard读进内存
+        cache_file = self._cache_file(task)
+        with open(cache_file + '.tmp', 'wb') as f:
+            pickle.dump((task, st.st_size, st.st_mtime_ns), f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(shard, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_file + '.tmp', cache_file)
+
+    def iter_shards(self, tasks: list):
+        """
+        按tasks的顺序逐个返回(task, shard)，shard为parse_file(*task)的结果。
+        命中缓存的文件直接读缓存，其余文件在workers>1时交给进程池并行解析，返回顺序不受影响，合并结果与串行解析一致。
+        事先只检查缓存是否过期，缓存的shard在轮到它时才读入内存
+        """
+        tasks = [tuple(task) for task in tasks]
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fresh = [self._cached_shard_is_fresh(task) for task in tasks]
+        else:
+            fresh = [False] * len(tasks)
+        missing = [task for task, is_fresh in zip(tasks, fresh) if not is_fresh]
+        stats = {task: os.stat(task[0]) for task in missing} if self.cache_dir else {} # 解析前记下，解析中途文件被改动也不会缓存到新的mtime下
+        pool = multiprocessing.Pool(self.workers) if self.workers > 1 and len(missing) > 1 else None
+        try:
+            if pool is not None:
+                parsed = pool.imap(_parse_task, [(type(self).parse_file, task) for task in missing], chunksize=4)
+            else:
+                parsed = (type(self).parse_file(*task) for task in missing)
+            for task, is_fresh in zip(tasks, fresh):
+                shard = self._load_cached_shard(task) if is_fresh else None
+                if shard is None:
+                    if is_fresh: # 检查时缓存还在，读取时却读不出来，当场重新解析
+                        st = os.stat(task[0])
+                        shard = type(self).parse_file(*task)
+                    else:
+                        st = stats.get(task)
+                        shard = next(parsed)
+                    if self.cache_dir:
+                        self._save_cached_shard(task, shard, st)
+                yield task, shard
+        finally:
+            if pool is not None:
+                pool.terminate()
+
     def export_corpus(self):
         # 导出语料为标准格式，已废弃
         warnings.warn("导出语料为旧格式的jsonl，已废弃，请用export_corpus_new", DeprecationWarning, stacklevel=2)
@@ -153,13 +392,20 @@ class BaseCorpus:
         with open(self.output, 'w', encoding='utf8') as f:
             f.write(json.dumps(out_json, ensure_ascii=False, indent=None))
 
-    def export_corpus_new(self) -> None:
-        # 导出语料为新的标准格式
+    def gen_paras_new(self, zh_digests: bytearray = None, dedup_stats: corpus_record.DedupStats = None, dup_flags: bytearray = None):
+        """
+        按key_content的顺序逐条生成新格式的段落及其是否重复，已填好行号、zh_text_md5和扩展字段。
+        不导出重复段落时跳过zh_text重复的段落。生成过的段落不会保留，多次调用得到的结果相同。
+        zh_digests为空的bytearray时按顺序记下每个段落zh_text的md5摘要，已有记录时直接取用，同一次导出中每段只算一次md5；
+        dup_flags同理，为空时按位记下每个段落是否重复，已有记录时直接取用，不再建去重用的摘要集合；
+        给出dedup_stats时把生成的段落计入其中。
+        """
+        reuse_digests = bool(zh_digests)
+        reuse_dup_flags = bool(dup_flags)
+        offset = 0
+        index = 0 # 繁简中文至少有一种的段落的序号，对应dup_flags中的位
         para = 0
-        paras = []
-        dup_count = 0
-        lq_count = 0
-        zh_md5 = set()
+        zh_md5 = None if reuse_dup_flags else corpus_record.DedupStats() if dedup_stats is None else dedup_stats
         for k, v in self.key_content.items():
             curr_para = para_contents.copy()
             ex_lang = {}
@@ -172,13 +418,25 @@ class BaseCorpus:
             # 繁简中文都没有的就不要了
             if not curr_para['zh_text'] and not curr_para['cht_text']:
                 continue
-            curr_para['zh_text_md5'] = get_md5(curr_para['zh_text'])
-            is_dup = False
-            if curr_para['zh_text_md5'] in zh_md5:
-                is_dup = True
-                if self.export_duplicate:
-                    dup_count += 1
-            zh_md5.add(curr_para['zh_text_md5'])
+            if reuse_digests:
+                zh_digest = zh_digests[offset:offset + corpus_record.MD5_DIGEST_SIZE]
+                offset += corpus_record.MD5_DIGEST_SIZE
+            else:
+                zh_digest = corpus_record.zh_text_md5_digest(curr_para['zh_text'])
+                if zh_digests is not None:
+                    zh_digests += zh_digest
+            curr_para['zh_text_md5'] = corpus_record.digest_to_md5(zh_digest) if curr_para['zh_text'] else ''
+            if reuse_dup_flags:
+                is_dup = bool(dup_flags[index >> 3] >> (index & 7) & 1)
+            else:
+                # 用16字节的摘要去重，没有简中的段落zh_text_md5都为空串，彼此算作重复
+                is_dup = zh_md5.seen(bytes(zh_digest) if curr_para['zh_text'] else b'')
+                if dup_flags is not None:
+                    if index & 7 == 0:
+                        dup_flags.append(0)
+                    if is_dup:
+                        dup_flags[-1] |= 1 << (index & 7)
+            index += 1
             if not is_dup or self.export_duplicate:
                 para += 1
                 curr_para['行号'] = para
@@ -186,15 +444,33 @@ class BaseCorpus:
                     curr_para['扩展字段'] = json.dumps({'other_texts': ex_lang}, ensure_ascii=False)
                 else:
                     curr_para['扩展字段'] = '{}'
-                    # 无简中或英文的认为是低质量语料
-                if not curr_para['zh_text'] or not curr_para['en_text']:
-                    lq_count += 1
-                    # print(curr_para['zh_text_md5'])
-                paras.append(curr_para)
-        output = [self.compose_json(p, len(paras), dup_count, lq_count) for p in paras]
-        out_json = [json.dumps(x, ensure_ascii=False) for x in output]
+                if dedup_stats is not None:
+                    dedup_stats.count(is_dup, corpus_record.is_low_quality(curr_para['zh_text'], curr_para['en_text']))
+                yield curr_para, is_dup
+
+    def export_corpus_new(self) -> None:
+        # 导出语料为新的标准格式
+        # 分两遍：第一遍只统计段落数、去重段落数和低质量段落数，第二遍逐行组装并写出，
+        # 不再同时在内存里保留全部段落、组装后的dict和json字符串；第一遍算出的zh_text摘要每段只占16字节、是否重复只占1位，
+        # 第二遍直接复用，第一遍去重用的摘要集合在第二遍之前就释放掉
+        zh_digests = bytearray()
+        dup_flags = bytearray()
+        dedup_stats = corpus_record.DedupStats()
+        for _ in self.gen_paras_new(zh_digests, dedup_stats, dup_flags):
+            pass
+        para_count, dup_count, lq_count = dedup_stats.para_count, dedup_stats.dup_count, dedup_stats.low_quality_count
+        dedup_stats.close()
+        if self.output_format == 'parquet':
+            writer = corpus_parquet.ParquetCorpusWriter(os.path.splitext(self.output)[0] + '.parquet')
+            for curr_para, _ in self.gen_paras_new(zh_digests, dup_flags=dup_flags):
+                writer.write_record(self.compose_json(curr_para, para_count, dup_count, lq_count))
+            writer.close()
+            return
         with open(self.output, 'w', encoding='utf8') as f:
-            f.write('\n'.join(out_json))
+            for curr_para, _ in self.gen_paras_new(zh_digests, dup_flags=dup_flags):
+                if curr_para['行号'] > 1:
+                    f.write('\n') # 与原先'\n'.join的结果一致，末行没有换行符
+                f.write(json.dumps(self.compose_json(curr_para, para_count, dup_count, lq_count), ensure_ascii=False))
 
     def compose_json(self, para: dict, para_count: int, dup_count: int, lq_count: int) -> dict:
         out_json = default_json.copy()
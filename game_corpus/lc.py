@@ -2,7 +2,7 @@
 import json
 import re
 import os
-from base_corpus import BaseCorpus
+from base_corpus import BaseCorpus, ColumnarKeyContent
 
 lang_dic = {
     'Assets/Resources_moved/Localize/en/': 'en_text',
@@ -16,56 +16,103 @@ lang_ex_code = {'en_text': r'[^a-zA-Z]',
                 'ko_text': r'[^\uAC00-\uD7AF]',
                 'zh_text': r'[^\u4E00-\u9FA5]'}
 sub_dirs = ['BattleAnnouncerDlg/', 'BgmLyrics/', 'EGOVoiceDig/', 'PersonalityVoiceDlg/', 'StoryData/', '']
+lang_ex_pattern = {lang: re.compile(code) for lang, code in lang_ex_code.items()}
+# 各语言有效字符的正向字符类：去掉无效字符后非空，等价于能搜到一个有效字符，不必构造去除后的字符串
+lang_valid_pattern = {lang: re.compile('[' + code[2:]) for lang, code in lang_ex_code.items()}
 
 
 def clean_content(lang, content):
-    return re.sub(lang_ex_code[lang], '', content)
+    return lang_ex_pattern[lang].sub('', content)
+
+
+def is_valid_content(lang, content):
+    return isinstance(content, str) and lang_valid_pattern[lang].search(content) is not None
 
 
 def is_valid(lang_content):
     for lang, content in lang_content.items():
-        if not isinstance(content, str):
-            return False
-        content = clean_content(lang, content)
-        if len(content) == 0:
+        if not is_valid_content(lang, content):
             return False
     return True
 
 
+def column_check(lang):
+    search = lang_valid_pattern[lang].search
+
+    def check(contents):
+        # 非字符串的内容无效，换成''后整列直接map给search，不在python层逐个调用search
+        if not set(map(type, contents)) <= {str}:
+            contents = [content if isinstance(content, str) else '' for content in contents]
+        return map(bool, map(search, contents))
+    return check
+
+
+def valid_mask(path_cnt) -> list:
+    """按path_cnt的遍历顺序返回每个条目是否有效，列式存储时按语言整列批量检查"""
+    if isinstance(path_cnt, ColumnarKeyContent):
+        valid = path_cnt.check_columns({lang: column_check(lang) for lang in path_cnt.columns})
+        return [valid[row] for row in path_cnt.rows.values()]
+    return [is_valid(v) for v in path_cnt.values()]
+
+
 class LimComCorpus(BaseCorpus):
-    def load_contents(self):
-        key_cnt = {}
+    def list_files(self) -> list:
+        # 按 子目录 -> 语言 -> 文件 的顺序列出待解析的文件，合并顺序与逐个解析时相同
+        tasks = []
         for path in sub_dirs:
-            path_cnt = {}
             for lang_key, std_lang in lang_dic.items():
                 f_path = self.path + '/' + lang_key + path
-                files = os.listdir(f_path)
-                for f in files:
-                    if not f.endswith('.json'):
-                        continue
-                    with open(f_path + f, 'r', encoding='utf-8') as fp:
-                        content = fp.read()
-                    data = json.loads(content)
-                    if len(data) == 0 or 'dataList' not in data:
-                        continue
-                    items = data['dataList']
-                    for i in range(len(items)):
-                        item = items[i]
-                        props = item.keys()
-                        if 'id' not in props:
-                            rid = '_' + str(i)
-                        else:
-                            rid = str(item['id'])
-                        key = path + f.replace(lang_pre[std_lang], '') + rid
-                        for prop in props:
-                            if prop != 'id':
-                                key += prop
-                            if key not in path_cnt:
-                                path_cnt[key] = {}
-                            path_cnt[key][std_lang] = item[prop]
-            valid_cnt = {k: v for k, v in path_cnt.items() if is_valid(v)}
-            key_cnt.update(valid_cnt)
-        self.key_content = key_cnt
+                for f in os.listdir(f_path):
+                    if f.endswith('.json'):
+                        tasks.append((f_path + f, path, std_lang))
+        return tasks
+
+    @staticmethod
+    def parse_file(file_path, path, std_lang):
+        f = os.path.basename(file_path)
+        with open(file_path, 'r', encoding='utf-8') as fp:
+            content = fp.read()
+        data = json.loads(content)
+        file_cnt = {}
+        if len(data) == 0 or 'dataList' not in data:
+            return file_cnt
+        items = data['dataList']
+        for i in range(len(items)):
+            item = items[i]
+            props = item.keys()
+            if 'id' not in props:
+                rid = '_' + str(i)
+            else:
+                rid = str(item['id'])
+            key = path + f.replace(lang_pre[std_lang], '') + rid
+            for prop in props:
+                if prop != 'id':
+                    key += prop
+                if key not in file_cnt:
+                    file_cnt[key] = {}
+                file_cnt[key][std_lang] = item[prop]
+        return file_cnt
+
+    def add_valid(self, path_cnt):
+        for (k, v), valid in zip(path_cnt.items(), valid_mask(path_cnt)):
+            if valid:
+                self.key_content[k] = v
+
+    def load_contents(self):
+        self.key_content = self.new_key_content()
+        path_cnt = self.new_key_content()
+        curr_path = None
+        for (_, path, _), file_cnt in self.iter_shards(self.list_files()):
+            if path != curr_path:
+                # 同一子目录下各语言的文件都合并完后，再按完整的多语言内容筛选
+                self.add_valid(path_cnt)
+                path_cnt = self.new_key_content()
+                curr_path = path
+            for key, lang_content in file_cnt.items():
+                if key not in path_cnt:
+                    path_cnt[key] = {}
+                path_cnt[key].update(lang_content)
+        self.add_valid(path_cnt)
 
 
 if __name__ == '__main__':
@@ -73,11 +120,16 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--game_path', type=str, required=True, help='the corpus path of the game')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used to parse the game files')
+    parser.add_argument('--cache_dir', type=str, default=None, help='cache parsed files here and only reparse files modified since the last run')
+    parser.add_argument('--columnar', action='store_true', help='store the loaded texts column-wise to cut memory on large dumps')
+    parser.add_argument('--output_format', type=str, choices=['jsonl', 'parquet'], default='jsonl', help='export jsonl, or Parquet with the same fields (needs pyarrow)')
 
     args = parser.parse_args()
     game_path = args.game_path
 
-    corpus = LimComCorpus(game_path, lang_dict=lang_dic)
+    corpus = LimComCorpus(game_path, lang_dict=lang_dic, workers=args.workers, cache_dir=args.cache_dir,
+                          columnar=args.columnar, output_format=args.output_format)
 
     corpus.load_contents()
     corpus.export_corpus_new()
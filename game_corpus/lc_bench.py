@@ -0,0 +1,109 @@
+"""
+lc.py 有效性筛选的基准测试脚本。
+
+    python lc_bench.py --entries 1000000
+    python lc_bench.py --game_path 边狱公司的游戏目录 --sub_dir StoryData/
+生成（或从游戏目录的某个子目录读入）一份与 StoryData 结构相同的多语言条目，对比
+逐条 re.sub 后判断是否为空（旧实现）/ 逐条用预编译的正向字符类 re.search / 列式存储按语言整列批量检查
+三种方式的耗时，并校验三者筛选出的条目完全一致。
+"""
+import argparse
+import random
+import re
+import time
+
+import lc
+from base_corpus import ColumnarKeyContent
+
+LANG_TEXTS = {
+    'en_text': ['Hello there.', 'What is this place?', 'Chapter 1'],
+    'ja_text': ['こんにちは。', 'ここはどこ？', '第一章'],
+    'ko_text': ['안녕하세요.', '여기는 어디지?', '제1장'],
+    'zh_text': ['你好。', '这是哪里？', '第一章'],
+}
+# 去掉无效字符后为空的内容
+LANG_INVALID_TEXTS = {
+    'en_text': ['...', '!?', '100%'],
+    'ja_text': ['……', '！？', 'ＡＢＣ'],
+    'ko_text': ['...', '!?', '100%'],
+    'zh_text': ['……', '！？', '１００％'],
+}
+
+
+def legacy_is_valid(lang_content):
+    for lang, content in lang_content.items():
+        if not isinstance(content, str):
+            return False
+        content = re.sub(lc.lang_ex_code[lang], '', content)
+        if len(content) == 0:
+            return False
+    return True
+
+
+def gen_entries(entries: int, seed: int) -> dict:
+    # 大部分条目有效，少量缺某种语言、只有标点、为空或是数字（如 StoryData 里的 id、model 等属性），会被筛掉
+    rng = random.Random(seed)
+    path_cnt = {}
+    for i in range(entries):
+        lang_content = {}
+        for lang, texts in LANG_TEXTS.items():
+            r = rng.random()
+            if r < 0.01:
+                continue
+            elif r < 0.02:
+                lang_content[lang] = rng.randint(0, 100)
+            elif r < 0.03:
+                lang_content[lang] = ''
+            elif r < 0.04:
+                lang_content[lang] = rng.choice(LANG_INVALID_TEXTS[lang])
+            else:
+                lang_content[lang] = rng.choice(texts) * rng.randint(1, 8)
+        path_cnt[f'StoryData/S{i // 500}.json{i % 500}content'] = lang_content
+    return path_cnt
+
+
+def load_entries(game_path: str, sub_dir: str) -> dict:
+    corpus = lc.LimComCorpus(game_path, lang_dict=lc.lang_dic)
+    path_cnt = {}
+    for (_, path, _), file_cnt in corpus.iter_shards(corpus.list_files()):
+        if path != sub_dir:
+            continue
+        for key, lang_content in file_cnt.items():
+            path_cnt.setdefault(key, {}).update(lang_content)
+    return path_cnt
+
+
+def report(name: str, entries: int, seconds: float):
+    print(f"{name:<16} {entries:>10} entries {seconds:>9.3f} s {entries / seconds:>12.0f} entries/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the validity filter of lc.py")
+    parser.add_argument('--game_path', type=str, help='Take the entries from this game instead of generating them')
+    parser.add_argument('--sub_dir', type=str, default='StoryData/', help='Sub directory of the game to load with --game_path')
+    parser.add_argument('--entries', type=int, default=1000000, help='Number of generated entries')
+    parser.add_argument('--seed', type=int, default=0)
+    bench_args = parser.parse_args()
+
+    if bench_args.game_path:
+        path_cnt = load_entries(bench_args.game_path, bench_args.sub_dir)
+    else:
+        path_cnt = gen_entries(bench_args.entries, bench_args.seed)
+    columnar = ColumnarKeyContent()
+    columnar.update(path_cnt)
+    entries = len(path_cnt)
+
+    start = time.perf_counter()
+    expected = [legacy_is_valid(v) for v in path_cnt.values()]
+    report("re.sub", entries, time.perf_counter() - start)
+    print(f"{sum(expected)} of {entries} entries are valid")
+
+    start = time.perf_counter()
+    searched = lc.valid_mask(path_cnt)
+    report("re.search", entries, time.perf_counter() - start)
+    assert searched == expected
+
+    start = time.perf_counter()
+    batched = lc.valid_mask(columnar)
+    report("columnar", entries, time.perf_counter() - start)
+    assert batched == expected
@@ -13,19 +13,29 @@ lang_dic = {
 
 
 class WS3Corpus(BaseCorpus):
+    @staticmethod
+    def parse_file(file_path):
+        file = os.path.basename(file_path)
+        file_content = {}
+        with open(file_path, 'r', encoding='utf-8') as fp:
+            content = fp.read()
+            lines = content.split('\n')
+            for i in range(1, len(lines)):
+                if not lines[i].strip():
+                    continue
+                fields = lines[i].split('|')
+                fields = [f.strip() for f in fields]
+                key = '_'.join([file] + fields[:-6])
+                if key not in file_content:
+                    file_content[key] = {lang_dic[list(lang_dic.keys())[j]]: fields[-6:][j] for j in range(6)}
+        return file_content
+
     def load_contents(self):
-        for file in os.listdir(self.path):
-            with open(os.path.join(self.path, file), 'r', encoding='utf-8') as fp:
-                content = fp.read()
-                lines = content.split('\n')
-                for i in range(1, len(lines)):
-                    if not lines[i].strip():
-                        continue
-                    fields = lines[i].split('|')
-                    fields = [f.strip() for f in fields]
-                    key = '_'.join([file] + fields[:-6])
-                    if key not in self.key_content:
-                        self.key_content[key] = {lang_dic[list(lang_dic.keys())[j]]: fields[-6:][j] for j in range(6)}
+        tasks = [(os.path.join(self.path, file),) for file in os.listdir(self.path)]
+        for _, file_content in self.iter_shards(tasks):
+            for key, lang_content in file_content.items():
+                if key not in self.key_content:
+                    self.key_content[key] = lang_content
 
 
 if __name__ == '__main__':
@@ -33,11 +43,16 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--game_path', type=str, required=True, help='the corpus path of the game')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used to parse the game files')
+    parser.add_argument('--cache_dir', type=str, default=None, help='cache parsed files here and only reparse files modified since the last run')
+    parser.add_argument('--columnar', action='store_true', help='store the loaded texts column-wise to cut memory on large dumps')
+    parser.add_argument('--output_format', type=str, choices=['jsonl', 'parquet'], default='jsonl', help='export jsonl, or Parquet with the same fields (needs pyarrow)')
 
     args = parser.parse_args()
     game_path = args.game_path
 
-    corpus = WS3Corpus(game_path)
+    corpus = WS3Corpus(game_path, workers=args.workers, cache_dir=args.cache_dir, columnar=args.columnar,
+                       output_format=args.output_format)
     corpus.init_lang_dic(lang_dic)
     corpus.load_contents()
     corpus.export_corpus_new()
@@ -0,0 +1,145 @@
+"""
+jsonl_chk.py 使用的json编解码层。装了 orjson 或 msgspec 时用它们加速，否则用标准库。
+
+编码结果必须与 json.dumps(obj, ensure_ascii=False, sort_keys=True) 逐字节一致：
+- orjson 只能输出紧凑格式或带缩进的格式，这里用 OPT_INDENT_2 输出后再去掉换行和缩进（字符串里的换行一定被转义，不会误伤）
+- msgspec 按键排序编码后，用 msgspec.json.format(indent=0) 排成与标准库相同的单行格式
+两者的浮点数格式都与标准库不同（1e16 与 1e+16），所以含浮点数的对象、以及任何编码失败的情况都退回标准库。
+
+解码时 orjson 会把超出64位的整数解析成浮点数，因此解码结果含浮点数时交给标准库重新解码；
+NaN、1E400、孤立的代理字符等第三方库不接受的写法，解码失败后也退回标准库，结果与标准库保持一致。
+"""
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+BACKENDS = ['auto', 'orjson', 'msgspec', 'json']
+INDENT_NEWLINE_AFTER_COMMA = re.compile(rb',\n *')
+INDENT_NEWLINE = re.compile(rb'\n *')
+FLAT_VALUE_TYPES = frozenset({str, int, bool, type(None)})
+STR_TYPE = frozenset({str})
+CONTAINER_TYPES = (dict, list)
+
+backend = 'json'
+msgspec_encoder = None
+msgspec_decoder = None
+
+
+def json_loads(s: str):
+    return json.loads(s)
+
+
+def json_dumps_sorted_bytes(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True).encode('utf-8')
+
+
+def is_float_free(obj) -> bool:
+    """对象中是否没有浮点数，且所有键都是字符串"""
+    t = type(obj)
+    if t is dict:
+        if not STR_TYPE.issuperset(map(type, obj)):
+            return False
+        values = obj.values()
+    elif t is list:
+        values = obj
+    else:
+        return t is not float
+    value_types = set(map(type, values))
+    if float in value_types:
+        return False
+    if dict in value_types or list in value_types:
+        return all(is_float_free(v) for v in values if type(v) in CONTAINER_TYPES)
+    return True
+
+
+def contains_float(obj) -> bool:
+    """解码结果中是否含浮点数，json解码出来的键一定是字符串，这里只检查值"""
+    t = type(obj)
+    if t is dict:
+        values = obj.values()
+    elif t is list:
+        values = obj
+    else:
+        return t is float
+    value_types = set(map(type, values))
+    if float in value_types:
+        return True
+    if dict in value_types or list in value_types:
+        return any(contains_float(v) for v in values if type(v) in CONTAINER_TYPES)
+    return False
+
+
+def orjson_loads(s: str):
+    try:
+        obj = orjson.loads(s)
+    except orjson.JSONDecodeError:
+        return json.loads(s)
+    if contains_float(obj):
+        return json.loads(s)
+    return obj
+
+
+def orjson_dumps_sorted_bytes(obj) -> bytes:
+    try:
+        if type(obj) is dict and obj and FLAT_VALUE_TYPES.issuperset(map(type, obj.values())) and all(type(k) is str for k in obj):
+            # 语料的一行就是只含字符串、整数、布尔值的扁平dict，缩进格式固定为 {\n  "k": v,\n  "k": v\n}
+            return b'{' + orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2)[4:-2].replace(b',\n  ', b', ') + b'}'
+        if is_float_free(obj):
+            indented = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2)
+            return INDENT_NEWLINE.sub(b'', INDENT_NEWLINE_AFTER_COMMA.sub(b', ', indented))
+    except orjson.JSONEncodeError:
+        pass
+    return json_dumps_sorted_bytes(obj)
+
+
+def msgspec_loads(s: str):
+    try:
+        return msgspec_decoder.decode(s)
+    except msgspec.DecodeError:
+        return json.loads(s)
+
+
+def msgspec_dumps_sorted_bytes(obj) -> bytes:
+    if is_float_free(obj):
+        try:
+            return msgspec.json.format(msgspec_encoder.encode(obj), indent=0)
+        except (msgspec.EncodeError, TypeError, UnicodeEncodeError):
+            pass
+    return json_dumps_sorted_bytes(obj)
+
+
+loads = json_loads
+dumps_sorted_bytes = json_dumps_sorted_bytes
+
+
+def dumps_sorted(obj) -> str:
+    """等价于 json.dumps(obj, ensure_ascii=False, sort_keys=True)"""
+    return dumps_sorted_bytes(obj).decode('utf-8')
+
+
+def set_backend(name: str):
+    """选择编解码后端，auto 依次尝试 orjson、msgspec、标准库"""
+    global backend, loads, dumps_sorted_bytes, msgspec_encoder, msgspec_decoder
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'msgspec' if msgspec is not None else 'json'
+    if name == 'orjson':
+        if orjson is None:
+            raise ImportError("未安装orjson，请先 pip install orjson")
+        loads, dumps_sorted_bytes = orjson_loads, orjson_dumps_sorted_bytes
+    elif name == 'msgspec':
+        if msgspec is None:
+            raise ImportError("未安装msgspec，请先 pip install msgspec")
+        msgspec_encoder = msgspec.json.Encoder(order='sorted')
+        msgspec_decoder = msgspec.json.Decoder()
+        loads, dumps_sorted_bytes = msgspec_loads, msgspec_dumps_sorted_bytes
+    else:
+        loads, dumps_sorted_bytes = json_loads, json_dumps_sorted_bytes
+    backend = name
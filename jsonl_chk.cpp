@@ -17,11 +17,17 @@
 #include <cctype>
 #include <iterator>
 #include <optional>
+#include <functional>
+#include <memory>
+#include <ctime>
 
 #include "json.hpp" // 请确保nlohmann/json已在此路径可用
 #include "md5.h"    // 引用stbrumme/hash-library
 // Windows 编译命令: cl /std:c++20 /O2 jsonl_chk.cpp md5.cpp
+// Linux 编译命令: g++ -std=c++17 -O2 -o jsonl_chk jsonl_chk.cpp md5.cpp
 // Windows cmd 使用 jsonl_chk.exe 之前需要先chcp 65001
+// 输出与 jsonl_chk.py 逐字节一致，可用 python jsonl_chk.py --cpp_engine ./jsonl_chk ... 调用，
+// 一致性用 python jsonl_chk_bench.py cppdiff --engine ./jsonl_chk 做差分测试
 using json = nlohmann::json;
 namespace fs = std::filesystem;
 
@@ -112,21 +118,30 @@ static std::vector<std::string> NEW_STYLE_FIELDS = {
     "zh_text_md5",
 };
 
-// 命令行参数结构
+// 退出码：0 正常；1 输入有误；
+// EXIT_UNSUPPORTED 表示输入用到了本程序无法与 jsonl_chk.py 逐字节一致地处理的特性（繁转简、浮点数、超出64位的整数、NaN等非标准json写法等），
+// 此时应改用 jsonl_chk.py 处理，jsonl_chk.py --cpp_engine 遇到此退出码会自动退回Python实现
+static const int EXIT_UNSUPPORTED = 3;
+
+// 命令行参数结构，参数名与 jsonl_chk.py 保持一致
 struct Args
 {
     std::string input;
     std::string directory;
+    std::string all_directory_mode;
     bool debug = false;
     bool verbose = false;
     bool disable_rename = false;
+    bool disable_opencc_convert = false;
+    bool yes = false;
+    int64_t bytes_limit = 536870912;
 };
 
 static Args args;
 
 static void print_usage()
 {
-    std::cerr << "Usage: postprocess [input.jsonl] [-d directory] [-v] [-dr]\n";
+    std::cerr << "Usage: postprocess [input.jsonl] [-d directory] [-a name] [-b bytes_limit] [-v] [-dr] [-dc] [-dbg] [-y]\n";
 }
 
 static void parse_args(int argc, char **argv)
@@ -134,23 +149,29 @@ static void parse_args(int argc, char **argv)
     // 简单解析
     // 可能的参数：
     // 1) postprocess input.jsonl
-    // 2) postprocess -d directory
+    // 2) postprocess -d directory [-a name]
     // 3) -v verbose
     // 4) -dr disable_rename
+    // 5) -dc disable_opencc_convert
+    // 6) -b bytes_limit
+    // 7) -y 不询问是否覆盖输出目录，结束时也不等待回车，供 jsonl_chk.py 以子进程方式调用
     for (int i = 1; i < argc; i++)
     {
         std::string a = argv[i];
-        if (a == "-d" || a == "--directory")
+        if (a == "-d" || a == "--directory" || a == "-a" || a == "--all_directory_mode" || a == "-b" || a == "--bytes_limit")
         {
-            if (i + 1 < argc)
-            {
-                args.directory = argv[++i];
-            }
-            else
+            if (i + 1 >= argc)
             {
                 print_usage();
                 exit(1);
             }
+            std::string v = argv[++i];
+            if (a == "-d" || a == "--directory")
+                args.directory = v;
+            else if (a == "-a" || a == "--all_directory_mode")
+                args.all_directory_mode = v;
+            else
+                args.bytes_limit = std::stoll(v);
         }
         else if (a == "-dbg" || a == "--debug")
         {
@@ -164,6 +185,14 @@ static void parse_args(int argc, char **argv)
         {
             args.disable_rename = true;
         }
+        else if (a == "-dc" || a == "--disable_opencc_convert")
+        {
+            args.disable_opencc_convert = true;
+        }
+        else if (a == "-y" || a == "--yes")
+        {
+            args.yes = true;
+        }
         else if (args.input.empty() && a[0] != '-')
         {
             args.input = a;
@@ -176,177 +205,165 @@ static void parse_args(int argc, char **argv)
     }
 }
 
+[[noreturn]] static void unsupported(const std::string &reason)
+{
+    std::cerr << "【不支持】" << reason << "，请改用 jsonl_chk.py 处理\n";
+    exit(EXIT_UNSUPPORTED);
+}
+
+// C++20起path::u8string()返回std::u8string，统一转成std::string
+static std::string path_to_utf8(const fs::path &p)
+{
+    auto s = p.u8string();
+    return std::string(s.begin(), s.end());
+}
+
 static std::string md5_hex(const std::string &input)
 {
     MD5 md5_calculator;
-    return md5_calculator(input.c_str());
+    return md5_calculator(input.data(), input.size());
 }
 
-static std::vector<std::string> scan_filelines(std::vector<std::string> filelines)
+// 按 json.dumps(obj, ensure_ascii=False, sort_keys=True) 的格式序列化：
+// nlohmann::json 的对象本身按UTF-8字节序（即码位顺序）排好了键，字符串转义规则也与python一致，只需把分隔符换成 ", " 和 ": "
+static void py_dump(const json &j, std::string &out)
 {
-    // 对filelines进行处理，参考python代码逻辑
-    if (args.debug)
-        std::cerr << "去除空行以及重复...\n\n";
-
-    // 去除空行以及重复
+    switch (j.type())
+    {
+    case json::value_t::object:
     {
-        // 去空、统一strip，并检查多语言字段全一致的情况
-        int64_t lineidx = 0;
-        int64_t valid_ptr = 0;
-        // std::vector<json> valid_filelines;
-        for (auto &flitr : filelines)
+        out += '{';
+        bool first = true;
+        for (auto it = j.begin(); it != j.end(); ++it)
         {
-            json line = json::parse(flitr);
-            std::unordered_set<std::string> line_dedup_set;
-            for (auto &f : LANG_FIELDS)
-            {
-                auto s = line[f].get<std::string>();
-                // trim
-                {
-                    auto &str_ref = s;
-                    while (!str_ref.empty() && isspace((unsigned char)str_ref.front()))
-                        str_ref.erase(str_ref.begin());
-                    while (!str_ref.empty() && isspace((unsigned char)str_ref.back()))
-                        str_ref.pop_back();
-                }
-                line[f] = s;
-                line_dedup_set.insert(s);
-            }
-            flitr = std::move(line.dump(-1, ' ', false, json::error_handler_t::ignore));
-            line_dedup_set.erase("");
-            if (line_dedup_set.size() <= 1)
-            {
-                if (args.verbose)
-                {
-                    std::cerr << "【段落去冗余】为空或不同语种字段全一致的段落:" << line.dump() << "\n";
-                }
-                // skip
-            }
-            else
-            {
-                filelines[valid_ptr++] = filelines[lineidx];
-                // valid_filelines.push_back(std::move(line));
-            }
-            ++lineidx;
+            if (!first)
+                out += ", ";
+            first = false;
+            out += json(it.key()).dump();
+            out += ": ";
+            py_dump(it.value(), out);
         }
-        // filelines = std::move(valid_filelines);
-        filelines.resize(valid_ptr);
+        out += '}';
+        break;
     }
-    if (args.debug)
-        std::cerr << "文件级去重...\n\n";
-
+    case json::value_t::array:
     {
-        // 文件级去重
-        int64_t lineidx = 0;
-        int64_t valid_ptr = 0;
-        // std::vector<json> valid_filelines;
-        std::unordered_set<std::string> dedup_str_set;
-        for (auto &flitr : filelines)
+        out += '[';
+        bool first = true;
+        for (auto &v : j)
         {
-            json line = json::parse(flitr);
-            json dedup_dict;
-            dedup_dict["扩展字段"] = line["扩展字段"];
-            for (auto &f : LANG_FIELDS)
-            {
-                dedup_dict[f] = line[f];
-            }
-            std::string dedup_str = dedup_dict.dump(-1, ' ', false, json::error_handler_t::ignore);
-            if (dedup_str_set.find(dedup_str) == dedup_str_set.end())
-            {
-                // valid_filelines.push_back(std::move(line));
-                filelines[valid_ptr++] = filelines[lineidx];
-                dedup_str_set.insert(dedup_str);
-            }
-            else
-            {
-                if (args.verbose)
-                {
-                    std::cerr << "【文件级去重】与其它段落完全一致的段落:" << dedup_str << "\n";
-                }
-            }
-            ++lineidx;
+            if (!first)
+                out += ", ";
+            first = false;
+            py_dump(v, out);
         }
-        // filelines = std::move(valid_filelines);
-        filelines.resize(valid_ptr);
-        filelines.shrink_to_fit();
+        out += ']';
+        break;
     }
-    if (args.debug)
-        std::cerr << "统计重复和低质量...\n\n";
-    // 统计重复和低质量
+    case json::value_t::number_float:
+        // python的浮点数格式（如1e+16与1e16、超出64位的整数）无法保证一致
+        unsupported("含有浮点数或超出64位的整数");
+    default:
+        out += j.dump();
+    }
+}
+
+static std::string py_dumps(const json &j)
+{
+    std::string out;
+    py_dump(j, out);
+    return out;
+}
+
+// python的bool(x)
+static bool py_truthy(const json &j)
+{
+    switch (j.type())
     {
-        std::unordered_set<std::string> zh_text_dedup_set;
-        int low_quality_count = 0;
-        for (auto &flitr : filelines)
-        {
-            json line = json::parse(flitr);
-            std::string zh_text = line["zh_text"];
-            std::string en_text = line["en_text"];
-            if (zh_text.empty() || en_text.empty())
-            {
-                low_quality_count++;
-            }
-            if (zh_text_dedup_set.find(zh_text) != zh_text_dedup_set.end())
-            {
-                line["是否重复"] = true;
-            }
-            else
-            {
-                line["是否重复"] = false;
-                zh_text_dedup_set.insert(zh_text);
-            }
-            flitr = std::move(line.dump(-1, ' ', false, json::error_handler_t::ignore));
-        }
-        int zh_text_dedup_count = (int)zh_text_dedup_set.size();
-        int total = (int)filelines.size();
-        // 第二遍填充其他自动字段
-        for (int i = 0; i < (int)filelines.size(); i++)
-        {
-            auto line = json::parse(filelines[i]);
-            line["是否待查文件"] = false;
-            line["是否重复文件"] = false;
-            line["段落数"] = total;
-            line["去重段落数"] = total - zh_text_dedup_count;
-            line["低质量段落数"] = low_quality_count;
-            line["行号"] = i + 1;
-            line["是否跨文件重复"] = false;
-            {
-                // zh_text_md5
-                std::string zt = line["zh_text"];
-                line["zh_text_md5"] = md5_hex(zt);
-            }
-            // 确保只保留NEW_STYLE_FIELDS
-            json cloned_line;
-            for (auto &f : NEW_STYLE_FIELDS)
-            {
-                cloned_line[f] = line[f];
-            }
-            // line = std::move(cloned_line);
-            filelines[i] = cloned_line.dump(-1, ' ', false, json::error_handler_t::ignore);
-        }
+    case json::value_t::null:
+        return false;
+    case json::value_t::boolean:
+        return j.get<bool>();
+    case json::value_t::string:
+        return !j.get_ref<const std::string &>().empty();
+    case json::value_t::array:
+    case json::value_t::object:
+        return !j.empty();
+    case json::value_t::number_integer:
+        return j.get<int64_t>() != 0;
+    case json::value_t::number_unsigned:
+        return j.get<uint64_t>() != 0;
+    default:
+        unsupported("含有浮点数或超出64位的整数");
     }
-    return filelines;
 }
 
-static void process_file(const fs::path &file_path)
+// python的str.isspace()，str.strip()去掉的就是这些字符
+static bool is_py_space(uint32_t c)
 {
-    static bool asked = false;
-    // 准备输出目录
-    fs::path parent = file_path.parent_path();
-    fs::path out_file_dir = parent / "jsonl_reworked";
-    fs::path out_file_path = out_file_dir / file_path.filename();
+    return (c >= 0x09 && c <= 0x0D) || (c >= 0x1C && c <= 0x20) || c == 0x85 || c == 0xA0 || c == 0x1680 ||
+           (c >= 0x2000 && c <= 0x200A) || c == 0x2028 || c == 0x2029 || c == 0x202F || c == 0x205F || c == 0x3000;
+}
+
+static uint32_t decode_utf8(const std::string &s, size_t pos, size_t &len)
+{
+    unsigned char c = s[pos];
+    len = c < 0x80 ? 1 : c < 0xE0 ? 2 : c < 0xF0 ? 3 : 4;
+    if (pos + len > s.size())
+    {
+        len = 1;
+        return c;
+    }
+    uint32_t cp = len == 1 ? c : len == 2 ? c & 0x1F : len == 3 ? c & 0x0F : c & 0x07;
+    for (size_t k = 1; k < len; k++)
+        cp = (cp << 6) | ((unsigned char)s[pos + k] & 0x3F);
+    return cp;
+}
+
+// 与python的str.strip()一致：按码位去掉首尾的unicode空白，而不只是ASCII空白
+static std::string py_strip(const std::string &s)
+{
+    size_t begin = 0, end = s.size(), len = 0;
+    while (begin < end && is_py_space(decode_utf8(s, begin, len)))
+        begin += len;
+    while (end > begin)
+    {
+        size_t last = end - 1;
+        while (last > begin && ((unsigned char)s[last] & 0xC0) == 0x80)
+            --last;
+        if (!is_py_space(decode_utf8(s, last, len)))
+            break;
+        end = last;
+    }
+    return s.substr(begin, end - begin);
+}
+
+static std::string today()
+{
+    std::time_t t = std::time(nullptr);
+    char buf[16];
+    std::strftime(buf, sizeof(buf), "%Y%m%d", std::localtime(&t));
+    return buf;
+}
 
+static fs::path ensure_out_dir(const fs::path &parent)
+{
+    fs::path out_file_dir = parent / "jsonl_reworked";
     if (is_first)
     {
         if (fs::exists(out_file_dir))
         {
-            std::cerr << "请确保" << out_file_dir.string() << "目录为空，否则其内容可能会被覆盖。如不希望请直接结束本程序。\n";
-            std::cerr << "请输入Y以确认继续进行:";
-            std::string line;
-            std::getline(std::cin, line);
-            if (line != "Y")
+            if (!args.yes)
             {
-                std::cerr << "程序退出...\n";
-                exit(0);
+                std::cerr << "请确保" << out_file_dir.string() << "目录为空，否则其内容可能会被覆盖。如不希望请直接结束本程序。\n";
+                std::cerr << "请输入Y以确认继续进行:";
+                std::string line;
+                std::getline(std::cin, line);
+                if (line != "Y")
+                {
+                    std::cerr << "程序退出...\n";
+                    exit(0);
+                }
             }
         }
         else
@@ -355,34 +372,131 @@ static void process_file(const fs::path &file_path)
         }
         is_first = false;
     }
+    return out_file_dir;
+}
 
-    // filename2lines: key=文件名, value=该文件名对应的行集
-    std::unordered_map<std::string, std::vector<std::string>> filename2lines;
+// warning maps
+static std::unordered_set<std::string> first_warn_unk_key;
+static std::unordered_set<std::string> first_warn_other_texts_key_check;
 
-    // warning maps
-    std::unordered_set<std::string> first_warn_unk_key;
-    std::unordered_set<std::string> first_warn_other_texts_key_check;
+static const json &get_or_unsupported(const json &data, const std::string &key)
+{
+    auto it = data.find(key);
+    if (it == data.end())
+        unsupported("缺少字段" + key);
+    return *it;
+}
 
+static void validate_ext_fields(json &data, bool disable_ext_field_check)
+{
+    auto it = data.find("扩展字段");
+    if (it == data.end() || it->is_null())
     {
-        std::ifstream fi(file_path, std::ios::in);
-        if (!fi.is_open())
+        auto old_it = data.find("拓展字段");
+        if (old_it != data.end())
         {
-            std::cerr << "无法打开文件:" << file_path << "\n";
-            exit(1);
+            json v = *old_it;
+            data.erase(old_it);
+            data["扩展字段"] = v;
         }
-        int64_t linecounter = 0;
-        std::string line;
-        while (true)
+        else
+        {
+            data["扩展字段"] = "{}";
+        }
+    }
+    if (data["扩展字段"].is_string() && data["扩展字段"].get<std::string>().empty())
+    {
+        data["扩展字段"] = "{}";
+    }
+    json ext_field;
+    try
+    {
+        ext_field = json::parse(data["扩展字段"].get<std::string>());
+    }
+    catch (...)
+    {
+        std::cerr << "【错误】扩展字段并非有效json字符串：" << data["扩展字段"].dump() << "\n";
+        exit(1);
+    }
+    if (disable_ext_field_check)
+    {
+        data["扩展字段"] = py_dumps(ext_field);
+        return;
+    }
+    if (!ext_field.is_object() || (ext_field.contains("other_texts") && !ext_field["other_texts"].is_object()))
+    {
+        std::cerr << "【错误】扩展字段并非有效json字符串：" << data["扩展字段"].dump() << "\n";
+        exit(1);
+    }
+    if (ext_field.contains("other_texts"))
+    {
+        for (auto it = ext_field["other_texts"].begin(); it != ext_field["other_texts"].end(); ++it)
+        {
+            std::string k = it.key();
+            // 长度为2且为小写字母的校验
+            if (k.size() != 2 || !(std::islower((unsigned char)k[0]) && std::islower((unsigned char)k[1])))
+            {
+                if (first_warn_other_texts_key_check.find(k) == first_warn_other_texts_key_check.end())
+                {
+                    first_warn_other_texts_key_check.insert(k);
+                    std::cerr << "【警告】other_texts含有key名可能不合ISO 639-1规范:" << k << "\n";
+                }
+            }
+        }
+    }
+    for (auto it = ext_field.begin(); it != ext_field.end(); ++it)
+    {
+        std::string unknown_key = it.key();
+        if (unknown_key == "other_texts" || unknown_key == "k")
+            continue;
+        if (first_warn_unk_key.find(unknown_key) == first_warn_unk_key.end())
+        {
+            first_warn_unk_key.insert(unknown_key);
+            std::cerr << "【警告】扩展字段含有尚未定义的字段:" << unknown_key << "\n";
+        }
+    }
+    // 已知字段与未定义字段都会收录，按键排序后的结果就是整个扩展字段
+    data["扩展字段"] = py_dumps(ext_field);
+}
+
+static bool needs_opencc(const json &record)
+{
+    if (args.disable_opencc_convert)
+        return false;
+    auto zh_it = record.find("zh_text");
+    auto cht_it = record.find("cht_text");
+    return (zh_it == record.end() || !py_truthy(*zh_it)) && cht_it != record.end() && py_truthy(*cht_it);
+}
+
+// 逐条生成新版语料段落，对应 jsonl_chk.py 的 gen_new_style_line
+static void for_each_new_style_line(const fs::path &file_path, bool disable_ext_field_check, const std::function<void(json &)> &callback)
+{
+    std::ifstream fi(file_path, std::ios::in | std::ios::binary);
+    if (!fi.is_open())
+    {
+        std::cerr << "无法打开文件:" << file_path << "\n";
+        exit(1);
+    }
+    int64_t linecounter = 0;
+    std::string rawline;
+    while (std::getline(fi, rawline))
+    {
+        // python以文本模式读文件时，\r\n和单独的\r也都是换行
+        size_t piece_begin = 0;
+        while (piece_begin <= rawline.size())
         {
+            size_t piece_end = rawline.find('\r', piece_begin);
+            if (piece_end == std::string::npos)
+                piece_end = rawline.size();
+            std::string line = py_strip(rawline.substr(piece_begin, piece_end - piece_begin));
+            piece_begin = piece_end + 1;
             ++linecounter;
             if (args.debug && linecounter % 100000 == 0)
                 std::cerr << "读取行:" << linecounter << '\n';
-            if (!std::getline(fi, line))
-                break;
             if (line.empty())
-            {
                 continue;
-            }
+            if (line.rfind("\xEF\xBB\xBF", 0) == 0)
+                unsupported("行首含有BOM");
             json data;
             try
             {
@@ -390,105 +504,42 @@ static void process_file(const fs::path &file_path)
             }
             catch (...)
             {
-                std::cerr << "【错误】JSON解析失败:" << line << "\n";
-                exit(1);
+                unsupported("JSON解析失败（可能含有NaN等非标准写法）:" + line);
             }
+            if (!data.is_object())
+                unsupported("行不是json对象");
 
             if (!args.disable_rename)
             {
-                data["文件名"] = file_path.filename().string();
+                data["文件名"] = path_to_utf8(file_path.filename());
             }
+            if (!get_or_unsupported(data, "文件名").is_string())
+                unsupported("文件名不是字符串");
 
-            auto &filelines = filename2lines[data["文件名"].get<std::string>()];
-
-            if (data.find("扩展字段") == data.end())
-            {
-                // 尝试拓展字段
-                if (data.find("拓展字段") != data.end())
-                {
-                    data["扩展字段"] = data["拓展字段"];
-                    data.erase("拓展字段");
-                }
-                else
-                {
-                    data["扩展字段"] = "{}";
-                }
-            }
-            if (data["扩展字段"].is_string() && data["扩展字段"].get<std::string>().empty())
-            {
-                data["扩展字段"] = "{}";
-            }
-
-            // 验证扩展字段
-            {
-                std::string ext_s = data["扩展字段"].get<std::string>();
-                json ext_field;
-                try
-                {
-                    ext_field = json::parse(ext_s);
-                }
-                catch (...)
-                {
-                    std::cerr << "【错误】扩展字段并非有效json字符串：" << ext_s << "\n";
-                    exit(1);
-                }
-                json accepted_fields;
-                if (ext_field.find("other_texts") != ext_field.end())
-                {
-                    auto other_texts_field = ext_field["other_texts"];
-                    for (auto it = other_texts_field.begin(); it != other_texts_field.end(); ++it)
-                    {
-                        std::string k = it.key();
-                        // 长度为2且为小写字母的校验
-                        if (k.size() != 2 || !(std::islower((unsigned char)k[0]) && std::islower((unsigned char)k[1])))
-                        {
-                            if (first_warn_other_texts_key_check.find(k) == first_warn_other_texts_key_check.end())
-                            {
-                                first_warn_other_texts_key_check.insert(k);
-                                std::cerr << "【警告】other_texts含有key名可能不合ISO 639-1规范:" << k << "\n";
-                            }
-                        }
-                    }
-                    accepted_fields["other_texts"] = other_texts_field;
-                    ext_field.erase("other_texts");
-                }
-                if (ext_field.find("k") != ext_field.end())
-                {
-                    accepted_fields["k"] = ext_field["k"];
-                    ext_field.erase("k");
-                }
-                for (auto it = ext_field.begin(); it != ext_field.end(); ++it)
-                {
-                    std::string unknown_key = it.key();
-                    if (first_warn_unk_key.find(unknown_key) == first_warn_unk_key.end())
-                    {
-                        first_warn_unk_key.insert(unknown_key);
-                        std::cerr << "【警告】扩展字段含有尚未定义的字段:" << unknown_key << "\n";
-                    }
-                    accepted_fields[unknown_key] = it.value();
-                }
-                data["扩展字段"] = accepted_fields.dump(-1, ' ', false, json::error_handler_t::ignore);
-            }
+            validate_ext_fields(data, disable_ext_field_check);
 
             if (data.find("段落") != data.end())
             {
                 // 旧版语料，需要展平
-                auto paragraphs = data["段落"];
-                json data_cloned = data;
-                data_cloned.erase("段落");
-
+                json paragraphs = std::move(data["段落"]);
+                data.erase("段落");
+                if (!paragraphs.is_array())
+                    unsupported("段落不是列表");
                 for (auto &p : paragraphs)
                 {
-                    if (!p.contains("时间") || p["时间"].get<std::string>().empty())
+                    if (!p.is_object())
+                        unsupported("段落不是json对象");
+                    if (!p.contains("时间") || !py_truthy(p["时间"]))
                     {
-                        p["时间"] = data["时间"];
+                        p["时间"] = get_or_unsupported(data, "时间");
                     }
-                    if (p.find("扩展字段") == p.end())
+                    if (!p.contains("扩展字段") || p["扩展字段"].is_null())
                     {
                         if (p.find("拓展字段") != p.end())
                         {
-                            p["扩展字段"] = p["拓展字段"];
+                            json v = p["拓展字段"];
                             p.erase("拓展字段");
+                            p["扩展字段"] = v;
                         }
                         else
                         {
@@ -499,39 +550,28 @@ static void process_file(const fs::path &file_path)
                     {
                         p["扩展字段"] = "{}";
                     }
-
-                    if (p.find("other1_text") != p.end())
+                    for (const char *other_field : {"other1_text", "other2_text"})
                     {
-                        if (!p["other1_text"].get<std::string>().empty())
+                        if (get_or_unsupported(p, other_field) != "")
                         {
-                            std::cerr << "【错误】段落" << p["行号"] << "中存在other1_text字段，请确认具体是哪种语言并放入扩展字段中" << p.dump() << "\n";
-                            exit(1);
-                        }
-                    }
-                    if (p.find("other2_text") != p.end())
-                    {
-                        if (!p["other2_text"].get<std::string>().empty())
-                        {
-                            std::cerr << "【错误】段落" << p["行号"] << "中存在other2_text字段，请确认具体是哪种语言并放入扩展字段中" << p.dump() << "\n";
+                            std::cerr << "【错误】段落" << p["行号"] << "中存在" << other_field << "字段，请确认具体是哪种语言并放入扩展字段中" << p.dump() << "\n";
                             exit(1);
                         }
                     }
                     // 验证段落扩展字段
                     {
-                        std::string ext_s = p["扩展字段"].get<std::string>();
                         json ext_field;
                         try
                         {
-                            ext_field = json::parse(ext_s);
+                            ext_field = json::parse(p["扩展字段"].get<std::string>());
                         }
                         catch (...)
                         {
                             std::cerr << "【错误】扩展字段并非有效json字符串：" << p.dump() << "\n";
                             exit(1);
                         }
-                        p["扩展字段"] = ext_field.dump(-1, ' ', false, json::error_handler_t::ignore);
+                        p["扩展字段"] = py_dumps(ext_field);
                     }
-
                     for (auto &f : LANG_FIELDS)
                     {
                         if (!p.contains(f))
@@ -539,47 +579,238 @@ static void process_file(const fs::path &file_path)
                             p[f] = "";
                         }
                     }
-                    json merged = data_cloned;
+                    if (needs_opencc(p))
+                        unsupported("需要用OpenCC做繁简转换");
+                }
+                for (auto &p : paragraphs)
+                {
+                    json merged = data;
                     for (auto &k : KEEP_KEYS)
                     {
-                        merged[k] = p[k];
+                        merged[k] = get_or_unsupported(p, k);
                     }
-                    filelines.push_back(merged.dump(-1, ' ', false, json::error_handler_t::ignore));
-                    merged.clear();
+                    callback(merged);
                 }
             }
             else
             {
                 // 新版语料行
-                filelines.push_back(data.dump(-1, ' ', false, json::error_handler_t::ignore));
-                data.clear();
+                for (auto it = data.begin(); it != data.end();)
+                {
+                    if (std::find(NEW_STYLE_FIELDS.begin(), NEW_STYLE_FIELDS.end(), it.key()) == NEW_STYLE_FIELDS.end())
+                        it = data.erase(it);
+                    else
+                        ++it;
+                }
+                if (needs_opencc(data))
+                    unsupported("需要用OpenCC做繁简转换");
+                callback(data);
             }
         }
     }
+}
+
+// 文件统计，以文件名为主键，不同的文件名不共享行号、行结构、中文去重计数
+struct FileStat
+{
+    int64_t linecount = 0;
+    int64_t low_quality_count = 0;
+    int64_t zh_text_dedup_count = 0;
+    int64_t linecounter = 0;
+    std::unordered_set<std::string> dedup_str_set;
+    std::unordered_set<std::string> zh_text_dedup_set;
+};
+
+static std::unordered_map<std::string, FileStat> filename2stat;
+// 每个输入文件中每条段落的标记，统计阶段写入，输出阶段按下标读取
+static const uint8_t LINE_VALID = 1;
+static const uint8_t LINE_DUP = 2;
+static std::unordered_map<std::string, std::vector<uint8_t>> path2line_flags;
+
+static void strip_lang_fields(json &line, std::unordered_set<std::string> *line_dedup_set)
+{
+    for (auto &f : LANG_FIELDS)
+    {
+        auto it = line.find(f);
+        if (it != line.end() && !it->is_string())
+            unsupported(f + "不是字符串");
+        std::string s = it == line.end() ? "" : py_strip(it->get_ref<const std::string &>());
+        if (line_dedup_set)
+            line_dedup_set->insert(s);
+        line[f] = std::move(s);
+    }
+}
 
-    // 输出处理
+// 去除空行、文件级去重，并累计文件统计信息，返回段落的标记
+static uint8_t accept_line(json &line)
+{
+    std::unordered_set<std::string> line_dedup_set;
+    strip_lang_fields(line, &line_dedup_set);
+    line_dedup_set.erase("");
+    if (line_dedup_set.size() <= 1)
     {
-        std::ofstream fo(out_file_path, std::ios::out | std::ios::trunc);
-        if (!fo.is_open())
+        if (args.verbose)
         {
-            std::cerr << "无法创建输出文件:" << out_file_path << "\n";
-            exit(1);
+            std::cerr << "【段落去冗余】为空或不同语种字段全一致的段落:" << line.dump() << "\n";
         }
+        return 0;
+    }
+    // 去除所有LANG_FIELDS加上扩展字段完全一致的段落，各字段带上长度首尾相接作为去重键
+    std::string dedup_str;
+    auto append_field = [&dedup_str](const std::string &s)
+    {
+        uint64_t len = s.size();
+        dedup_str.append(reinterpret_cast<const char *>(&len), sizeof(len));
+        dedup_str += s;
+    };
+    append_field(line["扩展字段"].get_ref<const std::string &>());
+    for (auto &f : LANG_FIELDS)
+        append_field(line[f].get_ref<const std::string &>());
+    auto &stat = filename2stat[line["文件名"].get<std::string>()];
+    if (!stat.dedup_str_set.insert(std::move(dedup_str)).second)
+    {
+        if (args.verbose)
+        {
+            std::cerr << "【文件级去重】与其它段落完全一致的段落:" << line.dump() << "\n";
+        }
+        return 0;
+    }
+    stat.linecount++;
+    const std::string &zh_text = line["zh_text"].get_ref<const std::string &>();
+    const std::string &en_text = line["en_text"].get_ref<const std::string &>();
+    if (zh_text.empty() || en_text.empty())
+    {
+        stat.low_quality_count++;
+    }
+    return stat.zh_text_dedup_set.insert(zh_text).second ? LINE_VALID : LINE_VALID | LINE_DUP;
+}
+
+static void process_file(const fs::path &file_path)
+{
+    ensure_out_dir(file_path.parent_path());
+    auto &flags = path2line_flags[file_path.string()];
+    for_each_new_style_line(file_path, false, [&flags](json &line)
+                            { flags.push_back(accept_line(line)); });
+    // 统计完成后去重集合就不再需要了
+    for (auto &kv : filename2stat)
+    {
+        kv.second.zh_text_dedup_count = (int64_t)kv.second.zh_text_dedup_set.size();
+    }
+}
 
-        // 处理filename2lines
-        for (auto &kv : filename2lines)
+static void finish_stats()
+{
+    for (auto &kv : filename2stat)
+    {
+        kv.second.dedup_str_set = {};
+        kv.second.zh_text_dedup_set = {};
+    }
+}
+
+// 输出直接写入当前输出文件，超过字节上限时切换到下一个输出文件，命名规则与 jsonl_chk.py 一致
+static std::unique_ptr<std::ofstream> out_fp;
+static int64_t out_file_size = 0;
+static int out_file_id = 1;
+
+static fs::path get_next_out_file_path(const fs::path &parent_dir, const fs::path &file_path)
+{
+    fs::path out_file_dir = parent_dir / "jsonl_reworked";
+    std::string name = path_to_utf8(file_path.filename());
+    if (out_file_id == 1)
+    {
+        if (!args.all_directory_mode.empty())
+            return out_file_dir / fs::u8path(args.all_directory_mode + ".jsonl");
+        return out_file_dir / fs::u8path(name);
+    }
+    if (!args.all_directory_mode.empty())
+        return out_file_dir / fs::u8path(args.all_directory_mode + "-" + std::to_string(out_file_id) + ".jsonl");
+    size_t dot = name.rfind('.');
+    return out_file_dir / fs::u8path(name.substr(0, dot) + "-" + std::to_string(out_file_id) + "." + name.substr(dot + 1));
+}
+
+static void open_out_file(const fs::path &parent_dir, const fs::path &file_path)
+{
+    fs::path out_file_path = get_next_out_file_path(parent_dir, file_path);
+    std::cerr << "out file:" << path_to_utf8(out_file_path) << "\n";
+    out_fp = std::make_unique<std::ofstream>(out_file_path, std::ios::out | std::ios::trunc | std::ios::binary);
+    if (!out_fp->is_open())
+    {
+        std::cerr << "无法创建输出文件:" << out_file_path << "\n";
+        exit(1);
+    }
+}
+
+static void write_out_line(const std::string &outjsonbytes, const fs::path &parent_dir, const fs::path &file_path)
+{
+    if (out_file_size + (int64_t)outjsonbytes.size() > args.bytes_limit)
+    {
+        // 写入这一行会超过字节上限，切换到下一个输出文件；单行就超过上限时留下一个空文件
+        if (!out_fp)
+            open_out_file(parent_dir, file_path);
+        out_fp.reset();
+        out_file_size = 0;
+        out_file_id++;
+    }
+    if (!out_fp)
+        open_out_file(parent_dir, file_path);
+    out_fp->write(outjsonbytes.data(), outjsonbytes.size());
+    out_file_size += outjsonbytes.size();
+}
+
+static void flush_out()
+{
+    out_fp.reset();
+    out_file_size = 0;
+}
+
+static void out_file(const fs::path &parent_dir, const fs::path &file_path)
+{
+    ensure_out_dir(file_path.parent_path());
+    auto &flags = path2line_flags[file_path.string()];
+    const std::string time_str = today();
+    size_t lineidx = 0;
+    for_each_new_style_line(file_path, true, [&](json &line)
+                            {
+        uint8_t flag = flags.at(lineidx++);
+        if (!(flag & LINE_VALID))
+            return;
+        strip_lang_fields(line, nullptr);
+        auto &stat = filename2stat[line["文件名"].get<std::string>()];
+        line["是否待查文件"] = false;
+        line["是否重复文件"] = false;
+        line["是否跨文件重复"] = false;
+        line["时间"] = time_str;
+        line["是否重复"] = (flag & LINE_DUP) != 0;
+        line["行号"] = ++stat.linecounter;
+        line["zh_text_md5"] = md5_hex(line["zh_text"].get_ref<const std::string &>());
+        line["段落数"] = stat.linecount;
+        line["去重段落数"] = stat.linecount - stat.zh_text_dedup_count; // 统计的是“重复了的段落”的个数
+        line["低质量段落数"] = stat.low_quality_count;
+        std::string outjsonbytes = py_dumps(line);
+        outjsonbytes += '\n'; // LF格式的换行
+        write_out_line(outjsonbytes, parent_dir, file_path); });
+}
+
+static void reset_file_stats()
+{
+    filename2stat.clear();
+    path2line_flags.clear();
+    first_warn_unk_key.clear();
+    first_warn_other_texts_key_check.clear();
+}
+
+static std::vector<fs::path> list_jsonl_files(const std::string &directory)
+{
+    std::vector<fs::path> file_paths;
+    for (auto &p : fs::directory_iterator(fs::u8path(directory)))
+    {
+        std::string name = path_to_utf8(p.path().filename());
+        if (name.size() >= 6 && name.compare(name.size() - 6, 6, ".jsonl") == 0)
         {
-            std::string filename = kv.first;
-            auto &flines = kv.second;
-            auto processed = scan_filelines(std::move(flines));
-            for (auto &ln : processed)
-            {
-                // fo << ln.dump(-1, ' ', false, json::error_handler_t::ignore) << "\n";
-                fo << ln << "\n";
-            }
-            processed.clear();
+            file_paths.push_back(p.path());
         }
     }
+    return file_paths;
 }
 
 int main(int argc, char **argv)
@@ -592,30 +823,52 @@ int main(int argc, char **argv)
         exit(0);
     }
 
-    if (!args.directory.empty())
+    if (!args.directory.empty() && args.all_directory_mode.empty())
     {
-        // 目录处理
-        for (auto &p : fs::directory_iterator(args.directory))
+        // 目录处理，每个文件单独统计、单独输出
+        for (auto &file_path : list_jsonl_files(args.directory))
         {
-            if (!p.is_regular_file())
-                continue;
-            auto ext = p.path().extension();
-            if (ext == ".jsonl")
-            {
-                std::cerr << "[directory] filename:" << p.path().filename().string() << "\n";
-                process_file(p.path());
-            }
+            std::cerr << "[directory] filename:" << path_to_utf8(file_path.filename()) << "\n";
+            process_file(file_path);
+            finish_stats();
+            out_file(file_path.parent_path(), file_path);
+            reset_file_stats();
+            flush_out();
+            out_file_id = 1;
+        }
+    }
+    else if (!args.directory.empty())
+    {
+        // 读取整个目录后统一输出到一个文件名下
+        fs::path parent_dir = fs::u8path(args.directory);
+        auto file_paths = list_jsonl_files(args.directory);
+        for (auto &file_path : file_paths)
+        {
+            std::cerr << "[reading directory] filename:" << path_to_utf8(file_path.filename()) << "\n";
+            process_file(file_path);
+        }
+        finish_stats();
+        for (auto &file_path : file_paths)
+        {
+            std::cerr << "[output] filename:" << path_to_utf8(file_path.filename()) << "\n";
+            out_file(parent_dir, file_path);
         }
+        flush_out();
     }
     else
     {
         // 单文件处理
         std::cerr << "[single file] filename:" << args.input << "\n";
-        process_file(args.input);
+        fs::path input_path = fs::u8path(args.input);
+        process_file(input_path);
+        finish_stats();
+        out_file(input_path.parent_path(), input_path);
+        flush_out();
     }
 
-    std::cerr << "处理完毕，按回车关闭\n";
+    if (!args.yes)
     {
+        std::cerr << "处理完毕，按回车关闭\n";
         std::string dummy;
         std::getline(std::cin, dummy);
     }
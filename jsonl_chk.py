@@ -89,14 +89,25 @@ mnbvc 平行语料小组的通用后处理脚本。每个语料文件都应该
 """
 from collections import Counter
 from datetime import datetime
-import json
 import hashlib
 import argparse
-import copy
+import multiprocessing
 import os
 from pathlib import Path
-from io import BytesIO
+from io import StringIO
 import pickle
+import struct
+import subprocess
+import tempfile
+from digest_store import DIGEST_STORES, new_digest_store
+import corpus_parquet
+import corpus_record
+import dedup_index
+import json_codec
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 parser = argparse.ArgumentParser(description='''Common post-process script for parallel corpus mnbvc. Every corpus file should run this script before datachecker, or the corpus file cannot be accepted then published.
     - convert old-style parallel corpus to new-style parallel corpus
@@ -113,11 +124,35 @@ parser.add_argument('-dr', '--disable_rename', action='store_true', help='Disabl
 parser.add_argument('-dc', '--disable_opencc_convert', action='store_true', help='Disable chinese Conversion by BYVoid/OpenCC')
 parser.add_argument('-dbg', '--debug', action='store_true', help='Print debug info')
 parser.add_argument('-b', '--bytes_limit', type=int, default=536870912, help='Specify the upper limit each output jsonl file in bytes')
+parser.add_argument('-ds', '--digest_store', type=str, choices=list(DIGEST_STORES), default='set', help='Backend of the deduplication digest sets: set (fastest), array (packed sorted digests, ~5x less memory) or sqlite (on-disk, bounded memory; set SQLITE_TMPDIR to choose its location)')
+parser.add_argument('-w', '--workers', type=int, default=1, help='Number of worker processes used to check independent files in --directory mode (without --all_directory_mode)')
+parser.add_argument('-sw', '--scan_workers', type=int, default=1, help='Number of worker processes used to scan shards of one input file in parallel during the statistics pass')
+parser.add_argument('-jb', '--json_backend', type=str, choices=json_codec.BACKENDS, default='auto', help='JSON codec: orjson or msgspec when installed (auto), or the standard library. Output is byte-identical in every case')
+parser.add_argument('-ha', '--hash_algorithm', type=str, choices=['auto', 'xxh3', 'blake2b', 'md5'], default='auto', help='Hash of the file-level dedup key: xxh3 (needs xxhash) or blake2b over length-prefixed field values, auto picks xxh3 when installed; md5 keeps the old md5-of-sorted-json digest')
+parser.add_argument('-sp', '--single_pass', action='store_true', help='Parse every input file only once: spill kept lines to a temporary file, then fill in file-level totals with a cheap rewrite (the stat cache is not used)')
+parser.add_argument('-gi', '--global_index', type=str, help='Directory of a persistent global dedup index shared across runs and corpus directories; when given, `是否跨文件重复` is set for lines whose content already appeared under another `文件名`')
+parser.add_argument('-of', '--output_format', type=str, choices=['jsonl', 'parquet'], default='jsonl', help='Write jsonl, or zstd-compressed Parquet with the same fields (needs pyarrow; convert back with corpus_parquet.py). Output files are split at the same lines as the jsonl output would be')
+parser.add_argument('-ce', '--cpp_engine', type=str, help='Path of an executable built from jsonl_chk.cpp; files are processed by it (byte-identical output), falling back to this script for inputs it cannot reproduce, such as ones needing OpenCC conversion')
 # parser.add_argument('-ea', '--enable_assert', action='store_true', help='Enable assertions in the script')
 # parser.add_argument('-da', '--disable_auto_dedup', action='store_true', help='Disable auto deduplicate and empty line elimination')
 
-args = parser.parse_args()
+# 作为模块被导入时（如基准测试脚本）使用默认参数；多进程spawn出的子进程中模块名为__mp_main__，仍按命令行解析
+args = parser.parse_args() if __name__ in ("__main__", "__mp_main__") else parser.parse_args([])
 del parser
+json_codec.set_backend(args.json_backend)
+# 全局去重索引里存的是去重摘要，必须沿用建索引时的哈希算法
+index_hash_algorithm = dedup_index.read_hash_algorithm(args.global_index) if args.global_index else None
+if args.hash_algorithm == 'auto':
+    args.hash_algorithm = index_hash_algorithm or ('xxh3' if xxhash is not None else 'blake2b')
+if args.hash_algorithm == 'xxh3' and xxhash is None:
+    print("未安装xxhash，请先 pip install xxhash，或改用 --hash_algorithm blake2b")
+    exit(1)
+if args.output_format == 'parquet' and corpus_parquet.pyarrow is None:
+    print("未安装pyarrow，请先 pip install pyarrow，或改用 --output_format jsonl")
+    exit(1)
+if index_hash_algorithm is not None and index_hash_algorithm != args.hash_algorithm:
+    print(f"全局去重索引使用的哈希算法为{index_hash_algorithm}，不能改用{args.hash_algorithm}:",args.global_index)
+    exit(1)
 is_first = True
 
 KEEP_KEYS = [
@@ -204,66 +239,207 @@ NEW_STYLE_FIELDS = {
     "zh_text_md5",
 }
 
+class LineBitmap:
+    """
+    记录每个输入文件中有效行下标的位图，以文件id为主键，每行只占1 bit。
+    9千万行的文件也只需要十余MB，替代原先 {(文件路径, 行下标)} 的元组集合。
+    """
+    def __init__(self):
+        self.path2fileid = {}
+        self.bitmaps = []
+
+    def add(self, key: tuple):
+        file_path, lineidx = key
+        fileid = self.path2fileid.get(file_path)
+        if fileid is None:
+            fileid = self.path2fileid[file_path] = len(self.bitmaps)
+            self.bitmaps.append(bytearray())
+        bitmap = self.bitmaps[fileid]
+        byteidx = lineidx >> 3
+        if byteidx >= len(bitmap):
+            bitmap.extend(bytes(max(byteidx + 1 - len(bitmap), len(bitmap)))) # 按倍数扩容
+        bitmap[byteidx] |= 1 << (lineidx & 7)
+
+    def __contains__(self, key: tuple):
+        file_path, lineidx = key
+        fileid = self.path2fileid.get(file_path)
+        if fileid is None:
+            return False
+        bitmap = self.bitmaps[fileid]
+        byteidx = lineidx >> 3
+        return byteidx < len(bitmap) and bool(bitmap[byteidx] >> (lineidx & 7) & 1)
+
+    def get_bitmap(self, file_path: str) -> bytearray:
+        fileid = self.path2fileid.get(file_path)
+        return bytearray() if fileid is None else self.bitmaps[fileid]
+
+    def set_bitmap(self, file_path: str, bitmap: bytearray):
+        fileid = self.path2fileid.get(file_path)
+        if fileid is None:
+            self.path2fileid[file_path] = len(self.bitmaps)
+            self.bitmaps.append(bitmap)
+        else:
+            self.bitmaps[fileid] = bitmap
+
+    def clear(self):
+        self.path2fileid.clear()
+        self.bitmaps.clear()
+
 # 文件统计相关的走全局变量
 # 以文件名为主键，不同的文件名不共享行号、行结构、中文去重计数
 first_warn_unk_key = set()
 first_warn_other_texts_key_check = set()
-filename2zh_text_digest = {}
+deferred_ext_field_warnings = None # --scan_workers的子进程里不直接打印，把首次遇到的key按顺序记下交给主进程打印
+filename2dedup_stats = {} # 统计阶段的去重簿记，文件名 -> corpus_record.DedupStats
+# 统计完成后由filename2dedup_stats得到的计数，摘要集合关闭后输出阶段和统计缓存只用这几个计数
 filename2low_quality_count = Counter()
 filename2linecount = Counter()
-valid_line_idx_set = set()
+valid_line_idx_set = LineBitmap()
+dup_line_idx_set = LineBitmap() # 【是否重复】为True的有效行，输出时直接查表，不必再保留中文摘要集合
+cross_file_dup_line_idx_set = LineBitmap() # 【是否跨文件重复】为True的有效行
+global_dedup_index = None # 开启--global_index时在主进程中打开，跨文件、跨运行保留
 filename2zh_text_dedup_count = Counter()
 filename2linedigest = {}
 
+def warn_ext_field_key(kind: str, key: str):
+    """每个文件对同一个可疑的key只警告一次；kind为other_texts（语种缩写不规范）或unknown（未定义的字段）"""
+    warned = first_warn_other_texts_key_check if kind == 'other_texts' else first_warn_unk_key
+    if key in warned:
+        return
+    warned.add(key)
+    if deferred_ext_field_warnings is not None:
+        deferred_ext_field_warnings.append((kind, key))
+    elif kind == 'other_texts':
+        print("【警告】other_texts含有key名可能不合ISO 639-1规范的语种双字母缩写，请向工作群报告:", key)
+    else:
+        print("【警告】扩展字段含有尚未定义的字段，请向工作群报告:", key)
+
 def validate_ext_fields(data: dict, disable_ext_field_check: bool):
     if data.get('扩展字段') is None:
         data['扩展字段'] = data.pop('拓展字段', r'{}')
     if data['扩展字段'] == '':
         data['扩展字段'] = r'{}'
     try:
-        ext_field = json.loads(data['扩展字段'])
+        ext_field = json_codec.loads(data['扩展字段'])
         if disable_ext_field_check:
-            data['扩展字段'] = json.dumps(ext_field, ensure_ascii=False, sort_keys=True)
+            data['扩展字段'] = json_codec.dumps_sorted(ext_field)
             return
         accepted_fields = {}
         if 'other_texts' in ext_field:
             other_texts_field = ext_field.pop('other_texts')
             for k, v in other_texts_field.items():
                 if len(k) != 2 or not k.islower():
-                    if k not in first_warn_other_texts_key_check:
-                        first_warn_other_texts_key_check.add(k)
-                        print("【警告】other_texts含有key名可能不合ISO 639-1规范的语种双字母缩写，请向工作群报告:", k)
+                    warn_ext_field_key('other_texts', k)
             accepted_fields['other_texts'] = other_texts_field
         if 'k' in ext_field:
             k_field = ext_field.pop('k')
             accepted_fields['k'] = k_field
         for unknown_key, val in ext_field.items():
-            if unknown_key not in first_warn_unk_key:
-                first_warn_unk_key.add(unknown_key)
-                print("【警告】扩展字段含有尚未定义的字段，请向工作群报告:", unknown_key)
+            warn_ext_field_key('unknown', unknown_key)
             accepted_fields[unknown_key] = val # 打印警告信息，但是允许收录
         ext_field.clear()
-        data['扩展字段'] = json.dumps(accepted_fields, ensure_ascii=False, sort_keys=True)
+        data['扩展字段'] = json_codec.dumps_sorted(accepted_fields)
     except Exception as e:
         print("【错误】扩展字段并非有效json字符串：", data['扩展字段'])
         exit(1)
 
-def gen_new_style_line(file_path: Path, disable_ext_field_check: bool):
-    with open(file_path, "r", encoding='utf-8') as fi:
+SHARD_BYTES = 64 * 1024 * 1024
+
+def split_shards(file_path: Path):
+    """按换行符把文件切成若干约SHARD_BYTES大小的字节范围，每个范围都从行首开始、在行尾结束"""
+    file_size = os.path.getsize(file_path)
+    shards = []
+    with open(file_path, "rb") as f:
+        start = 0
+        while start < file_size:
+            f.seek(min(start + SHARD_BYTES, file_size))
+            f.readline()
+            end = f.tell()
+            shards.append((start, end))
+            start = end
+    return shards
+
+def open_lines(file_path: Path, byte_range: tuple = None):
+    if byte_range is None:
+        return open(file_path, "r", encoding='utf-8')
+    start, end = byte_range
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        shard = f.read(end - start)
+    return StringIO(shard.decode('utf-8'), newline=None) # 与文本模式打开文件时的换行符处理保持一致
+
+# 繁转简：转换器只构建一次（构建时要加载词典，开销远大于单次转换），并缓存转换结果，游戏语料中重复文本很多
+OPENCC_BATCH_SIZE = 1024
+OPENCC_CACHE_SIZE = 1 << 20
+opencc_converter = None
+t2s_cache = {}
+
+def get_opencc_converter():
+    global opencc_converter
+    if opencc_converter is None:
+        import opencc
+        opencc_converter = opencc.OpenCC(config="t2s")
+    return opencc_converter
+
+def t2s_batch(cht_texts: list) -> list:
+    """批量繁转简：未命中缓存的文本用换行符拼起来，一次调用转换完再拆开"""
+    results = [t2s_cache.get(cht_text) for cht_text in cht_texts]
+    misses = list(dict.fromkeys(cht_text for cht_text, result in zip(cht_texts, results) if result is None))
+    if misses:
+        converter = get_opencc_converter()
+        batchable = [cht_text for cht_text in misses if '\n' not in cht_text] # 自带换行的文本没法拼接，单独转换
+        converted = converter.convert('\n'.join(batchable)).split('\n') if batchable else []
+        if len(converted) != len(batchable):
+            converted = [converter.convert(cht_text) for cht_text in batchable]
+        if len(t2s_cache) + len(misses) > OPENCC_CACHE_SIZE:
+            t2s_cache.clear()
+        t2s_cache.update(zip(batchable, converted))
+        for cht_text in misses:
+            if '\n' in cht_text:
+                t2s_cache[cht_text] = converter.convert(cht_text)
+        results = [t2s_cache[cht_text] if result is None else result for cht_text, result in zip(cht_texts, results)]
+    return results
+
+def fill_zh_text_by_cht_text(records: list):
+    if args.disable_opencc_convert:
+        return
+    records = [record for record in records if not record.get("zh_text", "") and record.get("cht_text", "")]
+    if records:
+        for record, zh_text in zip(records, t2s_batch([record["cht_text"] for record in records])):
+            record["zh_text"] = zh_text
+
+def flatten_old_style_record(data: dict):
+    """
+    展平旧版语料：每个段落生成一个新的浅拷贝dict，文件级字段按段落冗余一份。
+    不对整条记录（包括全部段落）做deepcopy，段落多的文件不会出现成倍的内存峰值。
+    """
+    paragraphs = data.pop('段落')
+    for p in paragraphs:
+        record = data.copy()
+        for k in KEEP_KEYS:
+            record[k] = p[k]
+        yield record
+
+def gen_new_style_line(file_path: Path, disable_ext_field_check: bool, byte_range: tuple = None):
+    with open_lines(file_path, byte_range) as fi:
         # fic = fi.read() # 直接读40G文件报 Memory Error 了
         # $ wc -l dual_ass.jsonl
         # 92917622 dual_ass.jsonl
         linecounter = 0
+        pending = [] # 等待批量繁转简的新版语料段落，攒够OPENCC_BATCH_SIZE条再转换
         for linestr in fi:
             linecounter += 1
             if args.debug and linecounter % 100000 == 0: print("READING FILE:", linecounter)
             linestr = linestr.strip()
             if not linestr: continue
-            data: dict = json.loads(linestr)
+            data: dict = json_codec.loads(linestr)
             if not args.disable_rename:
                 data['文件名'] = file_path.name # 对于游戏语料，这里强制要求文件名等于jsonl内部文件名
             validate_ext_fields(data, disable_ext_field_check)
             if '段落' in data: # 旧版语料
+                fill_zh_text_by_cht_text(pending)
+                yield from pending
+                pending.clear()
                 for pid, p in enumerate(data['段落']):
                     if '时间' not in p or not p['时间']:
                         p['时间'] = data['时间']
@@ -274,42 +450,30 @@ def gen_new_style_line(file_path: Path, disable_ext_field_check: bool):
                     assert p['other1_text'] == '', f"【错误】段落{p['行号']}中存在other1_text字段 => {p}，请确认具体是哪种语言，并填入扩展字段中"
                     assert p['other2_text'] == '', f"【错误】段落{p['行号']}中存在other2_text字段 => {p}，请确认具体是哪种语言，并填入扩展字段中"
                     try:
-                        ext_field = json.loads(p['扩展字段'])
-                        p['扩展字段'] = json.dumps(ext_field, ensure_ascii=False, sort_keys=True)
+                        ext_field = json_codec.loads(p['扩展字段'])
+                        p['扩展字段'] = json_codec.dumps_sorted(ext_field)
                     except Exception as e:
                         print("【错误】扩展字段并非有效json字符串：", p)
                         exit(1)
                     for lang_field in LANG_FIELDS:
                         p.setdefault(lang_field, "")
-                data_cloned = copy.deepcopy(data)
-                data_cloned.pop('段落')
-                for pid, p in enumerate(data['段落']):
-                    for k in KEEP_KEYS:
-                        data_cloned[k] = p[k]
-                    cht_text: str = data_cloned.get("cht_text", "")
-                    zh_text: str = data_cloned.get("zh_text", "")
-                    if not zh_text and cht_text and not args.disable_opencc_convert:
-                        import opencc
-                        converter = opencc.OpenCC(config="t2s")
-                        zh_text = converter.convert(cht_text)
-                        data_cloned["zh_text"] = zh_text
-                    yield data_cloned
+                fill_zh_text_by_cht_text(data['段落'])
+                yield from flatten_old_style_record(data)
             else:
                 for key in list(data.keys()):
                     if key not in NEW_STYLE_FIELDS:
                         data.pop(key)
-                cht_text: str = data.get("cht_text", "")
-                zh_text: str = data.get("zh_text", "")
-                if not zh_text and cht_text and not args.disable_opencc_convert:
-                    import opencc
-                    converter = opencc.OpenCC(config="t2s")
-                    zh_text = converter.convert(cht_text)
-                    data["zh_text"] = zh_text
-                yield data # 需要避免把json序列化之前的dict保存下来，可能会有字符串形式的表示的数十倍大
+                pending.append(data) # 需要避免把json序列化之前的dict保存下来，可能会有字符串形式的表示的数十倍大，所以只攒一小批
+                if len(pending) >= OPENCC_BATCH_SIZE:
+                    fill_zh_text_by_cht_text(pending)
+                    yield from pending
+                    pending.clear()
+        fill_zh_text_by_cht_text(pending)
+        yield from pending
 
-def process_file(file_path: Path):
+def ensure_out_dir(parent_dir: Path):
     global is_first
-    out_file_dir = file_path.parent / "jsonl_reworked"
+    out_file_dir = parent_dir / "jsonl_reworked"
     if is_first:
         if os.path.exists(out_file_dir):
             print(f"请确保{out_file_dir}目录为空，否则其内容可能会被覆盖。如不希望请直接结束本程序。")
@@ -319,60 +483,217 @@ def process_file(file_path: Path):
         else:
             os.makedirs(out_file_dir)
         is_first = False
-    del out_file_dir
-    for lineidx, linejson in enumerate(gen_new_style_line(file_path, False)):
-        #######去除空行#######
-        line_dedup_set = set()
-        for lang_field in LANG_FIELDS:
-            linejsonfield = linejson.get(lang_field, "").strip()
-            linejson[lang_field] = linejsonfield
-            line_dedup_set.add(linejsonfield)
-        line_dedup_set.discard("")
-        if len(line_dedup_set) <= 1:
-            if args.verbose:
-                print('【段落去冗余】为空或不同语种字段全一致的段落:',linejson)
-            continue
-        #######去除空行#######
-        linejsonfilename = linejson['文件名']
-        #######文件级去重#######，去除所有LANG_FIELDS加上扩展字段，完全一致的段落，如[{"en_text":"Fine","zh_text":"好"},{"en_text":"Fine","zh_text":"好"}],这种重复只保留第一次出现的那段
-        dedup_str_set: set = filename2linedigest.setdefault(linejsonfilename, set())
-        dedup_dict = {'扩展字段':linejson['扩展字段']}
-        for lang_field in LANG_FIELDS:
-            dedup_dict[lang_field] = linejson[lang_field]
-        dedup_bytes = json.dumps(dedup_dict, ensure_ascii=False, sort_keys=True).encode('utf-8')
-        # digest = hashlib.sha256(dedup_str).hexdigest() + hashlib.md5(dedup_str).hexdigest() # 选一个快又不那么容易冲突的办法就行
-        # digest = hashlib.sha256(dedup_str).hexdigest()
-        digest = hashlib.md5(dedup_bytes).digest() + (len(dedup_bytes) % 256).to_bytes(1, byteorder='big', signed=False)
-        _prvlen = len(dedup_str_set)
-        dedup_str_set.add(digest)
-        _afterlen = len(dedup_str_set)
-        if _afterlen == _prvlen:
-            if args.verbose:
-                print('【文件级去重】与其它段落完全一致的段落:',dedup_bytes)
+    return out_file_dir
+
+# 文件级去重键：所有LANG_FIELDS加上扩展字段。
+# 规范化形式为 各字段字符数（定长头部）+ 各字段值首尾相接，不必为每行构建dict再做json序列化，一次哈希即可
+DEDUP_FIELDS = ['扩展字段'] + LANG_FIELDS
+DEDUP_KEY_HEADER = struct.Struct(f'<{len(DEDUP_FIELDS)}I')
+
+def dedup_key_digest_md5(values: list) -> bytes:
+    # 旧版摘要：按键排序的json的md5，外加json长度的低8位
+    dedup_bytes = json_codec.dumps_sorted_bytes(dict(zip(DEDUP_FIELDS, values)))
+    return hashlib.md5(dedup_bytes).digest() + (len(dedup_bytes) % 256).to_bytes(1, byteorder='big', signed=False)
+
+def dedup_key_digest_blake2b(values: list) -> bytes:
+    return hashlib.blake2b(DEDUP_KEY_HEADER.pack(*map(len, values)) + ''.join(values).encode('utf-8'), digest_size=16).digest()
+
+def dedup_key_digest_xxh3(values: list) -> bytes:
+    return xxhash.xxh3_128_digest(DEDUP_KEY_HEADER.pack(*map(len, values)) + ''.join(values).encode('utf-8'))
+
+DEDUP_KEY_DIGESTS = {
+    'md5': dedup_key_digest_md5,
+    'blake2b': dedup_key_digest_blake2b,
+    'xxh3': dedup_key_digest_xxh3,
+}
+
+def digest_line(linejson: dict):
+    """
+    去除空行，并计算文件级去重所需的摘要。只依赖本段落自身，可以在子进程中并行计算。
+    空段落返回None，否则返回 (文件名, 段落摘要, zh_text摘要, 是否低质量, 段落原文)，段落原文只在打印详细信息时计算。
+    """
+    #######去除空行#######
+    line_dedup_set = set()
+    for lang_field in LANG_FIELDS:
+        linejsonfield = linejson.get(lang_field, "").strip()
+        linejson[lang_field] = linejsonfield
+        line_dedup_set.add(linejsonfield)
+    line_dedup_set.discard("")
+    if len(line_dedup_set) <= 1:
+        if args.verbose:
+            print('【段落去冗余】为空或不同语种字段全一致的段落:',linejson)
+        return None
+    #######去除空行#######
+    #######文件级去重#######，去除所有LANG_FIELDS加上扩展字段，完全一致的段落，如[{"en_text":"Fine","zh_text":"好"},{"en_text":"Fine","zh_text":"好"}],这种重复只保留第一次出现的那段
+    dedup_values = [linejson[field] for field in DEDUP_FIELDS]
+    # digest = hashlib.sha256(dedup_str).hexdigest() + hashlib.md5(dedup_str).hexdigest() # 选一个快又不那么容易冲突的办法就行
+    # digest = hashlib.sha256(dedup_str).hexdigest()
+    digest = DEDUP_KEY_DIGESTS[args.hash_algorithm](dedup_values)
+    dedup_bytes = json_codec.dumps_sorted_bytes(dict(zip(DEDUP_FIELDS, dedup_values))) if args.verbose else None # 仅用于打印
+    zh_text: str = linejson.get("zh_text","")
+    en_text: str = linejson.get("en_text","")
+    is_low_quality = corpus_record.is_low_quality(zh_text, en_text)
+    zh_digest = corpus_record.zh_text_dedup_digest(zh_text) # 内存瓶颈；前16字节即【zh_text_md5】，输出时不再重新计算
+    return linejson['文件名'], digest, zh_digest, is_low_quality, dedup_bytes
+
+def accept_digests(line_digests: tuple):
+    """
+    按段落在文件中的顺序，根据digest_line的结果完成文件级去重，并累计文件统计信息。
+    段落被丢弃时返回None，否则返回其zh_text是否与本文件中更早保留的段落重复（即【是否重复】）。
+    """
+    if line_digests is None:
+        return None
+    linejsonfilename, digest, zh_digest, is_low_quality, dedup_bytes = line_digests
+    dedup_str_set = filename2linedigest.get(linejsonfilename)
+    if dedup_str_set is None:
+        dedup_str_set = filename2linedigest[linejsonfilename] = new_digest_store(args.digest_store)
+    if not dedup_str_set.add(digest):
+        if args.verbose:
+            print('【文件级去重】与其它段落完全一致的段落:',dedup_bytes)
+        return None
+    # filelines = filename2lines.setdefault(linejsonfilename, [])
+    # filelines.append(lineidx) # 记有效行的下标
+
+    #######文件级去重#######
+    # 计算【段落数】、【去重段落数】、【低质量段落数】，填写【是否重复】
+    dedup_stats = filename2dedup_stats.get(linejsonfilename)
+    if dedup_stats is None:
+        dedup_stats = filename2dedup_stats[linejsonfilename] = corpus_record.DedupStats(new_digest_store(args.digest_store))
+    return dedup_stats.add(zh_digest, is_low_quality)
+
+def accept_line(linejson: dict):
+    return accept_digests(digest_line(linejson))
+
+def accept_cross_file(line_digests: tuple) -> bool:
+    """把已保留的段落登记到全局去重索引，返回其是否与其它文件名下的段落重复（即【是否跨文件重复】）"""
+    if global_dedup_index is None:
+        return False
+    linejsonfilename, digest = line_digests[:2]
+    return global_dedup_index.add(digest, linejsonfilename)
+
+def update_zh_text_dedup_count():
+    for filename, dedup_stats in filename2dedup_stats.items():
+        filename2linecount[filename] = dedup_stats.para_count
+        filename2low_quality_count[filename] = dedup_stats.low_quality_count
+        filename2zh_text_dedup_count[filename] = dedup_stats.para_count - dedup_stats.dup_count
+
+def close_digest_stores():
+    # 统计完成后摘要集合就不再需要了，输出阶段只依赖计数和位图
+    for digest_store in filename2linedigest.values():
+        digest_store.close()
+    for dedup_stats in filename2dedup_stats.values():
+        dedup_stats.close()
+    filename2linedigest.clear()
+    filename2dedup_stats.clear()
+
+def scan_shard_worker(task: tuple):
+    global deferred_ext_field_warnings
+    file_path, byte_range = task
+    shard_digests = []
+    # 每个分片单独记下首次遇到的可疑key，由主进程按分片顺序去重后打印，与串行时一样每个key只警告一次
+    first_warn_unk_key.clear()
+    first_warn_other_texts_key_check.clear()
+    deferred_ext_field_warnings = []
+    try:
+        for linejson in gen_new_style_line(file_path, False, byte_range):
+            shard_digests.append(digest_line(linejson))
+    except SystemExit as e:
+        return e.code, None, deferred_ext_field_warnings
+    return None, shard_digests, deferred_ext_field_warnings
+
+def gen_line_digests(file_path: Path):
+    if args.scan_workers <= 1:
+        for linejson in gen_new_style_line(file_path, False):
+            yield digest_line(linejson)
+        return
+    # 子进程并行解析各个分片并计算摘要，主进程按分片顺序合并，保证行下标、去重结果与串行完全一致
+    tasks = [(file_path, byte_range) for byte_range in split_shards(file_path)]
+    with multiprocessing.Pool(args.scan_workers) as pool:
+        for exit_code, shard_digests, shard_warnings in pool.imap(scan_shard_worker, tasks):
+            for kind, key in shard_warnings:
+                warn_ext_field_key(kind, key)
+            if exit_code is not None:
+                pool.terminate()
+                exit(exit_code)
+            yield from shard_digests
+
+class ZhMd5Log:
+    """
+    两遍模式下，统计阶段按有效行的顺序把每行zh_text的md5摘要（16字节）追加到临时文件，输出阶段按同样的顺序读回，
+    每行的zh_text只算一次md5，内存里只记每个输入文件在临时文件中的位置。
+    命中统计缓存、本次没有经过统计阶段的文件不在其中，输出时再计算。
+    """
+    READ_CHUNK_RECORDS = 65536
+
+    def __init__(self):
+        self.fp = None
+        self.ranges = {} # 输入文件路径 -> (起始偏移, 记录数)
+        self.curr_file_path = None
+        self.curr_offset = 0
+        self.curr_count = 0
+
+    def begin(self, file_path: str, out_file_dir: Path):
+        if self.fp is None:
+            self.fp = tempfile.TemporaryFile(dir=out_file_dir)
+        self.fp.seek(0, os.SEEK_END)
+        self.curr_file_path = file_path
+        self.curr_offset = self.fp.tell()
+        self.curr_count = 0
+
+    def append(self, zh_digest: bytes):
+        self.fp.write(zh_digest[:corpus_record.MD5_DIGEST_SIZE])
+        self.curr_count += 1
+
+    def end(self):
+        self.ranges[self.curr_file_path] = (self.curr_offset, self.curr_count)
+
+    def read(self, file_path: str):
+        """按有效行的顺序返回该文件各行的md5摘要，没有记录时返回None"""
+        file_range = self.ranges.pop(file_path, None)
+        if file_range is None:
+            return None
+        return self._iter_range(*file_range)
+
+    def _iter_range(self, offset: int, count: int):
+        size = corpus_record.MD5_DIGEST_SIZE
+        self.fp.flush()
+        while count > 0:
+            n = min(count, self.READ_CHUNK_RECORDS)
+            self.fp.seek(offset)
+            chunk = self.fp.read(n * size)
+            offset += n * size
+            count -= n
+            for i in range(0, len(chunk), size):
+                yield chunk[i:i + size]
+
+    def clear(self):
+        if self.fp is not None:
+            self.fp.seek(0)
+            self.fp.truncate()
+        self.ranges.clear()
+
+zh_md5_log = ZhMd5Log()
+
+def process_file(file_path: Path):
+    zh_md5_log.begin(str(file_path), ensure_out_dir(file_path.parent))
+    for lineidx, line_digests in enumerate(gen_line_digests(file_path)):
+        is_dup = accept_digests(line_digests)
+        if is_dup is None:
             continue
-        # filelines = filename2lines.setdefault(linejsonfilename, [])
-        # filelines.append(lineidx) # 记有效行的下标
-        filename2linecount[linejsonfilename] += 1
         valid_line_idx_set.add((str(file_path),lineidx))
-
-        #######文件级去重#######
-        # 计算【去重段落数】、【低质量段落数】，填写【是否重复】
-        # low_quality_count = filename2low_quality_count.setdefault(linejson['文件名'], 0)
-        zh_text_set: set = filename2zh_text_digest.setdefault(linejsonfilename, set())
-        zh_text: str = linejson.get("zh_text","")
-        en_text: str = linejson.get("en_text","")
-        if not zh_text or not en_text:
-            filename2low_quality_count[linejsonfilename] += 1
-        # _prvlen = len(zh_text_set)
-        dedup_bytes = zh_text.encode("utf-8")
-        digest = hashlib.md5(dedup_bytes).digest() + (len(dedup_bytes) % 256).to_bytes(1, byteorder='big', signed=False) # 内存瓶颈
-        zh_text_set.add(digest)
-        # _afterlen = len(zh_text_set)
-    for filename, zh_text_set in filename2zh_text_digest.items():
-        filename2zh_text_dedup_count[filename] = len(zh_text_set)
+        zh_md5_log.append(line_digests[2])
+        if is_dup:
+            dup_line_idx_set.add((str(file_path),lineidx))
+        if accept_cross_file(line_digests):
+            cross_file_dup_line_idx_set.add((str(file_path),lineidx))
+    zh_md5_log.end()
+    update_zh_text_dedup_count()
 
 filename2linecounter = Counter()
-bio = BytesIO()
+OUT_BUFFER_BYTES = 8 * 1024 * 1024
+# 输出直接写入当前输出文件，内存里只有一个OUT_BUFFER_BYTES大小的写缓冲，不再把整个输出文件攒在内存里
+out_fp = None
+out_file_size = 0
 out_file_id = 1
 
 def get_next_out_file_path(parent_dir: Path, file_path: Path):
@@ -389,134 +710,403 @@ def get_next_out_file_path(parent_dir: Path, file_path: Path):
             next_out_file_path = parent_dir / "jsonl_reworked" / f"{filename_without_ext}-{out_file_id}.{file_ext_name}"
     return next_out_file_path
 
+def fill_line_fields(linejson: dict, is_dup: bool, is_cross_file_dup: bool, zh_text_md5: str):
+    """填写除文件级统计（段落数、去重段落数、低质量段落数）以外的自动字段"""
+    linejsonfilename = linejson['文件名']
+    filename2linecounter[linejsonfilename] += 1
+    linejson['是否待查文件'] = False # 平行语料组固定将此字段给False
+    linejson['是否重复文件'] = False # 平行语料组固定将此字段给False
+    linejson['是否跨文件重复'] = is_cross_file_dup # 不开--global_index时恒为False
+
+    linejson['时间'] = datetime.now().strftime("%Y%m%d")
+    linejson['是否重复'] = is_dup
+    linejson['行号'] = filename2linecounter[linejsonfilename]
+    linejson['zh_text_md5'] = zh_text_md5
+
+def fill_file_stat_fields(linejson: dict):
+    linejsonfilename = linejson['文件名']
+    linejson['段落数'] = filename2linecount[linejsonfilename]
+    linejson['去重段落数'] = filename2linecount[linejsonfilename] - filename2zh_text_dedup_count[linejsonfilename] # 经核实，此字段统计的是“重复了的段落”的个数
+    linejson['低质量段落数'] = filename2low_quality_count[linejsonfilename]
+
+class ParquetOutFile:
+    """--output_format parquet的输出文件，接口与写jsonl时打开的文件相同，写入的每一行都解码后转存为Parquet"""
+    def __init__(self, out_file_path: Path):
+        self.writer = corpus_parquet.ParquetCorpusWriter(out_file_path)
+
+    def write(self, outjsonbytes: bytes):
+        self.writer.write_record(json_codec.loads(outjsonbytes.decode('utf-8')))
+
+    def close(self):
+        self.writer.close()
+
+def open_out_file(parent_dir: Path, file_path: Path):
+    next_out_file_path = get_next_out_file_path(parent_dir, file_path)
+    if args.output_format == 'parquet':
+        # 按jsonl的字节数切分，每个Parquet文件转换回jsonl后与直接输出jsonl时的对应文件相同
+        next_out_file_path = next_out_file_path.with_suffix('.parquet')
+        print("out file:",next_out_file_path)
+        return ParquetOutFile(next_out_file_path)
+    print("out file:",next_out_file_path)
+    return open(next_out_file_path, "wb", buffering=OUT_BUFFER_BYTES)
+
+def write_out_line(outjsonbytes: bytes, parent_dir: Path, file_path: Path):
+    global out_file_id, out_fp, out_file_size
+    if out_file_size + len(outjsonbytes) > args.bytes_limit: # 写入这一行会超过字节上限，切换到下一个输出文件
+        if out_fp is None: # 单行就超过上限时，与原先的实现一样留下一个空文件
+            out_fp = open_out_file(parent_dir, file_path)
+        out_fp.close()
+        out_fp = None
+        out_file_size = 0
+        out_file_id += 1
+    if out_fp is None:
+        out_fp = open_out_file(parent_dir, file_path)
+    out_fp.write(outjsonbytes)
+    out_file_size += len(outjsonbytes)
+
+def flush_out(parent_dir: Path, file_path: Path):
+    global out_fp, out_file_size
+    if out_fp is not None:
+        out_fp.close()
+    out_fp = None
+    out_file_size = 0
+
 def out_file(file_path: Path):
-    out_file_dir = file_path.parent / "jsonl_reworked"
-    global is_first
-    if is_first:
-        if os.path.exists(out_file_dir):
-            print(f"请确保{out_file_dir}目录为空，否则其内容可能会被覆盖。如不希望请直接结束本程序。")
-            if input("请输入Y以确认继续进行:") != 'Y':
-                print("程序退出...")
-                exit(0)
-        else:
-            os.makedirs(out_file_dir)
-        is_first = False
-    del out_file_dir
-    global out_file_id
+    ensure_out_dir(file_path.parent)
+    zh_digests = zh_md5_log.read(str(file_path))
     for lineidx, linejson in enumerate(gen_new_style_line(file_path, True)):
         if (str(file_path), lineidx) not in valid_line_idx_set:
             continue
         for lang_field in LANG_FIELDS:
             linejsonfield = linejson.get(lang_field, "").strip()
             linejson[lang_field] = linejsonfield
+        is_dup = (str(file_path), lineidx) in dup_line_idx_set
+        is_cross_file_dup = (str(file_path), lineidx) in cross_file_dup_line_idx_set
+        if zh_digests is not None:
+            zh_text_md5 = corpus_record.digest_to_md5(next(zh_digests))
+        else:
+            zh_text_md5 = corpus_record.zh_text_md5(linejson["zh_text"])
+        fill_line_fields(linejson, is_dup, is_cross_file_dup, zh_text_md5)
+        fill_file_stat_fields(linejson)
+        outjsonbytes = json_codec.dumps_sorted_bytes(linejson) + b'\n' # 这个是LF格式的换行
+        write_out_line(outjsonbytes, file_path.parent, file_path)
+
+# 单遍模式：文件级统计字段按键名排序后把一行切成4段，中间文件只存这4段序列化好的字节，回填时直接拼接，无需再次解析输入
+FILE_STAT_FIELDS = sorted(["段落数", "去重段落数", "低质量段落数"])
+SPILL_HEADER = struct.Struct('<IIIII')
+
+class LineSpill:
+    """单遍模式的中间文件，保存已经序列化、但尚未填写文件级统计字段的段落"""
+    def __init__(self, out_file_dir: Path):
+        self.fp = tempfile.TemporaryFile(dir=out_file_dir)
+        self.filenames = []
+        self.filename2id = {}
+
+    def append(self, linejson: dict):
         linejsonfilename = linejson['文件名']
-        filename2linecounter[linejsonfilename] += 1
-        dedup_bytes = linejson["zh_text"].encode("utf-8")
-        zhmd5 = hashlib.md5(dedup_bytes)
-        digest = zhmd5.digest() + (len(dedup_bytes) % 256).to_bytes(1, byteorder='big', signed=False)
-        zh_text_set = filename2zh_text_digest[linejsonfilename]
-        _prvlen = len(zh_text_set)
-        zh_text_set.discard(digest)
-        _afterlen = len(zh_text_set)
-        linejson['是否待查文件'] = False # 平行语料组固定将此字段给False
-        linejson['是否重复文件'] = False # 平行语料组固定将此字段给False
-        linejson['是否跨文件重复'] = False # 平行语料组固定将此字段给False
-
-        linejson['时间'] = datetime.now().strftime("%Y%m%d")
-        linejson['是否重复'] = _afterlen == _prvlen
-        linejson['段落数'] = filename2linecount[linejsonfilename]
-        linejson['去重段落数'] = filename2linecount[linejsonfilename] - filename2zh_text_dedup_count[linejsonfilename] # 经核实，此字段统计的是“重复了的段落”的个数
-        linejson['低质量段落数'] = filename2low_quality_count[linejsonfilename]
-        linejson['行号'] = filename2linecounter[linejsonfilename]
-        linejson['zh_text_md5'] = zhmd5.hexdigest()
-        outjsonbytes = (json.dumps(linejson, ensure_ascii=False, sort_keys=True) + '\n').encode('utf-8') # 这个是LF格式的换行
-        if bio.tell() + len(outjsonbytes) > args.bytes_limit:
-            next_out_file_path = get_next_out_file_path(file_path.parent, file_path)
-            with open(next_out_file_path, "wb") as fo:
-                print("out file:",next_out_file_path)
-                fo.write(bio.getbuffer().tobytes())
-                # bio.seek(0)
-                # bio.readinto(fo)
-                bio.seek(0)
-                bio.truncate()
-                out_file_id += 1
-        bio.write(outjsonbytes)
+        fileid = self.filename2id.get(linejsonfilename)
+        if fileid is None:
+            fileid = self.filename2id[linejsonfilename] = len(self.filenames)
+            self.filenames.append(linejsonfilename)
+        segments = [{} for _ in range(len(FILE_STAT_FIELDS) + 1)]
+        for k, v in linejson.items():
+            if k in FILE_STAT_FIELDS:
+                continue
+            segid = 0
+            while segid < len(FILE_STAT_FIELDS) and k > FILE_STAT_FIELDS[segid]:
+                segid += 1
+            segments[segid][k] = v
+        segments = [json_codec.dumps_sorted_bytes(seg)[1:-1] for seg in segments]
+        self.fp.write(SPILL_HEADER.pack(fileid, *map(len, segments)))
+        for seg in segments:
+            self.fp.write(seg)
+
+    def __iter__(self):
+        self.fp.flush()
+        self.fp.seek(0)
+        while True:
+            header = self.fp.read(SPILL_HEADER.size)
+            if not header:
+                break
+            fileid, *seglens = SPILL_HEADER.unpack(header)
+            yield self.filenames[fileid], [self.fp.read(seglen) for seglen in seglens]
+
+    def close(self):
+        self.fp.close()
+
+def process_file_single_pass(file_path: Path, spill: LineSpill):
+    ensure_out_dir(file_path.parent)
+    for linejson in gen_new_style_line(file_path, False):
+        line_digests = digest_line(linejson)
+        is_dup = accept_digests(line_digests)
+        if is_dup is None:
+            continue
+        fill_line_fields(linejson, is_dup, accept_cross_file(line_digests), corpus_record.digest_to_md5(line_digests[2]))
+        spill.append(linejson)
+    update_zh_text_dedup_count()
+
+def out_spill(spill: LineSpill, parent_dir: Path, file_path: Path):
+    for linejsonfilename, segments in spill:
+        stat = {'文件名': linejsonfilename}
+        fill_file_stat_fields(stat)
+        parts = [segments[0]]
+        for k, seg in zip(FILE_STAT_FIELDS, segments[1:]):
+            parts.append(f'"{k}": {stat[k]}'.encode('utf-8'))
+            parts.append(seg)
+        outjsonbytes = b'{' + b', '.join(part for part in parts if part) + b'}\n'
+        write_out_line(outjsonbytes, parent_dir, file_path)
+    spill.close()
+
+def reset_file_stats():
+    close_digest_stores()
+    filename2low_quality_count.clear()
+    filename2linecount.clear()
+    valid_line_idx_set.clear()
+    dup_line_idx_set.clear()
+    cross_file_dup_line_idx_set.clear()
+    filename2zh_text_dedup_count.clear()
+    filename2linecounter.clear()
+
+# --all_directory_mode的统计缓存：每个输入文件一个统计片段，存在 <目录>/stat_cache/<文件名>.pkl。
+# 片段以文件路径为键，记录文件大小、mtime和内容哈希；大小和mtime都没变时直接复用，
+# 只有mtime变了时再算内容哈希确认，因此往目录里新增或修改一个文件后只需重新统计这一个文件。
+STAT_CACHE_DIR = 'stat_cache'
+STAT_CACHE_VERSION = 1
+CONTENT_HASH_CHUNK_BYTES = 8 * 1024 * 1024
+
+def stat_cache_options():
+    # 会影响统计结果的参数，变了就不能复用旧片段
+    return (STAT_CACHE_VERSION, args.disable_rename, args.disable_opencc_convert)
+
+def hash_file_content(file_path: Path) -> bytes:
+    content_hash = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(CONTENT_HASH_CHUNK_BYTES)
+            if not chunk:
+                break
+            content_hash.update(chunk)
+    return content_hash.digest()
+
+def get_stat_fragment_path(file_path: Path) -> Path:
+    return file_path.parent / STAT_CACHE_DIR / (file_path.name + '.pkl')
+
+def save_stat_fragment(file_path: Path, fragment: dict):
+    fragment_path = get_stat_fragment_path(file_path)
+    fragment_path.parent.mkdir(exist_ok=True)
+    tmp_path = fragment_path.with_name(fragment_path.name + '.tmp')
+    with open(tmp_path, "wb") as f:
+        pickle.dump(fragment, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, fragment_path) # 中途被打断也不会留下写了一半的片段
+
+def load_stat_fragment(file_path: Path):
+    """读取文件对应的统计片段，片段不存在或已过期时返回None"""
+    fragment_path = get_stat_fragment_path(file_path)
+    if not fragment_path.exists():
+        return None
+    try:
+        with open(fragment_path, "rb") as f:
+            fragment = pickle.load(f)
+    except (pickle.UnpicklingError, EOFError):
+        print("统计缓存损坏，重新统计:",fragment_path)
+        return None
+    if fragment.get('options') != stat_cache_options():
+        return None
+    st = file_path.stat()
+    if fragment['size'] != st.st_size:
+        return None
+    if fragment['mtime_ns'] != st.st_mtime_ns:
+        # mtime变了但内容可能没变（如重新拷贝了一遍），用内容哈希确认
+        if hash_file_content(file_path) != fragment['content_hash']:
+            return None
+        fragment['mtime_ns'] = st.st_mtime_ns
+        save_stat_fragment(file_path, fragment)
+    return fragment
+
+def build_stat_fragment(file_path: Path) -> dict:
+    """单独统计一个文件，生成它的统计片段。调用前后全局统计状态都应为空"""
+    st = file_path.stat()
+    process_file(file_path)
+    close_digest_stores()
+    fragment = {
+        'options': stat_cache_options(),
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'content_hash': hash_file_content(file_path),
+        'low_quality_count': dict(filename2low_quality_count),
+        'linecount': dict(filename2linecount),
+        'zh_text_dedup_count': dict(filename2zh_text_dedup_count),
+        'valid_bitmap': valid_line_idx_set.get_bitmap(str(file_path)),
+        'dup_bitmap': dup_line_idx_set.get_bitmap(str(file_path)),
+    }
+    reset_file_stats()
+    return fragment
+
+def merge_stat_fragment(file_path: Path, fragment: dict):
+    # 各片段的文件名互不重叠，计数直接累加即可
+    filename2low_quality_count.update(fragment['low_quality_count'])
+    filename2linecount.update(fragment['linecount'])
+    filename2zh_text_dedup_count.update(fragment['zh_text_dedup_count'])
+    valid_line_idx_set.set_bitmap(str(file_path), fragment['valid_bitmap'])
+    dup_line_idx_set.set_bitmap(str(file_path), fragment['dup_bitmap'])
+
+def process_all_directory_stats(file_paths: list):
+    """
+    --all_directory_mode的统计阶段：有效的统计片段直接复用，新增或修改过的文件单独统计并写入片段。
+    去重和计数都以【文件名】字段为单位，只要各输入文件的文件名互不重叠，按文件拆开统计再合并的结果就与整体统计一致；
+    开了-dr后不同输入文件可能共用同一个文件名，这时片段无法合并，退回按顺序整体统计。
+    开启--global_index时每次运行都要把段落登记进索引，不使用统计缓存。
+    """
+    if global_dedup_index is not None:
+        for file_path in file_paths:
+            print('[reading directory] filename:',file_path.name)
+            process_file(file_path)
+        close_digest_stores()
+        return
+    fragments = []
+    filename2path = {}
+    for file_path in file_paths:
+        fragment = load_stat_fragment(file_path)
+        if fragment is None:
+            print('[reading directory] filename:',file_path.name)
+            fragment = build_stat_fragment(file_path)
+            save_stat_fragment(file_path, fragment)
+        else:
+            print('[cached] filename:',file_path.name)
+        if any(filename2path.setdefault(filename, file_path) != file_path for filename in fragment['linecount']):
+            break
+        fragments.append(fragment)
+    if len(fragments) != len(file_paths):
+        print('多个输入文件含有相同的【文件名】，统计片段无法合并，重新整体统计')
+        fragments.clear()
+        for file_path in file_paths:
+            print('[reading directory] filename:',file_path.name)
+            process_file(file_path)
+        close_digest_stores()
+        return
+    for file_path, fragment in zip(file_paths, fragments):
+        merge_stat_fragment(file_path, fragment)
+
+# jsonl_chk.cpp 编译出的程序遇到无法与本脚本逐字节一致处理的输入时（繁转简、浮点数等）以此退出码退出
+CPP_ENGINE_UNSUPPORTED = 3
+
+def run_cpp_engine(parent_dir: Path, engine_args: list) -> bool:
+    """
+    用 --cpp_engine 指定的程序处理，输出位置和切分方式与本脚本相同。
+    返回是否已处理完；程序报告输入不受支持时返回False，由调用方改用本脚本处理（会覆盖掉已经写出的输出文件）。
+    """
+    ensure_out_dir(parent_dir) # 覆盖确认由本脚本完成，子进程不再询问
+    cmd = [args.cpp_engine, *engine_args, '-y', '-b', str(args.bytes_limit)]
+    for enabled, flag in [(args.disable_rename, '-dr'), (args.disable_opencc_convert, '-dc'), (args.verbose, '-v'), (args.debug, '-dbg')]:
+        if enabled:
+            cmd.append(flag)
+    returncode = subprocess.run(cmd).returncode
+    if returncode == CPP_ENGINE_UNSUPPORTED:
+        print("--cpp_engine 不支持此输入，改用python实现处理")
+        return False
+    if returncode != 0:
+        exit(returncode)
+    return True
+
+def process_directory_file(file_path: Path):
+    """--directory模式下完整处理一个文件，处理完后重置所有文件级状态"""
+    global out_file_id
+    print('[directory] filename:',file_path.name)
+    if args.cpp_engine and run_cpp_engine(file_path.parent, [str(file_path)]):
+        return
+    if args.single_pass:
+        spill = LineSpill(ensure_out_dir(file_path.parent))
+        process_file_single_pass(file_path, spill)
+        out_spill(spill, file_path.parent, file_path)
+    else:
+        process_file(file_path)
+        out_file(file_path)
+        zh_md5_log.clear()
+    first_warn_unk_key.clear()
+    first_warn_other_texts_key_check.clear()
+    reset_file_stats()
+    flush_out(file_path.parent, file_path)
+    out_file_id = 1
+
+def init_worker():
+    global is_first
+    is_first = False # 输出目录已经由主进程确认过了
+
+def process_directory_file_worker(file_path: Path):
+    # 子进程里的exit()不会传回主进程，这里把退出码作为返回值交给主进程处理
+    try:
+        process_directory_file(file_path)
+    except SystemExit as e:
+        return e.code
+    return None
 
 if __name__ == "__main__":
+    if args.scan_workers > 1 and (args.workers > 1 or args.single_pass):
+        print("--scan_workers 不能与 --workers 或 --single_pass 同时使用。")
+        exit(1)
+    if args.global_index and args.workers > 1:
+        print("--global_index 不能与 --workers 同时使用。")
+        exit(1)
+    if args.global_index and args.cpp_engine:
+        print("--global_index 不能与 --cpp_engine 同时使用。")
+        exit(1)
+    if args.output_format != 'jsonl' and args.cpp_engine:
+        print("--cpp_engine 只能输出jsonl，不能与 --output_format parquet 同时使用。")
+        exit(1)
+    if args.global_index:
+        global_dedup_index = dedup_index.GlobalDedupIndex(args.global_index, args.hash_algorithm)
     if args.directory:
         if not args.all_directory_mode:
-            for filename in os.listdir(args.directory):
-                if filename.endswith('.jsonl'):
-                    print('[directory] filename:',filename)
-                    file_path = Path(os.path.join(args.directory, filename))
-                    process_file(file_path)
-                    out_file(file_path)
-                    first_warn_unk_key.clear()
-                    first_warn_other_texts_key_check.clear()
-                    filename2zh_text_digest.clear()
-                    filename2low_quality_count.clear()
-                    filename2linecount.clear()
-                    valid_line_idx_set.clear()
-                    filename2zh_text_dedup_count.clear()
-                    filename2linedigest.clear()
-                    filename2linecounter.clear()
-                    if bio.tell() > 0:
-                        next_out_file_path = get_next_out_file_path(file_path.parent, file_path)
-                        print("out file:",next_out_file_path)
-                        with open(next_out_file_path, "wb") as fo:
-                            fo.write(bio.getbuffer().tobytes())
-                    bio.seek(0)
-                    bio.truncate()
-                    out_file_id = 1
-        else:
-            cachepath = Path(os.path.join(args.directory, "stat.pkl"))
-            if cachepath.exists():
-                with open(cachepath, "rb") as f:
-                    print("Load cache file:",cachepath)
-                    first_warn_unk_key,first_warn_other_texts_key_check,filename2zh_text_digest,filename2low_quality_count,filename2linecount,valid_line_idx_set,filename2zh_text_dedup_count,filename2linedigest = pickle.load(f)
+            file_paths = [Path(os.path.join(args.directory, filename)) for filename in os.listdir(args.directory) if filename.endswith('.jsonl')]
+            if args.workers > 1 and file_paths:
+                ensure_out_dir(Path(args.directory))
+                with multiprocessing.Pool(args.workers, initializer=init_worker) as pool:
+                    # 各文件的输出互不相干，输出文件名和按-b切分的结果与串行执行完全一致
+                    for exit_code in pool.imap(process_directory_file_worker, file_paths, chunksize=1):
+                        if exit_code is not None:
+                            pool.terminate()
+                            exit(exit_code)
             else:
-                for filename in os.listdir(args.directory):
-                    if filename.endswith('.jsonl'):
-                        print('[reading directory] filename:',filename)
-                        process_file(Path(os.path.join(args.directory, filename)))
-                with open(cachepath, "wb") as f:
-                    pickle.dump(
-                        (
-                            first_warn_unk_key,
-                            first_warn_other_texts_key_check,
-                            filename2zh_text_digest,
-                            filename2low_quality_count,
-                            filename2linecount,
-                            valid_line_idx_set,
-                            filename2zh_text_dedup_count,
-                            filename2linedigest,
-                        ), f, pickle.HIGHEST_PROTOCOL
-                    )
-                    print("Write cache file:",cachepath)
+                for file_path in file_paths:
+                    process_directory_file(file_path)
+        elif args.cpp_engine and run_cpp_engine(Path(args.directory), ['-d', args.directory, '-a', args.all_directory_mode]):
+            pass
+        elif args.single_pass:
+            spill = LineSpill(ensure_out_dir(Path(args.directory)))
             for filename in os.listdir(args.directory):
                 if filename.endswith('.jsonl'):
-                    print('[output] filename:',filename)
-                    out_file(Path(os.path.join(args.directory, filename)))
-            if bio.tell() > 0:
-                next_out_file_path = get_next_out_file_path(Path(args.directory), None)
-                print("out file:",next_out_file_path)
-                with open(next_out_file_path, "wb") as fo:
-                    fo.write(bio.getbuffer().tobytes())
-            bio.seek(0)
-            bio.truncate()
+                    print('[reading directory] filename:',filename)
+                    process_file_single_pass(Path(os.path.join(args.directory, filename)), spill)
+            close_digest_stores()
+            out_spill(spill, Path(args.directory), None)
+            flush_out(Path(args.directory), None)
+        else:
+            file_paths = [Path(os.path.join(args.directory, filename)) for filename in os.listdir(args.directory) if filename.endswith('.jsonl')]
+            process_all_directory_stats(file_paths)
+            for file_path in file_paths:
+                print('[output] filename:',file_path.name)
+                out_file(file_path)
+            flush_out(Path(args.directory), None)
 
     elif args.input:
         print('[single file] filename:',args.input)
         input_path = Path(args.input)
-        process_file(input_path)
-        out_file(input_path)
-        if bio.tell() > 0:
-            next_out_file_path = get_next_out_file_path(input_path.parent, input_path)
-            print("out file:",next_out_file_path)
-            with open(next_out_file_path, "wb") as fo:
-                fo.write(bio.getbuffer().tobytes())
+        if args.cpp_engine and run_cpp_engine(input_path.parent, [args.input]):
+            pass
+        elif args.single_pass:
+            spill = LineSpill(ensure_out_dir(input_path.parent))
+            process_file_single_pass(input_path, spill)
+            out_spill(spill, input_path.parent, input_path)
+        else:
+            process_file(input_path)
+            out_file(input_path)
+        flush_out(input_path.parent, input_path)
     else:
         print("请提供一个目录或输入文件路径。")
         exit(0)
+    if global_dedup_index is not None:
+        global_dedup_index.flush()
+        print("global index:",args.global_index,"digests:",len(global_dedup_index))
+        global_dedup_index.close()
 
     # input("处理完毕，回车关闭")
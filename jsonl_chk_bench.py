@@ -0,0 +1,593 @@
+"""
+jsonl_chk.py 热点的基准测试脚本。
+
+繁转简（OpenCC）：
+    python jsonl_chk_bench.py opencc --lines 200000
+    python jsonl_chk_bench.py opencc --input 某个只有cht_text的语料.jsonl
+对比 每行新建转换器（旧实现）/ 复用转换器 / 复用转换器+结果缓存 / 批量转换 四种方式的吞吐。
+
+json编解码：
+    python jsonl_chk_bench.py codec --lines 200000
+    python jsonl_chk_bench.py codec --input 某个语料.jsonl
+对每个可用的后端（标准库、orjson、msgspec）分别测试逐行解码、按键排序编码的吞吐，并校验编码结果与标准库逐字节一致。
+
+旧版语料展平：
+    python jsonl_chk_bench.py flatten --paragraphs 17944
+对比 deepcopy整条记录（旧实现）与逐段落浅拷贝 两种展平方式的内存峰值（tracemalloc）和耗时，默认使用与 Terraria 样例同样规模的单条旧版记录。
+
+C++实现的差分测试：
+    python jsonl_chk_bench.py cppdiff --engine ./jsonl_chk
+    python jsonl_chk_bench.py cppdiff --engine ./jsonl_chk --input 某个语料目录
+生成一份覆盖各种边角情况的语料（unicode空白、转义字符、缺字段、拓展字段、旧版语料、CRLF换行、跨文件同名等），
+分别用 jsonl_chk.py 和 jsonl_chk.cpp 编译出的程序按单文件、-d、-a、-a -dr、小 -b 几种方式处理，逐字节比较全部输出文件，不一致时退出码非0。
+另外检查需要繁转简或含浮点数的输入会让C++程序以不支持退出，且 jsonl_chk.py --cpp_engine 此时退回python实现后的输出仍然一致。
+
+整体流程（统计 process_file + 输出 out_file）：
+    python jsonl_chk_bench.py pipeline --lines 200000 --old_style_ratio 0.5 --dup_rate 0.1 --ext_shape nested --output result.json
+    python jsonl_chk_bench.py pipeline --lines 200000 --old_style_ratio 0.5 --dup_rate 0.1 --ext_shape nested --baseline result.json
+按给定的规模、语种数、重复率、扩展字段形状、繁体比例生成新版/旧版语料，在新的子进程中跑完两个阶段，
+报告各阶段的 lines/s、峰值RSS和输出字节数，结果可存成json；给出 --baseline 时与之对比，吞吐下降或内存上涨超过 --tolerance 即以非0退出码结束，
+用于在评审时发现去重哈希、OpenCC、json编解码等热点的性能回退。
+"""
+import argparse
+import contextlib
+import copy
+import filecmp
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import json_codec
+import jsonl_chk
+
+LANG_WORDS = {
+    "zh_text": ["正在", "生成", "海洋", "沙子", "你好", "世界", "确定", "取消", "第一章"],
+    "en_text": ["Generating", "ocean", "sand", "hello", "world", "OK", "Cancel", "Chapter", "\"quoted\""],
+    "fr_text": ["Génération", "du", "sable", "de", "l'océan", "Bonjour"],
+    "ru_text": ["Создание", "песка", "в", "океане", "Привет"],
+    "ja_text": ["海の砂", "を", "生成中", "こんにちは"],
+}
+CHT_WORDS = ["這個", "們", "說話", "時間", "為什麼", "會議", "國家", "經濟", "發展", "學習", "電腦", "遊戲", "開始", "結束", "記錄", "準備", "關係", "問題", "歷史", "語言"]
+
+
+def gen_cht_texts(lines: int, dup_rate: float, seed: int) -> list:
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(lines):
+        if texts and rng.random() < dup_rate:
+            texts.append(rng.choice(texts))
+        else:
+            texts.append("，".join(rng.choices(CHT_WORDS, k=rng.randint(2, 12))) + "。")
+    return texts
+
+
+def load_cht_texts(input_path: str, lines: int) -> list:
+    texts = []
+    with open(input_path, "r", encoding="utf-8") as f:
+        for linestr in f:
+            linestr = linestr.strip()
+            if not linestr:
+                continue
+            data = json.loads(linestr)
+            for p in data.get("段落", [data]):
+                if p.get("cht_text"):
+                    texts.append(p["cht_text"])
+            if len(texts) >= lines:
+                break
+    return texts[:lines]
+
+
+def gen_new_style_lines(lines: int, seed: int) -> list:
+    rng = random.Random(seed)
+    result = []
+    for i in range(lines):
+        record = {field: "" for field in jsonl_chk.LANG_FIELDS}
+        for lang_field, words in LANG_WORDS.items():
+            if lang_field in ("zh_text", "en_text") or rng.random() < 0.4:
+                record[lang_field] = " ".join(rng.choices(words, k=rng.randint(1, 8)))
+        record.update({"文件名": "bench.jsonl", "是否待查文件": False, "是否重复文件": False, "段落数": lines, "去重段落数": 0, "低质量段落数": 0,
+                       "行号": i + 1, "是否重复": False, "是否跨文件重复": False, "时间": "20240316", "zh_text_md5": ""})
+        record["扩展字段"] = json_codec.dumps_sorted({"other_texts": {"cs": "Generování mořského písku", "pl": "Generowanie piasku morskiego"}} if rng.random() < 0.3 else {})
+        result.append(json.dumps(record, ensure_ascii=False))
+    return result
+
+
+def load_lines(input_path: str, lines: int) -> list:
+    result = []
+    with open(input_path, "r", encoding="utf-8") as f:
+        for linestr in f:
+            linestr = linestr.strip()
+            if linestr:
+                result.append(linestr)
+            if len(result) >= lines:
+                break
+    return result
+
+
+def gen_old_style_record(paragraphs: int, seed: int) -> dict:
+    """生成一条Terraria样例那样的旧版记录：一个文件级dict带上全部段落"""
+    rng = random.Random(seed)
+    paras = []
+    for i in range(paragraphs):
+        p = {field: "" for field in jsonl_chk.LANG_FIELDS}
+        for lang_field, words in LANG_WORDS.items():
+            p[lang_field] = " ".join(rng.choices(words, k=rng.randint(1, 6)))
+        p.update({"行号": i + 1, "是否重复": False, "是否跨文件重复": False, "other1_text": "", "other2_text": "", "时间": "20240316", "zh_text_md5": ""})
+        p["扩展字段"] = json_codec.dumps_sorted({"other_texts": {"cs": "Generování mořského písku", "pl": "Generowanie piasku morskiego", "hu": "Tengeri homok elhelyezése", "uk": "Генерація океанського піску", "tr": "Okyanus kumu üretme"}})
+        paras.append(p)
+    return {
+        "文件名": "Terraria-workshop-localization_test2.jsonl",
+        "是否待查文件": False,
+        "是否重复文件": False,
+        "段落数": paragraphs,
+        "去重段落数": 0,
+        "低质量段落数": 0,
+        "段落": paras,
+        "扩展字段": json_codec.dumps_sorted({"other_texts_iso_map": {"cs": "捷克语", "pl": "波兰语", "hu": "匈牙利语", "uk": "乌克兰语", "tr": "土耳其语"}}),
+        "时间": "20240316",
+    }
+
+
+PADDINGS = ["", " ", "\t", "\u3000", "\xa0", "\u2028", " \u200b"] # \u200b不是空白，不应被去掉
+TRICKY_TEXTS = ["含\"引号\"与\\反斜杠", "换行\n与\r回车", "控制字符\x01\x1f\x7f", "表情😀与\u2028分隔符", "/斜杠/", "\u0000空字符"]
+
+
+def gen_cpp_diff_record(rng: random.Random, i: int) -> dict:
+    record = {}
+    for lang_field, words in LANG_WORDS.items():
+        if lang_field in ("zh_text", "en_text") or rng.random() < 0.4:
+            text = " ".join(rng.choices(words, k=rng.randint(1, 4)))
+            if rng.random() < 0.1:
+                text = rng.choice(TRICKY_TEXTS)
+            record[lang_field] = rng.choice(PADDINGS) + text + rng.choice(PADDINGS)
+    if rng.random() < 0.1:
+        record["en_text"] = "" # 低质量段落
+    if rng.random() < 0.05:
+        record = {"zh_text": "  ", "en_text": "\u3000"} # 空段落
+    ext = rng.choice([{}, {"other_texts": {"cs": "Generování", "pl": "Generowanie"}}, {"k": [1, 2, {"b": True, "a": None}]}, {"未定义": "值", "k": -7}])
+    ext_key = "拓展字段" if rng.random() < 0.1 else "扩展字段"
+    record[ext_key] = "" if not ext and rng.random() < 0.5 else json.dumps(ext, ensure_ascii=rng.random() < 0.5)
+    record.update({"文件名": "new.jsonl", "行号": i + 1, "是否重复": False, "时间": "20240316", "多余字段": 12345678901234567890})
+    return record
+
+
+def gen_cpp_diff_corpus(corpus_dir: str, lines: int, seed: int):
+    """生成差分测试用的语料目录，各文件覆盖不同的边角情况"""
+    rng = random.Random(seed)
+    os.makedirs(corpus_dir)
+    records = [gen_cpp_diff_record(rng, i) for i in range(lines)]
+    records += [dict(rng.choice(records)) for _ in range(lines // 5)] # 完全重复与zh_text重复的段落
+    rng.shuffle(records)
+    with open(os.path.join(corpus_dir, "new.jsonl"), "w", encoding="utf-8", newline="") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=rng.random() < 0.3) + rng.choice(["\n", "\n", "\r\n", "\n\n", "\n   \n"]))
+    old_record = gen_old_style_record(max(lines // 10, 1), seed)
+    old_record["段落"][0]["时间"] = ""
+    old_record["段落"][-1]["en_text"] = "\u3000" + old_record["段落"][-1]["en_text"]
+    with open(os.path.join(corpus_dir, "old.jsonl"), "w", encoding="utf-8") as f:
+        f.write(json.dumps(old_record, ensure_ascii=False) + "\n")
+        for record in records[:lines // 10]:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    # 同一文件里出现多个文件名，配合-dr测试以文件名为单位的统计
+    with open(os.path.join(corpus_dir, "shared.jsonl"), "w", encoding="utf-8") as f:
+        for record in records[:lines // 2]:
+            f.write(json.dumps(dict(record, 文件名=rng.choice(["new.jsonl", "shared.jsonl", "其它.jsonl"])), ensure_ascii=False) + "\n")
+
+
+def run_engines(corpus_dir: str, work_dir: str, engine: str, mode_args: list, cpp_engine_via_py: bool = False) -> list:
+    """分别用python和C++实现处理语料目录的两份拷贝，返回不一致的输出文件列表"""
+    out_dirs = []
+    returncodes = []
+    for name in ["py", "cpp"]:
+        target = os.path.join(work_dir, name)
+        shutil.rmtree(target, ignore_errors=True)
+        shutil.copytree(corpus_dir, target)
+        cmd_args = [a.replace("{dir}", target) for a in mode_args]
+        if name == "py":
+            cmd = [sys.executable, "jsonl_chk.py", *cmd_args]
+        elif cpp_engine_via_py:
+            cmd = [sys.executable, "jsonl_chk.py", *cmd_args, "--cpp_engine", engine]
+        else:
+            cmd = [engine, *cmd_args, "-y"]
+        returncodes.append(subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode)
+        out_dirs.append(os.path.join(target, "jsonl_reworked"))
+    if returncodes != [0, 0]:
+        return [f"exit code: py {returncodes[0]}, cpp {returncodes[1]}"]
+    py_files, cpp_files = (sorted(os.listdir(d)) for d in out_dirs)
+    if py_files != cpp_files:
+        return [f"file list: {py_files} != {cpp_files}"]
+    return [name for name in py_files if not filecmp.cmp(*(os.path.join(d, name) for d in out_dirs), shallow=False)]
+
+
+def first_diff_line(py_path: str, cpp_path: str) -> str:
+    with open(py_path, "rb") as f1, open(cpp_path, "rb") as f2:
+        for lineno, (l1, l2) in enumerate(zip(f1, f2), 1):
+            if l1 != l2:
+                return f"line {lineno}:\n  py : {l1[:300]!r}\n  cpp: {l2[:300]!r}"
+    return "different number of lines"
+
+
+FILLER_WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+EXT_SHAPES = ["empty", "other_texts", "nested"]
+
+
+def gen_ext_field(rng: random.Random, ext_shape: str) -> str:
+    if ext_shape == "empty":
+        return "{}"
+    ext = {"other_texts": {"cs": "Generování mořského písku", "pl": "Generowanie piasku morskiego", "uk": "Генерація океанського піску"}}
+    if ext_shape == "nested":
+        ext["k"] = {"章节": rng.randint(1, 100), "标签": rng.sample(["剧情", "任务", "物品", "技能", "系统"], k=3), "来源": {"游戏": "bench", "版本": "1.4.4"}}
+    return json_codec.dumps_sorted(ext)
+
+
+def gen_pipeline_paragraph(rng: random.Random, bench_args, history: list) -> dict:
+    """生成一个段落；按--dup_rate完全重复之前的段落，按--zh_dup_rate只重复zh_text，按--cht_ratio只给cht_text"""
+    if history and rng.random() < bench_args.dup_rate:
+        return dict(rng.choice(history))
+    other_fields = [field for field in jsonl_chk.LANG_FIELDS if field not in ("zh_text", "en_text", "cht_text")]
+    paragraph = {field: "" for field in jsonl_chk.LANG_FIELDS}
+    for field in ["zh_text", "en_text"] + rng.sample(other_fields, k=max(bench_args.langs - 2, 0)):
+        paragraph[field] = " ".join(rng.choices(LANG_WORDS.get(field, FILLER_WORDS), k=rng.randint(2, 12)))
+    if history and rng.random() < bench_args.zh_dup_rate:
+        paragraph["zh_text"] = rng.choice(history)["zh_text"]
+    if rng.random() < bench_args.cht_ratio:
+        paragraph["zh_text"] = ""
+        paragraph["cht_text"] = "，".join(rng.choices(CHT_WORDS, k=rng.randint(2, 12)))
+    paragraph["扩展字段"] = gen_ext_field(rng, bench_args.ext_shape)
+    if len(history) < 10000:
+        history.append(paragraph)
+    else:
+        history[rng.randrange(len(history))] = paragraph
+    return paragraph
+
+
+def gen_pipeline_corpus(corpus_dir: str, bench_args) -> int:
+    """生成新版语料 new.jsonl 和旧版语料 old.jsonl（每条记录--paragraphs个段落），返回段落总数"""
+    rng = random.Random(bench_args.seed)
+    os.makedirs(corpus_dir)
+    history = []
+    old_lines = round(bench_args.lines * bench_args.old_style_ratio)
+    new_lines = bench_args.lines - old_lines
+    if new_lines:
+        with open(os.path.join(corpus_dir, "new.jsonl"), "w", encoding="utf-8") as f:
+            for i in range(new_lines):
+                record = gen_pipeline_paragraph(rng, bench_args, history)
+                record.update({"文件名": "new.jsonl", "是否待查文件": False, "是否重复文件": False, "段落数": 0, "去重段落数": 0, "低质量段落数": 0,
+                               "行号": i + 1, "是否重复": False, "是否跨文件重复": False, "时间": "20240316", "zh_text_md5": ""})
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    if old_lines:
+        with open(os.path.join(corpus_dir, "old.jsonl"), "w", encoding="utf-8") as f:
+            for offset in range(0, old_lines, bench_args.paragraphs):
+                paragraphs = []
+                for i in range(offset, min(offset + bench_args.paragraphs, old_lines)):
+                    paragraph = gen_pipeline_paragraph(rng, bench_args, history)
+                    paragraph.update({"行号": i + 1, "是否重复": False, "是否跨文件重复": False, "other1_text": "", "other2_text": "", "时间": "", "zh_text_md5": ""})
+                    paragraphs.append(paragraph)
+                record = {"文件名": "old.jsonl", "是否待查文件": False, "是否重复文件": False, "段落数": len(paragraphs), "去重段落数": 0, "低质量段落数": 0,
+                          "段落": paragraphs, "扩展字段": gen_ext_field(rng, bench_args.ext_shape), "时间": "20240316"}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return bench_args.lines
+
+
+def peak_rss_mib():
+    if resource is None: # Windows上没有resource模块
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024 # macOS单位为字节，Linux为KiB
+
+
+def run_pipeline(corpus_dir: str, options: dict) -> dict:
+    """在新的子进程中按--directory模式逐个文件跑完统计和输出两个阶段，峰值RSS只反映这一次运行"""
+    for k, v in options.items():
+        setattr(jsonl_chk.args, k, v)
+    json_codec.set_backend(jsonl_chk.args.json_backend)
+    seconds = {"process_file": 0.0, "out_file": 0.0}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for filename in sorted(os.listdir(corpus_dir)):
+            if not filename.endswith(".jsonl"):
+                continue
+            file_path = Path(corpus_dir) / filename
+            start = time.perf_counter()
+            jsonl_chk.process_file(file_path)
+            seconds["process_file"] += time.perf_counter() - start
+            start = time.perf_counter()
+            jsonl_chk.out_file(file_path)
+            jsonl_chk.flush_out(file_path.parent, file_path)
+            seconds["out_file"] += time.perf_counter() - start
+            jsonl_chk.reset_file_stats()
+            jsonl_chk.out_file_id = 1
+    out_dir = os.path.join(corpus_dir, "jsonl_reworked")
+    bytes_written = 0
+    lines_written = 0
+    for filename in os.listdir(out_dir):
+        with open(os.path.join(out_dir, filename), "rb") as f:
+            for linebytes in f:
+                bytes_written += len(linebytes)
+                lines_written += 1
+    return {"seconds": seconds, "peak_rss_mib": peak_rss_mib(), "bytes_written": bytes_written, "lines_written": lines_written}
+
+
+def compare_with_baseline(result: dict, baseline: dict, tolerance: float) -> list:
+    """打印与基线的对比，返回超出容忍范围的回退项"""
+    if result["config"] != baseline["config"]:
+        print("warning: corpus config differs from the baseline, numbers are not comparable")
+    regressions = []
+    for stage, stat in result["stages"].items():
+        old = baseline["stages"].get(stage, {}).get("lines_per_sec")
+        if not old:
+            continue
+        change = stat["lines_per_sec"] / old - 1
+        print(f"{stage:<16} {old:>12.0f} -> {stat['lines_per_sec']:>12.0f} lines/s ({change:+.1%})")
+        if change < -tolerance:
+            regressions.append(stage)
+    if result["peak_rss_mib"] and baseline.get("peak_rss_mib"):
+        change = result["peak_rss_mib"] / baseline["peak_rss_mib"] - 1
+        print(f"{'peak_rss':<16} {baseline['peak_rss_mib']:>12.1f} -> {result['peak_rss_mib']:>12.1f} MiB ({change:+.1%})")
+        if change > tolerance:
+            regressions.append("peak_rss")
+    if result["bytes_written"] != baseline.get("bytes_written"):
+        print(f"warning: bytes written changed {baseline.get('bytes_written')} -> {result['bytes_written']}")
+    return regressions
+
+
+def legacy_flatten_old_style_record(data: dict):
+    # 旧实现：deepcopy整条记录后反复改写同一个dict
+    data_cloned = copy.deepcopy(data)
+    data_cloned.pop('段落')
+    for p in data['段落']:
+        for k in jsonl_chk.KEEP_KEYS:
+            data_cloned[k] = p[k]
+        yield data_cloned
+
+
+def report(name: str, lines: int, seconds: float):
+    print(f"{name:<16} {lines:>10} lines {seconds:>9.3f} s {lines / seconds:>12.0f} lines/s")
+
+
+def bench_opencc(bench_args):
+    import opencc
+    if bench_args.input:
+        texts = load_cht_texts(bench_args.input, bench_args.lines)
+    else:
+        texts = gen_cht_texts(bench_args.lines, bench_args.dup_rate, bench_args.seed)
+    print(f"{len(texts)} cht_text lines, {len(set(texts))} distinct")
+
+    legacy_texts = texts[:bench_args.legacy_lines]
+    start = time.perf_counter()
+    legacy = [opencc.OpenCC(config="t2s").convert(text) for text in legacy_texts]
+    report("per_line", len(legacy_texts), time.perf_counter() - start)
+
+    converter = opencc.OpenCC(config="t2s")
+    start = time.perf_counter()
+    expected = [converter.convert(text) for text in texts]
+    report("cached", len(texts), time.perf_counter() - start)
+    assert expected[:len(legacy)] == legacy
+
+    jsonl_chk.t2s_cache.clear()
+    start = time.perf_counter()
+    memoized = [jsonl_chk.t2s_batch([text])[0] for text in texts]
+    report("memoized", len(texts), time.perf_counter() - start)
+    assert memoized == expected
+
+    jsonl_chk.t2s_cache.clear()
+    start = time.perf_counter()
+    batched = []
+    for offset in range(0, len(texts), jsonl_chk.OPENCC_BATCH_SIZE):
+        batched.extend(jsonl_chk.t2s_batch(texts[offset:offset + jsonl_chk.OPENCC_BATCH_SIZE]))
+    report("batched", len(texts), time.perf_counter() - start)
+    assert batched == expected
+
+
+def bench_codec(bench_args):
+    if bench_args.input:
+        lines = load_lines(bench_args.input, bench_args.lines)
+    else:
+        lines = gen_new_style_lines(bench_args.lines, bench_args.seed)
+    print(f"{len(lines)} lines, {sum(map(len, lines))} characters")
+    expected = None
+    for backend in ["json", "orjson", "msgspec"]:
+        try:
+            json_codec.set_backend(backend)
+        except ImportError:
+            print(f"{backend}: not installed, skipped")
+            continue
+        start = time.perf_counter()
+        records = [json_codec.loads(linestr) for linestr in lines]
+        report(f"{backend}.loads", len(lines), time.perf_counter() - start)
+        start = time.perf_counter()
+        encoded = [json_codec.dumps_sorted_bytes(record) for record in records]
+        report(f"{backend}.dumps", len(lines), time.perf_counter() - start)
+        if expected is None:
+            expected = encoded
+        assert encoded == expected, f"{backend} 的编码结果与标准库不一致"
+
+
+def bench_flatten(bench_args):
+    linestr = json.dumps(gen_old_style_record(bench_args.paragraphs, bench_args.seed), ensure_ascii=False)
+    print(f"1 old-style record, {bench_args.paragraphs} paragraphs, {len(linestr.encode('utf-8'))} bytes")
+    for name, flatten in [("deepcopy", legacy_flatten_old_style_record), ("shallow", jsonl_chk.flatten_old_style_record)]:
+        data = json.loads(linestr)
+        tracemalloc.start()
+        baseline, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        count = 0
+        for record in flatten(data):
+            json_codec.dumps_sorted_bytes(record)
+            count += 1
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report(name, count, seconds)
+        print(f"{'':<16} peak memory above parsed record: {(peak - baseline) / 1024 / 1024:.1f} MiB")
+
+
+def bench_cppdiff(bench_args):
+    engine = os.path.abspath(bench_args.engine)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    work_dir = tempfile.mkdtemp(prefix="jsonl_chk_cppdiff_")
+    failed = False
+    try:
+        corpus_dir = bench_args.input
+        if corpus_dir is None:
+            corpus_dir = os.path.join(work_dir, "corpus")
+            gen_cpp_diff_corpus(corpus_dir, bench_args.lines, bench_args.seed)
+        first_file = sorted(name for name in os.listdir(corpus_dir) if name.endswith(".jsonl"))[0]
+        modes = [
+            [os.path.join("{dir}", first_file), "-dc"],
+            ["-d", "{dir}", "-dc"],
+            ["-d", "{dir}", "-dc", "-b", "4096"],
+            ["-d", "{dir}", "-a", "ALL", "-dc"],
+            ["-d", "{dir}", "-a", "ALL", "-dr", "-dc", "-b", "65536"],
+        ]
+        for mode_args in modes:
+            start = time.perf_counter()
+            diffs = run_engines(corpus_dir, work_dir, engine, mode_args)
+            name = " ".join(mode_args).replace("{dir}", "<dir>")
+            print(f"{'DIFF' if diffs else 'OK':<5} {name} ({time.perf_counter() - start:.1f} s)")
+            for diff in diffs:
+                failed = True
+                print("  ", diff, first_diff_line(*(os.path.join(work_dir, e, "jsonl_reworked", diff) for e in ["py", "cpp"])) if diff.endswith(".jsonl") else "")
+        if bench_args.input is None:
+            # C++实现无法逐字节复现的输入：应以不支持退出，经 jsonl_chk.py --cpp_engine 调用时退回python实现
+            unsupported_dir = os.path.join(work_dir, "unsupported")
+            os.makedirs(unsupported_dir)
+            with open(os.path.join(unsupported_dir, "float.jsonl"), "w", encoding="utf-8") as f:
+                f.write(json.dumps({"zh_text": "浮点", "en_text": "float", "扩展字段": json.dumps({"k": 1e16})}, ensure_ascii=False) + "\n")
+            returncode = subprocess.run([engine, os.path.join(unsupported_dir, "float.jsonl"), "-y"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+            print(f"{'OK' if returncode == 3 else 'DIFF':<5} unsupported input exits with 3 (got {returncode})")
+            failed |= returncode != 3
+            shutil.rmtree(os.path.join(unsupported_dir, "jsonl_reworked"), ignore_errors=True)
+            diffs = run_engines(unsupported_dir, work_dir, engine, ["-d", "{dir}", "-dc"], cpp_engine_via_py=True)
+            print(f"{'DIFF' if diffs else 'OK':<5} jsonl_chk.py --cpp_engine falls back to python")
+            failed |= bool(diffs)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if failed:
+        sys.exit(1)
+
+
+def bench_pipeline(bench_args):
+    if bench_args.cht_ratio > 0 and importlib.util.find_spec("opencc") is None:
+        print("未安装opencc，请先 pip install opencc，或使用 --cht_ratio 0")
+        sys.exit(1)
+    hash_algorithm = bench_args.hash_algorithm
+    if hash_algorithm == "auto":
+        hash_algorithm = "xxh3" if jsonl_chk.xxhash is not None else "blake2b"
+    json_codec.set_backend(bench_args.json_backend)
+    options = {"json_backend": json_codec.backend, "hash_algorithm": hash_algorithm, "digest_store": bench_args.digest_store,
+               "disable_opencc_convert": False, "bytes_limit": jsonl_chk.args.bytes_limit}
+    config = {k: getattr(bench_args, k) for k in ["lines", "old_style_ratio", "paragraphs", "langs", "dup_rate", "zh_dup_rate", "ext_shape", "cht_ratio", "seed"]}
+    work_dir = tempfile.mkdtemp(prefix="jsonl_chk_pipeline_")
+    try:
+        corpus_dir = os.path.join(work_dir, "corpus")
+        start = time.perf_counter()
+        lines = gen_pipeline_corpus(corpus_dir, bench_args)
+        corpus_bytes = sum(os.path.getsize(os.path.join(corpus_dir, name)) for name in os.listdir(corpus_dir))
+        print(f"{lines} lines, {corpus_bytes} bytes generated in {time.perf_counter() - start:.1f} s")
+        runs = []
+        # 每次运行都用一个新的spawn子进程，峰值RSS不受本进程生成语料的影响
+        with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+            for _ in range(bench_args.repeat):
+                shutil.rmtree(os.path.join(corpus_dir, "jsonl_reworked"), ignore_errors=True)
+                runs.append(pool.apply(run_pipeline, (corpus_dir, options)))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    stages = {}
+    for stage in ["process_file", "out_file"]:
+        seconds = min(run["seconds"][stage] for run in runs) # 多次运行取最快的一次，减少噪声
+        stages[stage] = {"seconds": seconds, "lines_per_sec": lines / seconds}
+        report(stage, lines, seconds)
+    total_seconds = sum(stat["seconds"] for stat in stages.values())
+    report("total", lines, total_seconds)
+    rss = [run["peak_rss_mib"] for run in runs if run["peak_rss_mib"] is not None]
+    result = {
+        "config": config,
+        "options": options,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpus_bytes": corpus_bytes,
+        "lines": lines,
+        "lines_written": runs[0]["lines_written"],
+        "bytes_written": runs[0]["bytes_written"],
+        "stages": stages,
+        "total_lines_per_sec": lines / total_seconds,
+        "peak_rss_mib": max(rss) if rss else None,
+    }
+    print(f"{'':<16} peak RSS {result['peak_rss_mib'] or 0:.1f} MiB, {result['lines_written']} lines / {result['bytes_written']} bytes written")
+    if bench_args.output:
+        with open(bench_args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print("result written to", bench_args.output)
+    if bench_args.baseline:
+        with open(bench_args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(result, baseline, bench_args.tolerance)
+        if regressions:
+            print("regression:", ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the hot loops of jsonl_chk.py")
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+    opencc_parser = subparsers.add_parser("opencc", help="Traditional-to-Simplified conversion throughput on a Traditional-only corpus")
+    opencc_parser.add_argument("--input", type=str, help="Take cht_text values from this jsonl file instead of generating them")
+    opencc_parser.add_argument("--lines", type=int, default=200000, help="Number of cht_text lines to convert")
+    opencc_parser.add_argument("--dup_rate", type=float, default=0.3, help="Ratio of repeated lines in the generated corpus")
+    opencc_parser.add_argument("--legacy_lines", type=int, default=200, help="Number of lines converted with a new converter per line (slow)")
+    opencc_parser.add_argument("--seed", type=int, default=0)
+    codec_parser = subparsers.add_parser("codec", help="JSON decode / sorted-key encode throughput of every available backend")
+    codec_parser.add_argument("--input", type=str, help="Take lines from this jsonl file instead of generating them")
+    codec_parser.add_argument("--lines", type=int, default=200000, help="Number of lines to decode and encode")
+    codec_parser.add_argument("--seed", type=int, default=0)
+    flatten_parser = subparsers.add_parser("flatten", help="Peak memory and time of flattening one old-style record")
+    flatten_parser.add_argument("--paragraphs", type=int, default=17944, help="Number of paragraphs in the generated old-style record")
+    flatten_parser.add_argument("--seed", type=int, default=0)
+    cppdiff_parser = subparsers.add_parser("cppdiff", help="Check that the jsonl_chk.cpp engine writes byte-identical output to jsonl_chk.py")
+    cppdiff_parser.add_argument("--engine", type=str, required=True, help="Executable built from jsonl_chk.cpp")
+    cppdiff_parser.add_argument("--input", type=str, help="Compare on a copy of this corpus directory instead of a generated one")
+    cppdiff_parser.add_argument("--lines", type=int, default=3000, help="Number of new-style lines in the generated corpus")
+    cppdiff_parser.add_argument("--seed", type=int, default=0)
+    pipeline_parser = subparsers.add_parser("pipeline", help="Throughput, peak RSS and output size of process_file + out_file on a synthetic corpus")
+    pipeline_parser.add_argument("--lines", type=int, default=200000, help="Number of paragraphs in the generated corpus")
+    pipeline_parser.add_argument("--old_style_ratio", type=float, default=0.5, help="Ratio of paragraphs written as old-style records (the rest are new-style lines)")
+    pipeline_parser.add_argument("--paragraphs", type=int, default=1000, help="Number of paragraphs per old-style record")
+    pipeline_parser.add_argument("--langs", type=int, default=4, help="Number of non-empty language fields per paragraph, zh_text and en_text included")
+    pipeline_parser.add_argument("--dup_rate", type=float, default=0.1, help="Ratio of paragraphs that exactly repeat an earlier one (dropped by deduplication)")
+    pipeline_parser.add_argument("--zh_dup_rate", type=float, default=0.1, help="Ratio of paragraphs that repeat only the zh_text of an earlier one")
+    pipeline_parser.add_argument("--ext_shape", type=str, choices=EXT_SHAPES, default="other_texts", help="Shape of the extension field of every paragraph")
+    pipeline_parser.add_argument("--cht_ratio", type=float, default=0.0, help="Ratio of paragraphs that only have cht_text and need OpenCC conversion")
+    pipeline_parser.add_argument("--json_backend", type=str, choices=json_codec.BACKENDS, default="auto")
+    pipeline_parser.add_argument("--hash_algorithm", type=str, choices=["auto", "xxh3", "blake2b", "md5"], default="auto")
+    pipeline_parser.add_argument("--digest_store", type=str, choices=list(jsonl_chk.DIGEST_STORES), default="set")
+    pipeline_parser.add_argument("--repeat", type=int, default=1, help="Run the pipeline this many times and keep the fastest run of each stage")
+    pipeline_parser.add_argument("--output", type=str, help="Write the result to this JSON file")
+    pipeline_parser.add_argument("--baseline", type=str, help="Compare with a result JSON written by --output, exit with 1 on regressions")
+    pipeline_parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative throughput drop / peak RSS growth against the baseline")
+    pipeline_parser.add_argument("--seed", type=int, default=0)
+    bench_args = parser.parse_args()
+    if bench_args.bench == "opencc":
+        bench_opencc(bench_args)
+    elif bench_args.bench == "codec":
+        bench_codec(bench_args)
+    elif bench_args.bench == "flatten":
+        bench_flatten(bench_args)
+    elif bench_args.bench == "cppdiff":
+        bench_cppdiff(bench_args)
+    elif bench_args.bench == "pipeline":
+        bench_pipeline(bench_args)